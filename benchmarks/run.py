@@ -0,0 +1,241 @@
+"""
+CPU benchmark of `SemanticLoss` on a ladder of synthetic constraints and batch sizes.
+
+For every constraint the runner times the parsing and normalization of the `sdd` and `vtree` files
+(`SemanticLoss._import_psdd`) and the construction of the loss, then, for every batch size, the forward pass,
+the forward and backward pass, the size of the autograd graph and the peak resident memory. Each batch size
+is measured in a forked process, so that the peak memory of a measurement is not hidden by the previous ones.
+
+Usage:
+    python benchmarks/run.py --output benchmark.json
+    python benchmarks/run.py --quick --batch-sizes 1 64 4096
+"""
+import argparse
+import json
+import multiprocessing
+import os
+import platform
+import resource
+import statistics
+import sys
+import tempfile
+import time
+from typing import Callable, Dict, List, Sequence, Tuple
+
+import torch
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from semantic_loss_pytorch import SemanticLoss, builders  # noqa: E402
+from semantic_loss_pytorch.py3psdd import PSddNode, Vtree, io  # noqa: E402
+
+
+BATCH_SIZES = [1, 4, 16, 64, 256, 1024, 4096]
+
+
+# ------------------------------------------------------------------------------------------------------------------
+# synthetic constraints
+# ------------------------------------------------------------------------------------------------------------------
+
+def one_hot(n: int) -> Tuple[Vtree, PSddNode]:
+    """
+    Exactly one of `n` variables is true.
+    """
+    manager = builders.shape_manager((n,))
+    return manager.vtree, builders.exactly_one(manager, (n,))
+
+
+def at_most(n: int, k: int) -> Tuple[Vtree, PSddNode]:
+    """
+    At most `k` of `n` variables are true.
+    """
+    manager = builders.shape_manager((n,))
+    return manager.vtree, builders.at_most_k(manager, (n,), k)
+
+
+def grid(rows: int, columns: int) -> Tuple[Vtree, PSddNode]:
+    """
+    Exactly one variable is true in each row of a `rows x columns` grid.
+    """
+    manager = builders.shape_manager((rows, columns))
+    return manager.vtree, builders.exactly_one(manager, (rows, columns))
+
+
+CONSTRAINTS: Dict[str, List[Tuple[str, Callable[[], Tuple[Vtree, PSddNode]]]]] = {
+    "full": [
+        ("one_hot_16", lambda: one_hot(16)),
+        ("one_hot_128", lambda: one_hot(128)),
+        ("one_hot_1024", lambda: one_hot(1024)),
+        ("at_most_4_of_64", lambda: at_most(64, 4)),
+        ("at_most_16_of_256", lambda: at_most(256, 16)),
+        ("at_most_32_of_1024", lambda: at_most(1024, 32)),
+        ("grid_8x8", lambda: grid(8, 8)),
+        ("grid_32x32", lambda: grid(32, 32)),
+        ("grid_64x64", lambda: grid(64, 64)),
+    ],
+    "quick": [
+        ("one_hot_16", lambda: one_hot(16)),
+        ("at_most_4_of_64", lambda: at_most(64, 4)),
+        ("grid_8x8", lambda: grid(8, 8)),
+    ],
+}
+
+
+# ------------------------------------------------------------------------------------------------------------------
+# measurements
+# ------------------------------------------------------------------------------------------------------------------
+
+def median_time(fn: Callable[[], None], repeat: int) -> float:
+    """
+    Returns the median wall time in seconds of `repeat` calls of `fn`, after a warm-up call.
+    """
+    fn()
+    times = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        fn()
+        times.append(time.perf_counter() - start)
+    return statistics.median(times)
+
+
+def graph_size(tensor: torch.Tensor) -> int:
+    """
+    Returns the number of nodes of the autograd graph that computed `tensor`.
+    """
+    seen, stack = set(), [tensor.grad_fn]
+    while stack:
+        node = stack.pop()
+        if node is None or node in seen:
+            continue
+        seen.add(node)
+        stack.extend(child for child, _ in node.next_functions)
+    return len(seen)
+
+
+def peak_rss() -> int:
+    """
+    Returns the peak resident set size of the current process, in bytes.
+    """
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return peak if sys.platform == "darwin" else peak * 1024
+
+
+def measure_batch(sl: SemanticLoss, batch_size: int, repeat: int) -> Dict[str, float]:
+    """
+    Measures the forward and the forward and backward pass of `sl` on a batch of random logits.
+    """
+    baseline_rss = peak_rss()
+    logits = torch.randn(batch_size, sl.circuit.var_count, requires_grad=True)
+
+    def forward():
+        with torch.no_grad():
+            sl(logits=logits)
+
+    def forward_backward():
+        sl(logits=logits).backward()
+
+    result = {
+        "batch_size": batch_size,
+        "forward_seconds": median_time(forward, repeat),
+        "forward_backward_seconds": median_time(forward_backward, repeat),
+        "graph_size": graph_size(sl(logits=logits)),
+    }
+    result["baseline_rss_bytes"] = baseline_rss
+    result["peak_rss_bytes"] = peak_rss()
+    return result
+
+
+def _measure_batch_worker(queue, sl, batch_size, repeat):
+    queue.put(measure_batch(sl, batch_size, repeat))
+
+
+def measure_batch_isolated(sl: SemanticLoss, batch_size: int, repeat: int) -> Dict[str, float]:
+    """
+    Same as `measure_batch`, in a forked process when possible.
+    """
+    if "fork" not in multiprocessing.get_all_start_methods():
+        return measure_batch(sl, batch_size, repeat)
+
+    context = multiprocessing.get_context("fork")
+    queue = context.Queue()
+    process = context.Process(target=_measure_batch_worker, args=(queue, sl, batch_size, repeat))
+    process.start()
+    result = queue.get()
+    process.join()
+    return result
+
+
+def measure_constraint(
+    name: str, build: Callable[[], Tuple[Vtree, PSddNode]], batch_sizes: Sequence[int], repeat: int, **kwargs
+) -> Dict:
+    """
+    Writes the files of a constraint and measures loading, compiling and evaluating it.
+    """
+    with tempfile.TemporaryDirectory() as directory:
+        vtree, sdd = build()
+        vtree_file, sdd_file = os.path.join(directory, name + ".vtree"), os.path.join(directory, name + ".sdd")
+        vtree.save(vtree_file)
+        io.sdd_save(sdd, sdd_file)
+
+        import_seconds = median_time(lambda: SemanticLoss._import_psdd(sdd_file, vtree_file), repeat)
+        start = time.perf_counter()
+        sl = SemanticLoss(sdd_file, vtree_file, **kwargs)
+        build_seconds = time.perf_counter() - start
+
+    result = {
+        "name": name,
+        "var_count": sl.circuit.var_count,
+        "psdd_size": sl.psdd.size(),
+        "import_psdd_seconds": import_seconds,
+        "build_seconds": build_seconds,
+        "circuit": sl.circuit.size_report(),
+        "n_layers": sl.circuit.n_layers,
+        "batches": [],
+    }
+    for batch_size in batch_sizes:
+        result["batches"].append(measure_batch_isolated(sl, batch_size, repeat))
+        print(
+            "%-20s batch %5d  forward %9.3f ms  forward+backward %9.3f ms" % (
+                name,
+                batch_size,
+                1000 * result["batches"][-1]["forward_seconds"],
+                1000 * result["batches"][-1]["forward_backward_seconds"],
+            ),
+            flush=True,
+        )
+    return result
+
+
+def main(argv: Sequence[str] = None):
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--output", default="benchmark.json", help="JSON file the results are written to")
+    parser.add_argument("--batch-sizes", type=int, nargs="+", default=BATCH_SIZES, help="batch sizes to measure")
+    parser.add_argument("--repeat", type=int, default=5, help="timed repetitions of each measurement")
+    parser.add_argument("--quick", action="store_true", help="only measure the smallest constraints")
+    parser.add_argument("--log-space", action="store_true", help="evaluate the circuits in log-space")
+    parser.add_argument("--threads", type=int, default=None, help="number of torch threads")
+    args = parser.parse_args(argv)
+
+    if args.threads is not None:
+        torch.set_num_threads(args.threads)
+
+    results = {
+        "python": platform.python_version(),
+        "torch": torch.__version__,
+        "platform": platform.platform(),
+        "threads": torch.get_num_threads(),
+        "log_space": args.log_space,
+        "repeat": args.repeat,
+        "constraints": [
+            measure_constraint(name, build, args.batch_sizes, args.repeat, log_space=args.log_space)
+            for name, build in CONSTRAINTS["quick" if args.quick else "full"]
+        ],
+    }
+
+    with open(args.output, "w") as f:
+        json.dump(results, f, indent=2)
+    print("results written to %s" % args.output)
+
+
+if __name__ == "__main__":
+    main()
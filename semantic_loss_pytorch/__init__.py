@@ -1 +1,8 @@
-from semantic_loss_pytorch.semantic_loss import SemanticLoss
\ No newline at end of file
+from semantic_loss_pytorch.circuit import CompiledCircuit
+from semantic_loss_pytorch.semantic_loss import (
+    CircuitScorer,
+    MultiConstraintSemanticLoss,
+    ScriptableSemanticLoss,
+    SemanticLoss,
+    categorical_groups,
+)
@@ -0,0 +1,141 @@
+"""
+Builders of normalized SDDs for common families of constraints over the variables of a tensor,
+constructed directly on a `PSddManager` without going through `DIMACS` files and an external compiler.
+
+Variables are the elements of the tensor, numbered from 1 in row-major order as in `constraints_to_cnf`.
+All the constraints built on the same manager can be conjoined with `PSddManager.conjoin`:
+
+    manager = shape_manager((4, 3))
+    psdd = manager.conjoin(exactly_one(manager, (4, 3)), at_most_k(manager, (4, 3), 2, dim=0))
+    sl = SemanticLoss(psdd=psdd)
+"""
+import itertools
+from typing import Sequence, Tuple
+
+from semantic_loss_pytorch.py3psdd import PSddManager, PSddNode, Vtree
+from semantic_loss_pytorch.semantic_loss import categorical_groups
+
+
+def _balanced_vtree(items: Sequence) -> Vtree:
+    """
+    Returns a balanced vtree over `items`, each one being a variable or a sequence of variables forming a sub-vtree.
+    """
+    if len(items) == 1:
+        item = items[0]
+        return Vtree.leaf_node(item) if isinstance(item, int) else _balanced_vtree(list(item))
+    middle = len(items) // 2
+    return Vtree.internal_node(_balanced_vtree(items[:middle]), _balanced_vtree(items[middle:]))
+
+
+def shape_vtree(shape: Sequence[int], dim: int = -1) -> Vtree:
+    """
+    Returns a balanced vtree over the variables of a tensor with the given shape (without the batch dimension),
+    where the variables of each group along `dim` (see `categorical_groups`) are the variables of a vtree node.
+    Constraints over the groups are then compact, and the groups can be used as categorical groups.
+    """
+    groups = [[index + 1 for index in group] for group in categorical_groups(shape, dim=dim)]
+    root = _balanced_vtree(groups)
+    # ids follow the in-order traversal, as in `Vtree.read`
+    for node_id, node in enumerate(root):
+        node.id = node_id
+    return root
+
+
+def shape_manager(shape: Sequence[int], dim: int = -1) -> PSddManager:
+    """
+    Returns a manager over the vtree of `shape_vtree`, on which the constraints of this module are built.
+    """
+    return PSddManager(shape_vtree(shape, dim=dim))
+
+
+def _variable(shape: Sequence[int], index: Sequence[int]) -> int:
+    """
+    Returns the variable of the element of a tensor with the given shape at `index`.
+    """
+    return sum(i * stride for i, stride in zip(index, _strides(shape))) + 1
+
+
+def _strides(shape: Sequence[int]) -> Tuple[int, ...]:
+    strides = [1] * len(shape)
+    for i in range(len(shape) - 2, -1, -1):
+        strides[i] = strides[i + 1] * shape[i + 1]
+    return tuple(strides)
+
+
+def cardinality(manager: PSddManager, shape: Sequence[int], counts: Sequence[int], dim: int = -1) -> PSddNode:
+    """
+    Returns the SDD where the number of true variables of each group along `dim` is in `counts`.
+    """
+    groups = categorical_groups(shape, dim=dim)
+    return manager.conjoin(*[
+        manager.cardinality_sdd([index + 1 for index in group], counts) for group in groups
+    ])
+
+
+def exactly_k(manager: PSddManager, shape: Sequence[int], k: int, dim: int = -1) -> PSddNode:
+    """
+    Exactly `k` variables of each group along `dim` are true.
+    """
+    return cardinality(manager, shape, [k], dim=dim)
+
+
+def exactly_one(manager: PSddManager, shape: Sequence[int], dim: int = -1) -> PSddNode:
+    """
+    Exactly one variable of each group along `dim` is true, as in a one-hot encoding.
+    """
+    return exactly_k(manager, shape, 1, dim=dim)
+
+
+def at_most_k(manager: PSddManager, shape: Sequence[int], k: int, dim: int = -1) -> PSddNode:
+    """
+    At most `k` variables of each group along `dim` are true.
+    """
+    return cardinality(manager, shape, range(k + 1), dim=dim)
+
+
+def at_least_k(manager: PSddManager, shape: Sequence[int], k: int, dim: int = -1) -> PSddNode:
+    """
+    At least `k` variables of each group along `dim` are true.
+    """
+    return cardinality(manager, shape, range(k, shape[dim] + 1), dim=dim)
+
+
+def implications(
+    manager: PSddManager,
+    shape: Sequence[int],
+    pairs: Sequence[Tuple[Sequence[int], Sequence[int]]],
+    constraint: PSddNode = None,
+) -> PSddNode:
+    """
+    Returns the SDD where, for each `(antecedent, consequent)` pair of indices of the tensor, the variable
+    at `antecedent` implies the variable at `consequent`.
+
+    Implications between variables of different groups can make the SDD exponential in the size of the groups.
+    When they are meant to be conjoined with a constraint that already restricts the groups, such as
+    `exactly_one`, pass it as `constraint`: the implications are then conjoined to it one at a time, so that the
+    intermediate SDDs stay small.
+    """
+    clauses = [
+        manager.implication_sdd(_variable(shape, antecedent), _variable(shape, consequent))
+        for antecedent, consequent in pairs
+    ]
+    if constraint is None:
+        return manager.conjoin(*clauses)
+    for clause in clauses:
+        constraint = manager.conjoin(constraint, clause)
+    return constraint
+
+
+def neighbour_implications(
+    manager: PSddManager, shape: Sequence[int], dim: int = 0, constraint: PSddNode = None
+) -> PSddNode:
+    """
+    Each variable implies its next neighbour along `dim`: `x[..., i, ...]` implies `x[..., i + 1, ...]`.
+    See `implications` for `constraint`.
+    """
+    dim = dim % len(shape)
+    pairs = []
+    for index in itertools.product(*[range(size) for size in shape]):
+        if index[dim] + 1 < shape[dim]:
+            pairs.append((index, index[:dim] + (index[dim] + 1,) + index[dim + 1:]))
+    return implications(manager, shape, pairs, constraint=constraint)
@@ -0,0 +1,108 @@
+import contextlib
+import hashlib
+import os
+import tempfile
+from typing import Callable, Dict
+
+import numpy as np
+
+
+try:
+    import fcntl
+except ImportError:  # not available on Windows, concurrent writers are still safe thanks to the atomic rename
+    fcntl = None
+
+
+# bump when the layout of the cached arrays changes
+CACHE_VERSION = 2
+
+# size of the blocks used to hash the input files
+HASH_BLOCK_SIZE = 1 << 20
+
+
+def cache_key(*files: str, **options) -> str:
+    """
+    Returns a key identifying the content of the given files and the compilation options.
+
+    Args:
+        files: paths of the files the compiled circuit is built from
+        options: additional options that change the compiled circuit
+    """
+    digest = hashlib.sha256(b"semantic-loss-cache-%d" % CACHE_VERSION)
+    for filename in files:
+        file_digest = hashlib.sha256()
+        with open(filename, "rb") as f:
+            for block in iter(lambda: f.read(HASH_BLOCK_SIZE), b""):
+                file_digest.update(block)
+        digest.update(file_digest.digest())
+    for name in sorted(options):
+        digest.update(("%s=%r;" % (name, options[name])).encode())
+    return digest.hexdigest()
+
+
+@contextlib.contextmanager
+def _locked(lock_file: str):
+    """
+    Holds an exclusive lock on `lock_file`, so that processes starting at the same time
+    wait for the first one to fill the cache instead of all compiling the same circuit.
+    """
+    if fcntl is None:
+        yield
+        return
+
+    with open(lock_file, "a") as f:
+        fcntl.flock(f, fcntl.LOCK_EX)
+        try:
+            yield
+        finally:
+            fcntl.flock(f, fcntl.LOCK_UN)
+
+
+def load(cache_dir: str, key: str) -> Dict[str, np.ndarray]:
+    """
+    Returns the arrays stored under `key`, or None if they are not in the cache.
+    """
+    path = os.path.join(cache_dir, key + ".npz")
+    if not os.path.isfile(path):
+        return None
+    with np.load(path, allow_pickle=False) as data:
+        return {name: data[name] for name in data.files}
+
+
+def save(cache_dir: str, key: str, arrays: Dict[str, np.ndarray]):
+    """
+    Stores `arrays` under `key`. The file is written to a temporary name and atomically renamed,
+    so that readers never see a partially written file.
+    """
+    os.makedirs(cache_dir, exist_ok=True)
+    fd, tmp_path = tempfile.mkstemp(dir=cache_dir, prefix=key, suffix=".tmp")
+    try:
+        with os.fdopen(fd, "wb") as f:
+            np.savez(f, **arrays)
+        os.replace(tmp_path, os.path.join(cache_dir, key + ".npz"))
+    except BaseException:
+        os.remove(tmp_path)
+        raise
+
+
+def load_or_compile(cache_dir: str, key: str, compile_fn: Callable[[], Dict[str, np.ndarray]]) -> Dict[str, np.ndarray]:
+    """
+    Returns the arrays stored under `key`, calling `compile_fn` and storing its result if they are not cached yet.
+
+    Args:
+        cache_dir: directory of the cache, created if it does not exist
+        key: key of the arrays, see `cache_key`
+        compile_fn: function returning the arrays to cache
+    """
+    arrays = load(cache_dir, key)
+    if arrays is not None:
+        return arrays
+
+    os.makedirs(cache_dir, exist_ok=True)
+    with _locked(os.path.join(cache_dir, key + ".lock")):
+        # another process may have filled the cache while we were waiting for the lock
+        arrays = load(cache_dir, key)
+        if arrays is None:
+            arrays = compile_fn()
+            save(cache_dir, key, arrays)
+    return arrays
@@ -0,0 +1,1019 @@
+import itertools
+from typing import Dict, List, Optional, Sequence, Tuple, Union
+
+import numpy as np
+import torch
+from torch.autograd.function import once_differentiable
+
+from semantic_loss_pytorch import profiling
+from semantic_loss_pytorch.py3psdd.sdd import NormalizedSddNode
+
+
+class CompiledCircuit(torch.nn.Module):
+    """
+    Flat, level-scheduled tensor program computing the weighted model count of one or more normalized SDDs.
+
+    The nodes of the SDD are visited once, at construction time, in the topological order given by
+    `as_list()` and grouped by depth: leaves have depth 0 and every decomposition node sits one level
+    above its deepest child. All nodes of a level only depend on nodes of lower levels, so a level
+    can be evaluated with a constant number of batched tensor operations:
+        - one gather of the prime values and one of the sub values of all the elements of the level,
+        - one multiplication of the two gathers,
+        - one segment sum (`index_add_`) of the products into the nodes they belong to.
+
+    Node values live in a single `[n_nodes, batch]` buffer where nodes are numbered level by level.
+    Leaves are read from a literal table built from the literal weights:
+        - rows `[0, var_count)` contain the weights of the positive literals,
+        - rows `[var_count, 2 * var_count)` contain the weights of the negative literals,
+        - rows `[2 * var_count, 3 * var_count)` contain the value of a `true` node over a variable,
+          the sum of its positive and negative weights (that is 1 for probabilities),
+        - the last two rows contain the constants 1 and 0.
+
+    Elements with a `false` terminal as prime or sub are dropped during the compilation, as they
+    always contribute 0 to their node.
+
+    Several SDDs can be compiled in the same program: nodes shared by their circuits (as they are when
+    the SDDs come from the same manager) are evaluated once and the value of all the roots is returned.
+
+    The circuit can also be evaluated in log-space, taking log-weights as input: products become sums
+    and the segment sums become segment `logsumexp`s, so that the weighted model count of deep circuits
+    over many variables does not underflow in single or half precision.
+    """
+
+    def __init__(
+        self,
+        psdd: Union[NormalizedSddNode, Sequence[NormalizedSddNode]] = None,
+        arrays: Dict[str, np.ndarray] = None,
+    ):
+        """
+        Args:
+            psdd: normalized SDD to compile, or a sequence of SDDs to compile together
+            arrays: index arrays of an already compiled circuit, as returned by `to_arrays`
+        """
+        super().__init__()
+
+        if (psdd is None) == (arrays is None):
+            raise ValueError("Only psdd or arrays can be provided, neither both nor none")
+        if arrays is None:
+            arrays = self.linearize(psdd)
+
+        self.var_count = int(arrays["var_count"])
+        self.n_roots = len(arrays["roots"])
+        self.node_ptr: List[int] = [int(ptr) for ptr in arrays["node_ptr"]]
+        self.element_ptr: List[int] = [int(ptr) for ptr in arrays["element_ptr"]]
+        self.n_nodes = self.node_ptr[-1]
+        self.n_elements = self.element_ptr[-1]
+        # node and element counts before `simplify`, if the circuit was simplified
+        self.original_size: Optional[List[int]] = (
+            [int(size) for size in arrays["original_size"]] if "original_size" in arrays else None
+        )
+
+        for name in ("roots", "leaf_index", "element_prime", "element_sub", "element_target"):
+            self.register_buffer(name, torch.as_tensor(arrays[name], dtype=torch.long), persistent=False)
+
+    @staticmethod
+    def linearize(
+        psdd: Union[NormalizedSddNode, Sequence[NormalizedSddNode]], groups: Sequence[Sequence[int]] = None
+    ) -> Dict[str, np.ndarray]:
+        """
+        Compile one or more normalized SDDs to the index arrays of the tensor program.
+
+        Variables can be grouped into categorical variables, where exactly one variable of each group is true
+        and the positive weights of the variables of a group are the probabilities of its categories.
+        The variables of each group must be exactly the variables of a vtree node: the SDD nodes normalized for
+        that vtree node are replaced by the sum of the weights of the categories they are true for, and the
+        nodes below them are not compiled.
+
+        Args:
+            psdd: normalized SDD to compile, or a sequence of SDDs to compile together
+            groups: disjoint groups of variables forming categorical variables, as 0-based variable indices
+
+        Returns:
+            a dictionary of numpy arrays, see `to_arrays`
+        """
+        psdds = [psdd] if isinstance(psdd, NormalizedSddNode) else list(psdd)
+
+        # SDDs from different managers may have nodes with the same id, so nodes are identified by reference
+        nodes, seen = [], set()
+        for root in psdds:
+            for node in root.as_list(clear_data=False):
+                if node not in seen:
+                    seen.add(node)
+                    nodes.append(node)
+        var_count = max(max(root.vtree.variables()) for root in psdds)
+
+        group_vtrees, inner_vtrees = CompiledCircuit._group_vtrees(psdds, groups or [])
+        # for each variable of a group, the bit of its category in the masks below
+        category_bit = {var + 1: 1 << bit for group in groups or [] for bit, var in enumerate(group)}
+        # nodes inside a group are represented by the bit mask of the categories they are true for
+        truth = {}
+
+        # each node is either the row of the literal table of a leaf, or the list of its elements
+        graph, position = [], {}
+        for node in nodes:
+            if id(node.vtree) in inner_vtrees or id(node.vtree) in group_vtrees:
+                group = group_vtrees.get(id(node.vtree)) or inner_vtrees[id(node.vtree)]
+                all_categories = (1 << len(group)) - 1
+                if node.is_false():
+                    truth[node] = 0
+                elif node.is_true():
+                    truth[node] = all_categories
+                elif node.is_literal():
+                    bit = category_bit[abs(node.literal)]
+                    truth[node] = bit if node.literal > 0 else all_categories & ~bit
+                else:  # node.is_decomposition()
+                    truth[node] = 0
+                    for p, s in node.elements:
+                        truth[node] |= truth[p] & truth[s]
+
+                if id(node.vtree) in group_vtrees:
+                    categories = [var for bit, var in enumerate(group) if truth[node] >> bit & 1]
+                    if categories:
+                        graph.append(3 * var_count)
+                        one = len(graph) - 1
+                        graph.extend(categories)
+                        graph.append([(one + k, one) for k in range(1, len(categories) + 1)])
+                    else:
+                        graph.append(3 * var_count + 1)
+                    position[node] = len(graph) - 1
+                continue
+
+            if node.is_false():
+                graph.append(3 * var_count + 1)
+            elif node.is_true():
+                # true nodes of normalized SDDs are defined over a leaf of the vtree
+                if node.vtree is not None and node.vtree.is_leaf():
+                    graph.append(2 * var_count + node.vtree.var - 1)
+                else:
+                    graph.append(3 * var_count)
+            elif node.is_literal():
+                if node.literal > 0:
+                    graph.append(node.literal - 1)
+                else:
+                    graph.append(var_count - node.literal - 1)
+            else:  # node.is_decomposition()
+                graph.append([
+                    (position[p], position[s]) for p, s in node.elements if not (p.is_false() or s.is_false())
+                ])
+            position[node] = len(graph) - 1
+
+        return CompiledCircuit._schedule(var_count, graph, [position[root] for root in psdds])
+
+    @staticmethod
+    def _group_vtrees(
+        psdds: Sequence[NormalizedSddNode], groups: Sequence[Sequence[int]]
+    ) -> Tuple[Dict[int, Sequence[int]], Dict[int, Sequence[int]]]:
+        """
+        Find the vtree node over the variables of each categorical group, in the vtree of every SDD.
+
+        Returns:
+            two dictionaries mapping the `id` of a vtree node to its group, the first one for the vtree nodes
+            over exactly the variables of a group, the second one for the vtree nodes below them
+        """
+        grouped_variables = [var for group in groups for var in group]
+        if len(grouped_variables) != len(set(grouped_variables)):
+            raise ValueError("Categorical groups must be disjoint")
+
+        group_vtrees, inner_vtrees = {}, {}
+        for root in psdds:
+            variables = {}
+            for vtree in root.vtree.post_order():
+                if vtree.is_leaf():
+                    variables[vtree] = frozenset([vtree.var])
+                else:
+                    variables[vtree] = variables[vtree.left] | variables[vtree.right]
+            vtree_of_variables = {vars_: vtree for vtree, vars_ in variables.items()}
+
+            for group in groups:
+                vtree = vtree_of_variables.get(frozenset(var + 1 for var in group))
+                if vtree is None:
+                    raise ValueError(
+                        f"The variables of the categorical group {list(group)} are not the variables of a vtree node"
+                    )
+                group_vtrees[id(vtree)] = group
+                for inner in vtree.post_order():
+                    if inner is not vtree:
+                        inner_vtrees[id(inner)] = group
+        return group_vtrees, inner_vtrees
+
+    @staticmethod
+    def _schedule(
+        var_count: int, graph: List[Union[int, List[Tuple[int, int]]]], roots: List[int]
+    ) -> Dict[str, np.ndarray]:
+        """
+        Group the nodes of a circuit by depth and build the index arrays of the tensor program.
+
+        Args:
+            var_count: number of variables
+            graph: nodes in topological order, each one is either the row of the literal table of a leaf
+                or the list of the `(prime, sub)` pairs of its elements, as positions in `graph`
+            roots: positions of the roots in `graph`
+        """
+        # depth of every node, leaves have depth 0
+        depth = []
+        for node in graph:
+            if isinstance(node, list):
+                depth.append(1 + max((max(depth[p], depth[s]) for p, s in node), default=0))
+            else:
+                depth.append(0)
+
+        # renumber nodes level by level, keeping the topological order inside each level
+        order = sorted(range(len(graph)), key=lambda index: depth[index])
+        position = [0] * len(graph)
+        for new_index, index in enumerate(order):
+            position[index] = new_index
+        n_layers = depth[order[-1]] + 1
+
+        leaf_index = []
+        element_prime, element_sub, element_target = [], [], []
+        node_ptr, element_ptr = [0] * (n_layers + 1), [0] * (n_layers + 1)
+
+        for index in order:
+            node_ptr[depth[index] + 1] += 1
+            if isinstance(graph[index], list):
+                element_ptr[depth[index] + 1] += len(graph[index])
+
+        # cumulative offsets, nodes and elements of a layer are in [ptr[layer], ptr[layer + 1])
+        for layer in range(n_layers):
+            node_ptr[layer + 1] += node_ptr[layer]
+            element_ptr[layer + 1] += element_ptr[layer]
+
+        for index in order:
+            node = graph[index]
+            if isinstance(node, list):
+                target = position[index] - node_ptr[depth[index]]
+                for p, s in node:
+                    element_prime.append(position[p])
+                    element_sub.append(position[s])
+                    element_target.append(target)
+            else:
+                leaf_index.append(node)
+
+        return {
+            "var_count": np.array(var_count, dtype=np.int64),
+            "roots": np.array([position[root] for root in roots], dtype=np.int64),
+            "node_ptr": np.array(node_ptr, dtype=np.int64),
+            "element_ptr": np.array(element_ptr, dtype=np.int64),
+            "leaf_index": np.array(leaf_index, dtype=np.int64),
+            "element_prime": np.array(element_prime, dtype=np.int64),
+            "element_sub": np.array(element_sub, dtype=np.int64),
+            "element_target": np.array(element_target, dtype=np.int64),
+        }
+
+    @staticmethod
+    def simplify(arrays: Dict[str, np.ndarray], fold_true: bool = False) -> Dict[str, np.ndarray]:
+        """
+        Rewrite a compiled circuit into a smaller one computing the same function of the literal weights:
+            - elements with a factor that is constant 0 are dropped, and nodes left without elements become 0,
+            - constant 1 factors are folded, so that a node with a single element `(x, 1)` is replaced by `x`,
+              which collapses single-child sums and chains of trivial products,
+            - leaves reading the same row of the literal table, and nodes with the same elements, are merged,
+            - nodes no longer reachable from the roots are removed.
+        The node and element counts of the input are kept in the `original_size` array, see `size_report`.
+
+        Args:
+            arrays: index arrays of the circuit, as returned by `linearize` or `to_arrays`
+            fold_true: whether to replace `true` nodes over a variable with the constant 1. This is only exact when
+                the positive and negative weights of every variable sum to 1 (0 in log-space), as they do for the
+                probabilities of the semantic loss, and also removes the dependence of the circuit on those weights.
+
+        Returns:
+            the index arrays of the simplified circuit
+        """
+        var_count = int(arrays["var_count"])
+        one, zero = 3 * var_count, 3 * var_count + 1
+        node_ptr, element_ptr = arrays["node_ptr"], arrays["element_ptr"]
+        n_leaves = int(node_ptr[1])
+
+        # position of each node in the simplified graph, nodes are interned so that equal nodes are merged
+        graph, interned = [], {}
+        replacement = [0] * int(node_ptr[-1])
+
+        def intern(node):
+            key = node if isinstance(node, int) else tuple(node)
+            if key not in interned:
+                interned[key] = len(graph)
+                graph.append(node)
+            return interned[key]
+
+        for index, row in enumerate(arrays["leaf_index"].tolist()):
+            if fold_true and 2 * var_count <= row < 3 * var_count:
+                row = one
+            replacement[index] = intern(row)
+
+        elements = [[] for _ in range(int(node_ptr[-1]) - n_leaves)]
+        for layer in range(1, len(node_ptr) - 1):
+            first, last = int(element_ptr[layer]), int(element_ptr[layer + 1])
+            for p, s, target in zip(
+                arrays["element_prime"][first:last].tolist(),
+                arrays["element_sub"][first:last].tolist(),
+                arrays["element_target"][first:last].tolist(),
+            ):
+                elements[int(node_ptr[layer]) + target - n_leaves].append((p, s))
+
+        # nodes are numbered level by level, so children are always simplified before their parents
+        for index, node_elements in enumerate(elements, start=n_leaves):
+            node = []
+            for p, s in node_elements:
+                p, s = replacement[p], replacement[s]
+                if graph[p] == zero or graph[s] == zero:
+                    continue
+                # constant factors go second, and products are commutative
+                p, s = (s, p) if graph[p] == one or (graph[s] != one and s < p) else (p, s)
+                node.append((p, s))
+
+            if not node:
+                replacement[index] = intern(zero)
+            elif len(node) == 1 and graph[node[0][1]] == one:
+                replacement[index] = node[0][0]
+            else:
+                replacement[index] = intern(sorted(node))
+
+        # keep only the nodes reachable from the roots, graph is in topological order
+        roots = [replacement[root] for root in arrays["roots"].tolist()]
+        reachable = [False] * len(graph)
+        for root in roots:
+            reachable[root] = True
+        for index in range(len(graph) - 1, -1, -1):
+            if reachable[index] and isinstance(graph[index], list):
+                for p, s in graph[index]:
+                    reachable[p] = reachable[s] = True
+
+        position = list(itertools.accumulate(int(r) for r in reachable))
+        pruned = [
+            node if isinstance(node, int) else [(position[p] - 1, position[s] - 1) for p, s in node]
+            for node, keep in zip(graph, reachable) if keep
+        ]
+
+        simplified = CompiledCircuit._schedule(var_count, pruned, [position[root] - 1 for root in roots])
+        simplified["original_size"] = arrays.get(
+            "original_size", np.array([node_ptr[-1], element_ptr[-1]], dtype=np.int64)
+        )
+        return simplified
+
+    def to_arrays(self) -> Dict[str, np.ndarray]:
+        """
+        Returns the circuit as a dictionary of numpy arrays, that can be stored with `numpy.savez` and
+        used to build the same circuit again with `CompiledCircuit(arrays=...)`:
+            - `var_count`: number of variables,
+            - `roots`: index of the root nodes,
+            - `node_ptr`, `element_ptr`: offsets of the nodes and of the elements of each layer,
+            - `leaf_index`: row of the literal table of each leaf,
+            - `element_prime`, `element_sub`: index of the prime and of the sub of each element,
+            - `element_target`: index of the node of each element, relative to the first node of its layer,
+            - `original_size`: only for simplified circuits, node and element counts before `simplify`.
+        """
+        arrays = {
+            "var_count": np.array(self.var_count, dtype=np.int64),
+            "node_ptr": np.array(self.node_ptr, dtype=np.int64),
+            "element_ptr": np.array(self.element_ptr, dtype=np.int64),
+        }
+        for name in ("roots", "leaf_index", "element_prime", "element_sub", "element_target"):
+            arrays[name] = getattr(self, name).cpu().numpy()
+        if self.original_size is not None:
+            arrays["original_size"] = np.array(self.original_size, dtype=np.int64)
+        return arrays
+
+    def size_report(self) -> Dict[str, int]:
+        """
+        Returns the number of nodes and elements of the circuit, and the ones it had before `simplify`
+        (the same, if the circuit was not simplified).
+        """
+        nodes_before, elements_before = self.original_size or (self.n_nodes, self.n_elements)
+        return {
+            "nodes_before": nodes_before,
+            "elements_before": elements_before,
+            "nodes_after": self.n_nodes,
+            "elements_after": self.n_elements,
+        }
+
+    @property
+    def n_layers(self) -> int:
+        return len(self.node_ptr) - 1
+
+    def memory_per_sample(self, dtype: torch.dtype = torch.float) -> int:
+        """
+        Estimate the peak memory, in bytes, used by each sample of the batch in a forward and backward pass:
+        the literal table, the node-value and node-gradient buffers, and the gathers of the widest layer.
+        """
+        max_layer_elements = max(
+            (self.element_ptr[layer + 1] - self.element_ptr[layer] for layer in range(self.n_layers)), default=0
+        )
+        rows = 3 * self.var_count + 2 + 2 * self.n_nodes + 5 * max_layer_elements
+        return rows * torch.empty((), dtype=dtype).element_size()
+
+    def chunk_size(self, max_memory: int, dtype: torch.dtype = torch.float) -> int:
+        """
+        Returns the largest number of samples that can be evaluated at once within `max_memory` bytes.
+        """
+        return max(1, max_memory // self.memory_per_sample(dtype))
+
+    def literal_table(self, positive: torch.Tensor, negative: torch.Tensor, log_space: bool = False) -> torch.Tensor:
+        """
+        Stack the literal weights in the `[3 * var_count + 2, batch]` table the leaves are gathered from.
+
+        Args:
+            positive: weights of the positive literals, with shape `[batch, n_vars]`, `n_vars >= var_count`
+            negative: weights of the negative literals, with the same shape of `positive`
+            log_space: whether the weights are log-weights
+
+        Returns:
+            the literal table, see the class documentation for the meaning of each row
+        """
+        if positive.size(-1) < self.var_count or negative.size(-1) < self.var_count:
+            raise ValueError(
+                f"The circuit is defined over {self.var_count} variables, "
+                f"got literal weights for {positive.size(-1)} variables"
+            )
+
+        positive = positive[:, :self.var_count].t()
+        negative = negative[:, :self.var_count].t()
+        if log_space:
+            true = torch.logaddexp(positive, negative)
+            constants = torch.stack([torch.zeros_like(positive[0]), torch.full_like(positive[0], -float("inf"))])
+        else:
+            true = positive + negative
+            constants = torch.stack([torch.ones_like(positive[0]), torch.zeros_like(positive[0])])
+        return torch.cat([positive, negative, true, constants], dim=0)
+
+    @staticmethod
+    def _segment_logsumexp(values: torch.Tensor, index: torch.Tensor, size: int) -> torch.Tensor:
+        """
+        Compute the `logsumexp` of the rows of `values` that share the same `index`.
+        Segments without rows, or where all rows are `-inf`, evaluate to `-inf` and receive no gradient.
+        """
+        maxima = values.new_full((size, values.size(1)), -float("inf")).scatter_reduce_(
+            0, index.unsqueeze(1).expand_as(values), values.detach(), "amax"
+        )
+        maxima = torch.where(torch.isfinite(maxima), maxima, torch.zeros_like(maxima))
+
+        sums = values.new_zeros(size, values.size(1)).index_add_(0, index, torch.exp(values - maxima[index]))
+        positive = sums > 0
+        sums = torch.where(positive, sums, torch.ones_like(sums))
+        return torch.where(positive, torch.log(sums) + maxima, torch.full_like(sums, -float("inf")))
+
+    def upward(self, table: torch.Tensor, log_space: bool = False) -> torch.Tensor:
+        """
+        Evaluate all the nodes of the circuit, bottom-up, with plain tensor operations.
+        The operations are recorded by autograd when gradients are enabled.
+
+        Args:
+            table: literal table, see `literal_table`
+            log_space: whether the table contains log-weights
+
+        Returns:
+            the `[n_nodes, batch]` buffer with the value of every node
+        """
+        values = table.new_empty(self.n_nodes, table.size(1))
+        values[:self.node_ptr[1]] = table.index_select(0, self.leaf_index)
+
+        for layer in range(1, self.n_layers):
+            first_node, last_node = self.node_ptr[layer], self.node_ptr[layer + 1]
+            first, last = self.element_ptr[layer], self.element_ptr[layer + 1]
+
+            primes = values.index_select(0, self.element_prime[first:last])
+            subs = values.index_select(0, self.element_sub[first:last])
+            target = self.element_target[first:last]
+
+            if log_space:
+                values[first_node:last_node] = self._segment_logsumexp(primes + subs, target, last_node - first_node)
+            else:
+                products = primes * subs
+                values[first_node:last_node] = products.new_zeros(last_node - first_node, products.size(1)).index_add_(
+                    0, target, products
+                )
+
+        return values
+
+    @staticmethod
+    def _safe_log(x: torch.Tensor) -> torch.Tensor:
+        """
+        Returns `log(x)`, with no gradient (instead of a NaN one) where `x` is 0.
+        """
+        positive = x > 0
+        return torch.where(positive, torch.log(torch.where(positive, x, torch.ones_like(x))), torch.log(x.detach()))
+
+    @staticmethod
+    def _entropy_terms(log_weights: torch.Tensor, log_totals: torch.Tensor) -> torch.Tensor:
+        """
+        Returns `-p * log(p)` for `p = weights / totals`, and 0 where `p` is 0, without producing NaN gradients.
+        """
+        valid = torch.isfinite(log_weights)
+        zeros = torch.zeros_like(log_weights)
+        log_probabilities = torch.where(valid, log_weights, zeros) - torch.where(valid, log_totals, zeros)
+        return torch.where(valid, -torch.exp(log_probabilities) * log_probabilities, zeros)
+
+    @staticmethod
+    def bernoulli_entropy(positive: torch.Tensor, negative: torch.Tensor, log_space: bool = False) -> torch.Tensor:
+        """
+        Returns the entropy (in nats) of independent variables with the given literal weights, element-wise.
+        """
+        if log_space:
+            true = torch.logaddexp(positive, negative)
+        else:
+            true = CompiledCircuit._safe_log(positive + negative)
+            positive, negative = CompiledCircuit._safe_log(positive), CompiledCircuit._safe_log(negative)
+        return CompiledCircuit._entropy_terms(positive, true) + CompiledCircuit._entropy_terms(negative, true)
+
+    def upward_entropy(self, table: torch.Tensor, log_space: bool = False) -> Tuple[torch.Tensor, torch.Tensor]:
+        """
+        Evaluate, bottom-up, the value of every node and the entropy of the distribution it induces on its models,
+        in the same walk over the circuit. As nodes are deterministic and decomposable, the entropy of a node is
+        `sum_e share_e * (H(prime_e) + H(sub_e) - log(share_e))`, where `share_e` is the fraction of the value of
+        the node given by element `e`, while the entropy of a `true` node over a variable is the one of a
+        Bernoulli variable and the one of the other leaves is 0.
+        The operations are recorded by autograd when gradients are enabled.
+
+        Args:
+            table: literal table, see `literal_table`
+            log_space: whether the table contains log-weights
+
+        Returns:
+            the `[n_nodes, batch]` buffers with the value and with the entropy (in nats) of every node
+        """
+        var_count = self.var_count
+        zeros = torch.zeros_like(table[:2 * var_count])
+        bernoulli = self.bernoulli_entropy(table[:var_count], table[var_count:2 * var_count], log_space=log_space)
+        entropy_table = torch.cat([zeros, bernoulli, zeros[:2]])
+
+        values = table.new_empty(self.n_nodes, table.size(1))
+        entropies = table.new_empty(self.n_nodes, table.size(1))
+        values[:self.node_ptr[1]] = table.index_select(0, self.leaf_index)
+        entropies[:self.node_ptr[1]] = entropy_table.index_select(0, self.leaf_index)
+
+        for layer in range(1, self.n_layers):
+            first_node, last_node = self.node_ptr[layer], self.node_ptr[layer + 1]
+            first, last = self.element_ptr[layer], self.element_ptr[layer + 1]
+
+            prime_index, sub_index = self.element_prime[first:last], self.element_sub[first:last]
+            primes, subs = values.index_select(0, prime_index), values.index_select(0, sub_index)
+            target = self.element_target[first:last]
+
+            # elements with no models have share 0, guarded so that no NaN reaches the gradients
+            if log_space:
+                scores = primes + subs
+                nodes = self._segment_logsumexp(scores, target, last_node - first_node)
+                valid = torch.isfinite(scores)
+                log_shares = torch.where(valid, scores, torch.zeros_like(scores)) - torch.where(
+                    valid, nodes[target], torch.zeros_like(scores)
+                )
+            else:
+                scores = primes * subs
+                nodes = scores.new_zeros(last_node - first_node, scores.size(1)).index_add_(0, target, scores)
+                valid = scores > 0
+                ones = torch.ones_like(scores)
+                log_shares = torch.log(torch.where(valid, scores, ones) / torch.where(valid, nodes[target], ones))
+
+            children = entropies.index_select(0, prime_index) + entropies.index_select(0, sub_index)
+            shares = torch.where(valid, torch.exp(log_shares), torch.zeros_like(log_shares))
+            contributions = shares * children + torch.where(
+                valid, -shares * log_shares, torch.zeros_like(log_shares)
+            )
+
+            values[first_node:last_node] = nodes
+            entropies[first_node:last_node] = contributions.new_zeros(
+                last_node - first_node, contributions.size(1)
+            ).index_add_(0, target, contributions)
+
+        return values, entropies
+
+    def wmc_and_entropy(
+        self, positive: torch.Tensor, negative: torch.Tensor, log_space: bool = False
+    ) -> Tuple[torch.Tensor, torch.Tensor]:
+        """
+        Compute the weighted model count of the circuit and the entropy of the distribution induced by the literal
+        weights on its models for each sample in the batch, with a single walk over the circuit, see
+        `upward_entropy`. Unlike `forward`, gradients are computed by autograd over the whole walk.
+
+        Args:
+            positive: weights of the positive literals, with shape `[batch, n_vars]`
+            negative: weights of the negative literals, with shape `[batch, n_vars]`
+            log_space: whether weights are log-weights, in which case the logarithm of the weighted model
+                count is returned
+
+        Returns:
+            the weighted model count (or its logarithm) and the entropy of each root and sample,
+            both with shape `[batch, n_roots]`
+        """
+        table = self.literal_table(positive, negative, log_space=log_space)
+        values, entropies = self.upward_entropy(table, log_space=log_space)
+        return values.index_select(0, self.roots).t(), entropies.index_select(0, self.roots).t()
+
+    def downward(self, values: torch.Tensor, root_grad: torch.Tensor, log_space: bool = False) -> torch.Tensor:
+        """
+        Propagate the gradient of the roots to all the nodes of the circuit with a single top-down sweep.
+        This is the same context accumulation done by `PSddNode.marginals`, where the context of a node is
+        the derivative of the root with respect to the node: every element adds to its prime the context of
+        its node times the value of its sub, and vice versa. In log-space, the contribution of an element is
+        weighted by its share of the node, `exp(prime + sub - node)`.
+
+        Args:
+            values: `[n_nodes, batch]` buffer returned by `upward`
+            root_grad: gradient of the root values, with shape `[batch, n_roots]`
+            log_space: whether `values` contains log-weights
+
+        Returns:
+            the `[n_nodes, batch]` buffer with the gradient of every node
+        """
+        grads = torch.zeros_like(values)
+        grads.index_add_(0, self.roots, root_grad.t())
+
+        for layer in range(self.n_layers - 1, 0, -1):
+            first, last = self.element_ptr[layer], self.element_ptr[layer + 1]
+
+            prime_index = self.element_prime[first:last]
+            sub_index = self.element_sub[first:last]
+            node_index = self.element_target[first:last] + self.node_ptr[layer]
+
+            primes = values.index_select(0, prime_index)
+            subs = values.index_select(0, sub_index)
+            context = grads.index_select(0, node_index)
+
+            if log_space:
+                nodes = values.index_select(0, node_index)
+                share = torch.exp(primes + subs - nodes)
+                context = torch.where(torch.isfinite(nodes), context * share, torch.zeros_like(context))
+                grads.index_add_(0, prime_index, context)
+                grads.index_add_(0, sub_index, context)
+            else:
+                grads.index_add_(0, prime_index, context * subs)
+                grads.index_add_(0, sub_index, context * primes)
+
+        return grads
+
+    def forward(self, positive: torch.Tensor, negative: torch.Tensor, log_space: bool = False) -> torch.Tensor:
+        """
+        Compute the weighted model count of the circuit for each sample in the batch.
+        Gradients are computed by a single top-down sweep over the circuit (see `downward`), so autograd
+        only records a constant number of operations, whatever the size of the circuit.
+
+        Args:
+            positive: weights of the positive literals, with shape `[batch, n_vars]`
+            negative: weights of the negative literals, with shape `[batch, n_vars]`
+            log_space: whether weights are log-weights, in which case the logarithm of the weighted model
+                count is returned
+
+        Returns:
+            the weighted model count (or its logarithm) of each root and sample, with shape `[batch, n_roots]`
+        """
+        table = self.literal_table(positive, negative, log_space=log_space)
+
+        # autograd functions cannot be scripted, TorchScript records the operations of the upward pass
+        if not torch.jit.is_scripting() and torch.is_grad_enabled() and table.requires_grad:
+            return _CircuitFunction.apply(table, self, log_space)
+        return self.upward(table, log_space=log_space).index_select(0, self.roots).t()
+
+    def marginals(
+        self, positive: torch.Tensor, negative: torch.Tensor, log_space: bool = False, root: int = 0
+    ) -> torch.Tensor:
+        """
+        Compute, for each sample, the probability of each variable being true in the distribution induced by the
+        literal weights on the models of a root: the derivative of the logarithm of its weighted model count with
+        respect to the log-weight of the positive literal of the variable.
+        The derivative is computed by autograd over `upward`, so that all the marginals are obtained with a single
+        upward and a single downward sweep over the circuit. When the weights require gradients, the marginals can
+        be differentiated as well.
+
+        Args:
+            positive: weights of the positive literals, with shape `[batch, n_vars]`
+            negative: weights of the negative literals, with shape `[batch, n_vars]`
+            log_space: whether weights are log-weights
+            root: index of the root whose models are considered
+
+        Returns:
+            the marginal probability of each variable, with shape `[batch, var_count]`
+        """
+        positive = positive[:, :self.var_count]
+        negative = negative[:, :self.var_count]
+        create_graph = torch.is_grad_enabled() and (positive.requires_grad or negative.requires_grad)
+
+        with torch.enable_grad():
+            if not positive.requires_grad:
+                positive = positive.detach().requires_grad_()
+            table = self.literal_table(positive, negative, log_space=log_space)
+            wmc = self.upward(table, log_space=log_space)[self.roots[root]]
+            if not log_space:
+                wmc = torch.log(wmc)
+            grad, = torch.autograd.grad(wmc.sum(), positive, create_graph=create_graph)
+
+        marginals = grad if log_space else positive * grad
+        return marginals if create_graph else marginals.detach()
+
+    def max_table(self, positive: torch.Tensor, negative: torch.Tensor, log_space: bool = False) -> torch.Tensor:
+        """
+        Stack the literal log-weights in the literal table of the max-product semiring, where the value of a `true`
+        node over a variable is the largest between its positive and negative log-weights, see `literal_table`.
+        """
+        if not log_space:
+            positive, negative = torch.log(positive), torch.log(negative)
+        table = self.literal_table(positive, negative, log_space=True)
+        var_count = self.var_count
+        positive, negative = table[:var_count], table[var_count:2 * var_count]
+        return torch.cat([positive, negative, torch.maximum(positive, negative), table[3 * var_count:]])
+
+    def _segment_argmax(self, scores: torch.Tensor, layer: int) -> Tuple[torch.Tensor, torch.Tensor]:
+        """
+        Returns the largest of the `[n_elements, batch]` scores of the elements of a layer for each of its nodes,
+        and the index of the element achieving it (the last one in case of ties).
+        """
+        first, last = self.element_ptr[layer], self.element_ptr[layer + 1]
+        size = self.node_ptr[layer + 1] - self.node_ptr[layer]
+        target = self.element_target[first:last].unsqueeze(1).expand_as(scores)
+
+        maxima = scores.new_full((size, scores.size(1)), -float("inf")).scatter_reduce_(0, target, scores, "amax")
+        elements = torch.arange(first, last, device=scores.device).unsqueeze(1).expand_as(scores)
+        best = torch.where(scores == maxima.gather(0, target), elements, torch.full_like(elements, -1))
+        return maxima, torch.full_like(maxima, -1, dtype=torch.long).scatter_reduce_(0, target, best, "amax")
+
+    def _follow(self, active: torch.Tensor, layer: int, choice: torch.Tensor):
+        """
+        Mark as active the prime and the sub of the chosen element of the active nodes of a layer.
+
+        Args:
+            active: `[n_nodes, batch]` mask of the active nodes, updated in place
+            layer: index of the layer
+            choice: `[n_layer_nodes, batch]` index of the chosen element of each node of the layer
+        """
+        first, last = self.element_ptr[layer], self.element_ptr[layer + 1]
+        target = self.element_target[first:last]
+
+        elements = torch.arange(first, last, device=choice.device).unsqueeze(1)
+        selected = active.index_select(0, target + self.node_ptr[layer]) & (choice.index_select(0, target) == elements)
+        active.index_add_(0, self.element_prime[first:last], selected)
+        active.index_add_(0, self.element_sub[first:last], selected)
+
+    def _assignment(self, active: torch.Tensor, true_positive: torch.Tensor) -> torch.Tensor:
+        """
+        Read the assignments from the active leaves: positive literals set their variable, negative literals leave
+        it to 0 and `true` nodes over a variable set it to the value given by `true_positive`.
+
+        Args:
+            active: `[n_nodes, batch]` mask of the active nodes
+            true_positive: `[n_leaves, batch]` mask of the leaves that set their variable when they are `true` nodes
+
+        Returns:
+            the `[batch, var_count]` 0/1 tensor of the assignments
+        """
+        var_count = self.var_count
+        variable = self.leaf_index % var_count
+        is_true = (self.leaf_index >= 2 * var_count) & (self.leaf_index < 3 * var_count)
+        leaf_value = (self.leaf_index < var_count).unsqueeze(1) | is_true.unsqueeze(1) & true_positive
+
+        assignment = torch.zeros(var_count, active.size(1), dtype=torch.bool, device=active.device)
+        assignment.index_add_(0, variable, active[:self.node_ptr[1]] & leaf_value)
+        return assignment.long().t()
+
+    def max_upward(self, table: torch.Tensor) -> Tuple[torch.Tensor, torch.Tensor]:
+        """
+        Evaluate all the nodes of the circuit, bottom-up, in the max-sum semiring: the value of a node is the
+        largest log-weight of its elements, and the element achieving it is stored for the top-down decoding.
+
+        Args:
+            table: literal table of log-weights, see `max_table`
+
+        Returns:
+            the `[n_nodes, batch]` buffer with the value of every node, and the `[n_nodes, batch]` buffer with
+            the index of the best element of every decomposition node (unused for leaves)
+        """
+        values = table.new_empty(self.n_nodes, table.size(1))
+        values[:self.node_ptr[1]] = table.index_select(0, self.leaf_index)
+        choices = torch.zeros(self.n_nodes, table.size(1), dtype=torch.long, device=table.device)
+
+        for layer in range(1, self.n_layers):
+            first_node, last_node = self.node_ptr[layer], self.node_ptr[layer + 1]
+            first, last = self.element_ptr[layer], self.element_ptr[layer + 1]
+
+            scores = values.index_select(0, self.element_prime[first:last]) + values.index_select(
+                0, self.element_sub[first:last]
+            )
+            values[first_node:last_node], choices[first_node:last_node] = self._segment_argmax(scores, layer)
+
+        return values, choices
+
+    def decode(self, choices: torch.Tensor, root: int = 0) -> torch.Tensor:
+        """
+        Follow the best element of every node from a root, top-down, and return the `[n_nodes, batch]` mask of
+        the nodes in the sub-circuit of the best assignment of each sample.
+
+        Args:
+            choices: best element of every node, as returned by `max_upward`
+            root: index of the root to decode
+        """
+        active = torch.zeros_like(choices, dtype=torch.bool)
+        active[self.roots[root]] = True
+
+        for layer in range(self.n_layers - 1, 0, -1):
+            self._follow(active, layer, choices[self.node_ptr[layer]:self.node_ptr[layer + 1]])
+
+        return active
+
+    def mpe(
+        self, positive: torch.Tensor, negative: torch.Tensor, log_space: bool = False, root: int = 0
+    ) -> Tuple[torch.Tensor, torch.Tensor]:
+        """
+        Compute, for each sample, the most probable assignment of the variables that is a model of a root,
+        with one max-sum upward pass and one top-down decoding pass over the circuit.
+
+        Args:
+            positive: weights of the positive literals, with shape `[batch, n_vars]`
+            negative: weights of the negative literals, with shape `[batch, n_vars]`
+            log_space: whether weights are log-weights
+            root: index of the root whose models are considered
+
+        Returns:
+            the `[batch, var_count]` 0/1 tensor of the best assignments, and the `[batch]` tensor of their
+            log-weights, that is `-inf` for samples without models
+        """
+        with torch.no_grad():
+            table = self.max_table(positive, negative, log_space=log_space)
+            values, choices = self.max_upward(table)
+            active = self.decode(choices, root=root)
+
+            # `true` nodes take the literal with the largest weight
+            variable = self.leaf_index % self.var_count
+            true_positive = table.index_select(0, variable) == table.index_select(0, variable + 2 * self.var_count)
+
+        return self._assignment(active, true_positive), values[self.roots[root]]
+
+    def sample(
+        self,
+        positive: torch.Tensor,
+        negative: torch.Tensor,
+        n_samples: int = 1,
+        log_space: bool = False,
+        root: int = 0,
+        generator: torch.Generator = None,
+    ) -> torch.Tensor:
+        """
+        Draw exact samples of the models of a root from the distribution induced by the literal weights,
+        `n_samples` for each row of the batch. After one upward pass computing the weighted model count of every
+        node, all the samples are drawn together top-down: every active node picks one of its elements with
+        probability proportional to its weight, by taking the largest score perturbed with Gumbel noise.
+
+        Args:
+            positive: weights of the positive literals, with shape `[batch, n_vars]`
+            negative: weights of the negative literals, with shape `[batch, n_vars]`
+            n_samples: number of samples drawn for each row of the batch
+            log_space: whether weights are log-weights
+            root: index of the root whose models are sampled
+            generator: random number generator used to draw the samples
+
+        Returns:
+            the `[batch, n_samples, var_count]` 0/1 tensor of the samples, which is meaningless for rows
+            without models
+        """
+        with torch.no_grad():
+            if not log_space:
+                positive, negative = torch.log(positive), torch.log(negative)
+            table = self.literal_table(positive, negative, log_space=True)
+            values = self.upward(table, log_space=True)
+            batch = table.size(1)
+
+            active = torch.zeros(self.n_nodes, batch * n_samples, dtype=torch.bool, device=table.device)
+            active[self.roots[root]] = True
+
+            for layer in range(self.n_layers - 1, 0, -1):
+                first, last = self.element_ptr[layer], self.element_ptr[layer + 1]
+                scores = values.index_select(0, self.element_prime[first:last]) + values.index_select(
+                    0, self.element_sub[first:last]
+                )
+                # Gumbel-max trick, with -log(E) for E ~ Exp(1) as Gumbel noise
+                noise = scores.new_empty(last - first, batch * n_samples).exponential_(generator=generator)
+                scores = scores.repeat_interleave(n_samples, dim=1) - torch.log(noise)
+                self._follow(active, layer, self._segment_argmax(scores, layer)[1])
+
+            # `true` nodes take the positive literal with probability positive / (positive + negative)
+            variable = self.leaf_index % self.var_count
+            probability = torch.exp(
+                table.index_select(0, variable) - table.index_select(0, variable + 2 * self.var_count)
+            )
+            uniform = table.new_empty(len(variable), batch * n_samples).uniform_(generator=generator)
+            true_positive = uniform < probability.repeat_interleave(n_samples, dim=1)
+
+        return self._assignment(active, true_positive).reshape(batch, n_samples, self.var_count)
+
+    def top_k(
+        self, positive: torch.Tensor, negative: torch.Tensor, k: int, log_space: bool = False, root: int = 0
+    ) -> Tuple[torch.Tensor, torch.Tensor]:
+        """
+        Compute, for each sample, the `k` most probable assignments of the variables that are models of a root.
+
+        Every node keeps the `k` best scores of its sub-circuit as a `[k, batch]` slice, together with the element
+        and the ranks of the prime and sub scores they come from. The `k` best scores of an element are the
+        `topk` of the outer sum of the scores of its prime and sub, and the ones of a node are the `topk` of the
+        scores of its elements, which are contiguous in the layer. The assignments are then decoded top-down
+        following these back-pointers, for all the `batch * k` assignments at once.
+
+        Args:
+            positive: weights of the positive literals, with shape `[batch, n_vars]`
+            negative: weights of the negative literals, with shape `[batch, n_vars]`
+            k: number of assignments returned for each sample
+            log_space: whether weights are log-weights
+            root: index of the root whose models are considered
+
+        Returns:
+            the `[batch, k, var_count]` 0/1 tensor of the best assignments, sorted by decreasing probability,
+            and the `[batch, k]` tensor of their log-weights. When a sample has less than `k` models, the
+            remaining assignments are meaningless and their log-weight is `-inf`.
+        """
+        with torch.no_grad():
+            table = self.max_table(positive, negative, log_space=log_space)
+            batch, var_count = table.size(1), self.var_count
+            device = table.device
+
+            # the second best score of a leaf is the other literal of a `true` node
+            ranked_table = table.new_full((table.size(0), k, batch), -float("inf"))
+            ranked_table[:, 0] = table
+            if k > 1:
+                ranked_table[2 * var_count:3 * var_count, 1] = torch.minimum(
+                    table[:var_count], table[var_count:2 * var_count]
+                )
+
+            values = table.new_empty(self.n_nodes, k, batch)
+            values[:self.node_ptr[1]] = ranked_table.index_select(0, self.leaf_index)
+            # chosen element of each node and rank, and rank of the prime times k plus the rank of the sub
+            choices = torch.zeros(self.n_nodes, k, batch, dtype=torch.long, device=device)
+            pairs = torch.zeros(self.n_nodes, k, batch, dtype=torch.long, device=device)
+
+            for layer in range(1, self.n_layers):
+                first_node, last_node = self.node_ptr[layer], self.node_ptr[layer + 1]
+                first, last = self.element_ptr[layer], self.element_ptr[layer + 1]
+                target = self.element_target[first:last]
+
+                primes = values.index_select(0, self.element_prime[first:last])
+                subs = values.index_select(0, self.element_sub[first:last])
+                scores, pair = (primes.unsqueeze(2) + subs.unsqueeze(1)).flatten(1, 2).topk(k, dim=1)
+
+                # scatter the candidates of each node in a padded `[n_layer_nodes, max_elements * k, batch]` tensor
+                counts = torch.bincount(target, minlength=last_node - first_node)
+                starts = torch.cumsum(counts, dim=0) - counts
+                slot = torch.arange(last - first, device=device) - starts[target]
+                max_elements = int(counts.max())
+                candidates = scores.new_full((last_node - first_node, max_elements * k, batch), -float("inf"))
+                candidates.view(last_node - first_node, max_elements, k, batch)[target, slot] = scores
+
+                values[first_node:last_node], best = candidates.topk(k, dim=1)
+                element = torch.minimum(
+                    starts.view(-1, 1, 1) + best // k, (starts + counts - 1).view(-1, 1, 1)
+                )
+                choices[first_node:last_node] = element + first
+                pairs[first_node:last_node] = pair.view(-1, batch).gather(
+                    0, (element * k + best % k).view(-1, batch)
+                ).view_as(best)
+
+            # decode the j-th assignment of each sample from the j-th best score of the root
+            n_assignments = batch * k
+            column = torch.arange(n_assignments, device=device)
+            ranks = torch.full((self.n_nodes, n_assignments), -1, dtype=torch.long, device=device)
+            ranks[self.roots[root]] = column % k
+
+            for layer in range(self.n_layers - 1, 0, -1):
+                first_node, last_node = self.node_ptr[layer], self.node_ptr[layer + 1]
+                rank = ranks[first_node:last_node]
+                active = rank >= 0
+                index = (rank.clamp(min=0) * batch + column // k)
+
+                element = choices[first_node:last_node].view(-1, k * batch).gather(1, index)
+                pair = pairs[first_node:last_node].view(-1, k * batch).gather(1, index)
+                minus_one = torch.full_like(pair, -1)
+                ranks.scatter_reduce_(
+                    0, self.element_prime[element], torch.where(active, pair // k, minus_one), "amax"
+                )
+                ranks.scatter_reduce_(0, self.element_sub[element], torch.where(active, pair % k, minus_one), "amax")
+
+            # the best literal of a `true` node has rank 0, the other one rank 1
+            variable = self.leaf_index % var_count
+            best_positive = table.index_select(0, variable) == table.index_select(0, variable + 2 * var_count)
+            leaf_ranks = ranks[:self.node_ptr[1]]
+            true_positive = (leaf_ranks == 0) == best_positive.repeat_interleave(k, dim=1)
+            assignments = self._assignment(leaf_ranks >= 0, true_positive)
+
+        return assignments.view(batch, k, var_count), values[self.roots[root]].t()
+
+
+class _CircuitFunction(torch.autograd.Function):
+    """
+    Evaluates a `CompiledCircuit` keeping only the node-value buffer for the analytic backward pass.
+    """
+
+    @staticmethod
+    def forward(ctx, table: torch.Tensor, circuit: CompiledCircuit, log_space: bool) -> torch.Tensor:
+        values = circuit.upward(table, log_space=log_space)
+        ctx.circuit = circuit
+        ctx.log_space = log_space
+        ctx.save_for_backward(values)
+        return values.index_select(0, circuit.roots).t()
+
+    @staticmethod
+    @once_differentiable
+    def backward(ctx, grad_output: torch.Tensor):
+        values, = ctx.saved_tensors
+        circuit = ctx.circuit
+
+        with profiling.timed("circuit.backward"):
+            grads = circuit.downward(values, grad_output, log_space=ctx.log_space)
+            leaves = grads[:circuit.node_ptr[1]]
+            table_grad = leaves.new_zeros(3 * circuit.var_count + 2, leaves.size(1)).index_add_(
+                0, circuit.leaf_index, leaves
+            )
+        return table_grad, None, None
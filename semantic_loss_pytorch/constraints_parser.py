@@ -0,0 +1,305 @@
+"""
+Parser of the constraint language of `constraints_to_cnf`, without sympy.
+
+Constraints are written with the operators documented in the README, with the precedence and associativity
+they have in Python (and therefore in sympy), from the tightest:
+    ~          negation
+    >> <<      implication, left associative
+    &          and
+    ^          xor
+    |          or
+and with the functions `And`, `Or`, `Not`, `Xor`, `Nand`, `Nor`, `Implies`, `Equivalent` and `ITE`, and the
+constants `True` and `False`. Variables are written `X<i>.<j>...` or `X.<i>.<j>...` over the shape of the file.
+The cardinality functions `ExactlyOne(...)`, `AtMostK(k, ...)` and `AtLeastK(k, ...)` are true when exactly one,
+at most `k` and at least `k` of their arguments are true, where `k` is a non-negative integer.
+
+Constraints are parsed into a compact AST:
+    - a non-zero int is a literal over the variables of the shape reshaped as a vector, numbered from 1 as in
+      DIMACS: `v` is the variable and `-v` its negation,
+    - `True` and `False` are the constants,
+    - a tuple `(operator, *arguments)` is an operator of `OPERATORS` applied to AST arguments. The operator of the
+      cardinality functions is a pair `(cardinality, k)`, where cardinality is one of `CARDINALITIES`, and
+      `ExactlyOne` is the cardinality `exactly` with `k = 1`.
+The tokenizer is a single regular expression and the parser an operator-precedence (shunting-yard) parser with
+explicit stacks, so that long constraints do not hit the recursion limit.
+"""
+import re as regex
+
+import numpy as np
+
+
+OPERATORS = ("and", "or", "not", "xor", "nand", "nor", "implies", "equivalent", "ite")
+CARDINALITIES = ("exactly", "atmost", "atleast")
+
+# name -> (operator, minimum number of arguments, maximum number of arguments)
+FUNCTIONS = {
+    "And": ("and", 0, None),
+    "Or": ("or", 0, None),
+    "Not": ("not", 1, 1),
+    "Xor": ("xor", 0, None),
+    "Nand": ("nand", 0, None),
+    "Nor": ("nor", 0, None),
+    "Implies": ("implies", 2, 2),
+    "Equivalent": ("equivalent", 0, None),
+    "ITE": ("ite", 3, 3),
+    "ExactlyOne": (("exactly", 1), 0, None),
+}
+
+# name -> cardinality of the functions whose first argument is the integer k
+CARDINALITY_FUNCTIONS = {"AtMostK": "atmost", "AtLeastK": "atleast"}
+
+# binary operator -> precedence
+BINARY = {">>": 4, "<<": 4, "&": 3, "^": 2, "|": 1}
+BINARY_OR_NOT = set(BINARY) | {"~"}
+
+_TOKEN = regex.compile(
+    r"\s*(?:(X\.?[0-9]+(?:\.[0-9]+)*)|([0-9]+)|(>>|<<|[&|^~(),])|([A-Za-z_][A-Za-z_0-9]*)|(\S))"
+)
+
+# frame of a parenthesis on the operator stack:
+# (marker, function name or None, operator of the function, number of operands before it)
+_PAREN = "("
+
+
+def tokenize(constraint):
+    """
+    Returns the tokens of a constraint as `(kind, text)` pairs, where kind is 'var', 'int', 'op' or 'name'.
+    """
+    tokens = []
+    for variable, integer, operator, name, invalid in _TOKEN.findall(constraint):
+        if invalid:
+            raise ValueError("Unexpected character '%s' in constraint '%s'" % (invalid, constraint))
+        if variable:
+            tokens.append(("var", variable))
+        elif integer:
+            tokens.append(("int", integer))
+        elif operator:
+            tokens.append(("op", operator))
+        elif name:
+            tokens.append(("name", name))
+    return tokens
+
+
+def negate(node):
+    """
+    Returns the negation of an AST, simplifying double negations.
+    """
+    if isinstance(node, bool):
+        return not node
+    if isinstance(node, int):
+        return -node
+    if node[0] == "not":
+        return node[1]
+    return "not", node
+
+
+def apply(operator, arguments):
+    """
+    Returns the AST of an operator applied to arguments. Nested `and`, `or` and `xor` are flattened,
+    as sympy does, and negations of literals become negative literals.
+    """
+    if operator == "not":
+        return negate(arguments[0])
+    if operator in ("and", "or", "xor"):
+        flat = []
+        for argument in arguments:
+            if isinstance(argument, tuple) and argument[0] == operator:
+                flat.extend(argument[1:])
+            else:
+                flat.append(argument)
+        arguments = flat
+    return (operator,) + tuple(arguments)
+
+
+class ConstraintsParser:
+    """
+    Parser of constraints over the variables of a tensor with the given shape, see the module documentation.
+    """
+
+    def __init__(self, shape):
+        self.shape = [int(dim) for dim in shape]
+        self.stride = np.array(list(np.cumprod(np.array((self.shape + [1])[::-1])))[::-1][1:])
+        self.total_vars = int(np.prod(self.shape))
+        self._variables = {}
+
+    def variable(self, token):
+        """
+        Returns the 1-based index of a variable token, as if the variables were reshaped as a vector.
+        """
+        if token in self._variables:
+            return self._variables[token]
+
+        items = [int(item) for item in token[1:].lstrip(".").split(".")]
+        if len(items) != len(self.shape):
+            raise ValueError(
+                "Number of indexes in %s is not the same as the number of dimensions specified in shape '%s'" % (
+                    token, self.shape
+                )
+            )
+        for number, (index_in_this_dim, dim) in enumerate(zip(items, self.shape)):
+            if index_in_this_dim >= dim:
+                raise ValueError("Index number %s '%s' in var '%s' should be < %s, given the shape %s" % (
+                    number, index_in_this_dim, token, dim, self.shape))
+
+        variable = int(np.dot(self.stride, items)) + 1
+        self._variables[token] = variable
+        return variable
+
+    def parse(self, constraint):
+        """
+        Returns the AST of a constraint.
+        """
+        tokens = tokenize(constraint)
+        operands, operators = [], []
+        expect_operand = True
+
+        def reduce():
+            operator = operators.pop()
+            if operator == "~":
+                operands.append(negate(operands.pop()))
+                return
+            right, left = operands.pop(), operands.pop()
+            if operator == ">>":
+                operands.append(apply("implies", [left, right]))
+            elif operator == "<<":
+                operands.append(apply("implies", [right, left]))
+            else:
+                operands.append(apply({"&": "and", "|": "or", "^": "xor"}[operator], [left, right]))
+
+        def error(message):
+            return ValueError("%s in constraint '%s'" % (message, constraint))
+
+        skip = 0
+        for position, (kind, text) in enumerate(tokens):
+            if skip:
+                skip -= 1
+                continue
+
+            if kind == "var" or (kind == "name" and text in ("True", "False")):
+                if not expect_operand:
+                    raise error("Unexpected '%s'" % text)
+                operands.append(self.variable(text) if kind == "var" else text == "True")
+                expect_operand = False
+
+            elif kind == "name":
+                if text not in FUNCTIONS and text not in CARDINALITY_FUNCTIONS:
+                    raise error("Unknown function '%s'" % text)
+                if not expect_operand or position + 1 == len(tokens) or tokens[position + 1][1] != "(":
+                    raise error("Function '%s' must be called" % text)
+                if text in FUNCTIONS:
+                    operators.append(text)
+                    continue
+
+                # the parenthesis and k are consumed here, the arguments follow a ','
+                if position + 2 == len(tokens) or tokens[position + 2][0] != "int":
+                    raise error("The first argument of '%s' must be an integer" % text)
+                operator = (CARDINALITY_FUNCTIONS[text], int(tokens[position + 2][1]))
+                operators.append((_PAREN, text, operator, len(operands)))
+                expect_operand = False
+                skip = 2
+
+            elif text == "~":
+                if not expect_operand:
+                    raise error("Unexpected '~'")
+                operators.append("~")
+
+            elif text in BINARY:
+                if expect_operand:
+                    raise error("Unexpected '%s'" % text)
+                precedence = BINARY[text]
+                while operators and operators[-1] in BINARY_OR_NOT and (
+                    operators[-1] == "~" or BINARY[operators[-1]] >= precedence
+                ):
+                    reduce()
+                operators.append(text)
+                expect_operand = True
+
+            elif text == "(":
+                if not expect_operand:
+                    raise error("Unexpected '('")
+                name = operators.pop() if operators and operators[-1] in FUNCTIONS else None
+                operators.append((_PAREN, name, FUNCTIONS[name][0] if name else None, len(operands)))
+
+            elif text in (",", ")"):
+                if expect_operand:
+                    # only the closing parenthesis of a call without arguments can follow an opening one
+                    frame = operators[-1] if operators else None
+                    empty_call = isinstance(frame, tuple) and frame[1] is not None and tokens[position - 1][1] == "("
+                    if text == "," or not empty_call:
+                        raise error("Unexpected '%s'" % text)
+                while operators and not isinstance(operators[-1], tuple):
+                    reduce()
+                if not operators:
+                    raise error("Unbalanced '%s'" % text)
+                frame = operators[-1]
+                if text == ",":
+                    if frame[1] is None:
+                        raise error("Unexpected ','")
+                    expect_operand = True
+                    continue
+
+                operators.pop()
+                _, name, operator, first = frame
+                arguments = operands[first:]
+                if name is not None:
+                    _, minimum, maximum = FUNCTIONS.get(name, (operator, 0, None))
+                    if len(arguments) < minimum or (maximum is not None and len(arguments) > maximum):
+                        raise error("Wrong number of arguments of '%s'" % name)
+                    del operands[first:]
+                    operands.append(apply(operator, arguments))
+                expect_operand = False
+
+            else:
+                raise error("Unexpected '%s'" % text)
+
+        if expect_operand:
+            raise error("Unexpected end")
+        while operators:
+            if isinstance(operators[-1], tuple):
+                raise error("Unbalanced '('")
+            reduce()
+        return operands[0]
+
+    def parse_all(self, constraints):
+        """
+        Returns the ASTs of a list of constraints.
+        """
+        return [self.parse(constraint) for constraint in constraints]
+
+
+def has_cardinality(node):
+    """
+    Returns whether an AST contains cardinality functions.
+    """
+    return any(isinstance(current, tuple) and isinstance(current[0], tuple) for current in post_order(node))
+
+
+def post_order(node):
+    """
+    Generator of the nodes of an AST, children before their parent, with an explicit stack.
+    """
+    stack = [(node, False)]
+    while stack:
+        node, expanded = stack.pop()
+        if expanded or not isinstance(node, tuple):
+            yield node
+            continue
+        stack.append((node, True))
+        stack.extend((argument, False) for argument in reversed(node[1:]))
+
+
+def fold(node, leaf, operator):
+    """
+    Evaluates an AST bottom-up without recursion: `leaf(node)` is called on literals and constants, and
+    `operator(name, values)` on operators, with the values of their arguments.
+    """
+    values = []
+    for current in post_order(node):
+        if isinstance(current, tuple):
+            n_arguments = len(current) - 1
+            arguments = values[len(values) - n_arguments:] if n_arguments else []
+            del values[len(values) - n_arguments:]
+            values.append(operator(current[0], arguments))
+        else:
+            values.append(leaf(current))
+    return values[0]
@@ -1,13 +1,19 @@
 import argparse
 import ast
+import os
 import re as regex
+import shutil
 import sys
+import tempfile
+from functools import partial
 
 import numpy as np
 import sympy
 from sympy import to_cnf
 from sympy.parsing.sympy_parser import parse_expr
 
+from semantic_loss_pytorch import constraints_parser
+
 
 """
 have to be splitting sympy parsing in multiple jobs because it can become very slow
@@ -16,6 +22,190 @@ after a certain length of the string to parse, also it can lead to a stack overf
 from multiprocessing import Pool
 
 
+ENCODINGS = ("cnf", "tseitin")
+PARSERS = ("native", "sympy")
+
+# number of clauses written at once to DIMACS files
+DIMACS_CHUNK_SIZE = 1 << 16
+# number of constraints converted to cnf at once by a process
+CONSTRAINTS_CHUNK_SIZE = 1 << 10
+
+_SYMPY_OPERATORS = {
+    "not": sympy.Not,
+    "and": sympy.And,
+    "or": sympy.Or,
+    "xor": sympy.Xor,
+    "nand": sympy.Nand,
+    "nor": sympy.Nor,
+    "implies": sympy.Implies,
+    "equivalent": sympy.Equivalent,
+    "ite": sympy.ITE,
+}
+_SYMPY_OPERATORS_INVERSE = [(cls, name) for name, cls in _SYMPY_OPERATORS.items()]
+
+
+class _TseitinEncoder:
+    """
+    Tseitin encoding of constraints, as ASTs of `constraints_parser`, as clauses of integer literals.
+    Every sub-formula that is not a literal is replaced by an auxiliary variable, defined by the clauses of its
+    equivalence with the sub-formula, so that the number of clauses is linear in the size of the constraints.
+    Auxiliary variables are fully defined by the variables of the constraints, so every model of the constraints
+    extends to exactly one model of the clauses. They are numbered after the `total_vars` variables of the shape,
+    and identical sub-formulas share the same auxiliary variable.
+    """
+
+    def __init__(self, total_vars):
+        self.total_vars = int(total_vars)
+        self.n_vars = int(total_vars)
+        self.clauses = []
+        self._literals = {}
+
+    @property
+    def n_aux(self):
+        return self.n_vars - self.total_vars
+
+    def _new_var(self):
+        self.n_vars += 1
+        return self.n_vars
+
+    def add(self, node):
+        """
+        Add the clauses asserting the constraint. Conjunctions, disjunctions and implications at the top
+        level are asserted directly, without auxiliary variables for themselves.
+        """
+        stack = [node]
+        while stack:
+            node = stack.pop()
+            if node is True:
+                continue
+            operator = node[0] if isinstance(node, tuple) else None
+            if operator == "and":
+                stack.extend(reversed(node[1:]))
+            elif operator == "or":
+                self.clauses.append([self.literal(argument) for argument in node[1:]])
+            elif operator == "implies":
+                self.clauses.append([-self.literal(node[1]), self.literal(node[2])])
+            else:
+                self.clauses.append([self.literal(node)])
+
+    def literal(self, node):
+        """
+        Return the literal equivalent to the constraint, adding the clauses defining its auxiliary variables.
+        """
+        return constraints_parser.fold(node, self._leaf, self._operator)
+
+    def _leaf(self, node):
+        if isinstance(node, bool):
+            if True not in self._literals:
+                self._literals[True] = self._new_var()
+                self.clauses.append([self._literals[True]])
+            return self._literals[True] if node else -self._literals[True]
+        return node
+
+    def _operator(self, operator, literals):
+        key = (operator, tuple(literals))
+        if key in self._literals:
+            return self._literals[key]
+
+        if isinstance(operator, tuple):
+            literal = self._cardinality(*operator, literals)
+        elif operator == "not":
+            literal = -literals[0]
+        elif operator == "and":
+            literal = self._and(literals)
+        elif operator == "or":
+            literal = -self._and([-literal for literal in literals])
+        elif operator == "nand":
+            literal = -self._and(literals)
+        elif operator == "nor":
+            literal = self._and([-literal for literal in literals])
+        elif operator == "implies":
+            literal = -self._and([literals[0], -literals[1]])
+        elif operator == "xor":
+            literal = literals[0] if literals else self._leaf(False)
+            for other in literals[1:]:
+                literal = self._xor(literal, other)
+        elif operator == "equivalent":
+            # all the arguments are equal, pairwise between consecutive ones
+            pairs = [-self._xor(a, b) for a, b in zip(literals, literals[1:])]
+            literal = self._and(pairs) if pairs else self._leaf(True)
+        elif operator == "ite":
+            literal = self._ite(*literals)
+        else:
+            raise ValueError("Operator '%s' is not supported by the Tseitin encoding" % operator)
+
+        self._literals[key] = literal
+        return literal
+
+    def _cardinality(self, cardinality, k, literals):
+        """
+        Return the literal of a cardinality constraint, with a sequential counter of the true literals.
+        """
+        at_least = self._counter(literals, k if cardinality == "atleast" else k + 1)
+
+        def at_least_literal(j):
+            # at least j of the literals are true
+            if j == 0:
+                return self._leaf(True)
+            return at_least[j - 1] if j <= len(at_least) else self._leaf(False)
+
+        if cardinality == "atleast":
+            return at_least_literal(k)
+        if cardinality == "atmost":
+            return -at_least_literal(k + 1)
+        return self._and([at_least_literal(k), -at_least_literal(k + 1)])
+
+    def _counter(self, literals, bound):
+        """
+        Sequential counter: return the literals true when at least 1, 2, ..., bound of the literals are true,
+        truncated to the number of literals. Each of them after the i-th literal is defined as: at least j after
+        the previous literals, or at least j - 1 after the previous literals and the i-th literal, so that the
+        number of auxiliary variables and clauses is O(len(literals) * bound).
+        """
+        at_least = []
+        for literal in literals:
+            previous, at_least = at_least, []
+            for j in range(min(len(previous) + 1, bound)):
+                # None stands for false for before, and for true (at least 0) for carry
+                before = previous[j] if j < len(previous) else None
+                carry = previous[j - 1] if j > 0 else None
+                if before is None and carry is None:
+                    at_least.append(literal)
+                elif before is None:
+                    at_least.append(self._and([carry, literal]))
+                elif carry is None:
+                    at_least.append(-self._and([-before, -literal]))
+                else:
+                    at_least.append(self._or_and(before, carry, literal))
+        return at_least
+
+    def _or_and(self, a, b, c):
+        aux = self._new_var()
+        self.clauses.extend([[aux, -a], [aux, -b, -c], [-aux, a, b], [-aux, a, c]])
+        return aux
+
+    def _and(self, literals):
+        aux = self._new_var()
+        self.clauses.extend([-aux, literal] for literal in literals)
+        self.clauses.append([aux] + [-literal for literal in literals])
+        return aux
+
+    def _xor(self, a, b):
+        aux = self._new_var()
+        self.clauses.extend([[-aux, a, b], [-aux, -a, -b], [aux, -a, b], [aux, a, -b]])
+        return aux
+
+    def _ite(self, condition, then, otherwise):
+        aux = self._new_var()
+        self.clauses.extend([
+            [-aux, -condition, then],
+            [-aux, condition, otherwise],
+            [aux, -condition, -then],
+            [aux, condition, -otherwise],
+        ])
+        return aux
+
+
 class ConstraintsToCnf:
     """
     Class with only a public and static method to go from a file specifying constraints in
@@ -30,7 +220,7 @@ class ConstraintsToCnf:
     """
 
     @classmethod
-    def expression_to_cnf(cls, constraint_file, output_file, nprocesses=1):
+    def expression_to_cnf(cls, constraint_file, output_file, nprocesses=1, encoding="cnf", parser="native"):
         """
         Given an input file specifying logical constraints with sympy syntax, one line
         after another, where each constraint is considered to be on an "and" relationship
@@ -72,10 +262,23 @@ class ConstraintsToCnf:
         something like variables.reshape(-1).
             This scripts takes into account the input shape to properly rename variables and rewrite the constraints
             specified in the input file as a DIMACS CNF file.
-        :param nprocesses: Number of processes to use during the parsing from string to simpy a sympy expression.
-            An higher number of processes might be needed because sympy seems to have some problems
+        :param nprocesses: Number of processes to use during the parsing of the constraints, and during their
+            conversion to cnf with the 'cnf' encoding, where each constraint is converted on its own. With the
+            sympy parser, an higher number of processes might be needed because sympy seems to have some problems
             after the length of a string to parse gets past an arbitrary threshold.
+        :param encoding: 'cnf' to convert the constraints to an equivalent CNF with sympy's to_cnf, which can be
+            exponential in the size of the constraints, or 'tseitin' to introduce an auxiliary variable for each
+            sub-formula and write an equisatisfiable CNF of linear size. Auxiliary variables are numbered after
+            the variables of the shape, their range is recorded in the header of the DIMACS file, and they are
+            fully defined by the other variables, so the number of models does not change.
+        :param parser: 'native' to parse the constraints with `constraints_parser`, in time linear in their length
+            and without recursion, or 'sympy' to parse them with sympy's parse_expr, which is slow on long
+            constraints and accepts any sympy expression.
         """
+        if encoding not in ENCODINGS:
+            raise ValueError("encoding must be one of %s, got '%s'" % (ENCODINGS, encoding))
+        if parser not in PARSERS:
+            raise ValueError("parser must be one of %s, got '%s'" % (PARSERS, parser))
 
         # parse data, get shape (list of ints) and constraints (list of strings)
         shape, constraints = ConstraintsToCnf._read_data(constraint_file)
@@ -105,23 +308,245 @@ class ConstraintsToCnf:
             We will 'and' each constraint, starting from a base constraint of 'true'
         """
 
+        if encoding == "cnf":
+            # every constraint is an independent conjunct, so it is converted to cnf on its own in the processes
+            print("converting to cnf and writing to DIMACS")
+            encoder = _TseitinEncoder(total_vars)
+            clauses = ConstraintsToCnf._constraints_to_clauses_multiprocess(
+                constraints, shape, nprocesses, encoder, parser
+            )
+            # the auxiliary variables are only known once all the clauses have been written
+            ConstraintsToCnf._clauses_to_dimacs(
+                shape, total_vars, clauses, lambda: encoder.n_aux, constraint_file, output_file,
+                "the cardinality functions"
+            )
+            return
+
+        if parser == "native":
+            constraints_asts = ConstraintsToCnf._parse_constraints_native(constraints, shape, nprocesses)
+        else:
+            if nprocesses == 1:
+                constraints_expression = ConstraintsToCnf._parse_constraints_monoprocess(constraints)
+            else:
+                constraints_expression = ConstraintsToCnf._parse_constraints_multiprocess(constraints, nprocesses)
+
+            # check variables for correctness (shape wise and name/format)
+            for var in constraints_expression.atoms():
+                if not var.is_Boolean:
+                    ConstraintsToCnf._assert_is_valid_variable(str(var), shape, stride, total_vars)
+            constraints_asts = [ConstraintsToCnf._sympy_to_ast(constraints_expression, stride)]
+
+        print("converting to cnf with the tseitin encoding")
+        encoder = _TseitinEncoder(total_vars)
+        for constraint_ast in constraints_asts:
+            encoder.add(constraint_ast)
+
+        print("writing to DIMACS")
+        ConstraintsToCnf._clauses_to_dimacs(
+            shape, total_vars, encoder.clauses, encoder.n_aux, constraint_file, output_file
+        )
+
+    @staticmethod
+    def _parse_constraints_native(constraints, shape, nprocesses=1):
+        """
+        Function that parses a list of string into ASTs of `constraints_parser`, by using multiple processes
+        if nprocesses > 1.
+        :param constraints: Constraints as a list of strings.
+        :param shape: Shape in which we consider our variables to be.
+        :param nprocesses: Number of processes to use.
+        :return: The list of the ASTs of the constraints.
+        """
+        parser = constraints_parser.ConstraintsParser(shape)
+        if nprocesses == 1:
+            return parser.parse_all(constraints)
+
+        with Pool(processes=nprocesses) as pool:
+            multiple_results = [pool.apply_async(parser.parse_all, [chunk]) for chunk in
+                                ConstraintsToCnf._chunks(constraints, nprocesses)]
+            return [constraint for res in multiple_results for constraint in res.get()]
+
+    @staticmethod
+    def _constraints_to_clauses(constraints, shape):
+        """
+        Function that parses a list of string and converts each constraint to cnf on its own.
+        :param constraints: Constraints as a list of strings.
+        :param shape: Shape in which we consider our variables to be.
+        :return: The clauses of the cnfs, as lists of integer literals, without duplicates among these constraints,
+            and the ASTs of the constraints with cardinality functions, which are not converted.
+        """
+        parser = constraints_parser.ConstraintsParser(shape)
+        symbols, indexes = {}, {}
+        clauses, cardinality_asts, seen = [], [], set()
+        for constraint in constraints:
+            constraint_ast = parser.parse(constraint)
+            if constraints_parser.has_cardinality(constraint_ast):
+                cardinality_asts.append(constraint_ast)
+                continue
+            expression = ConstraintsToCnf._ast_to_sympy([constraint_ast], shape, symbols)
+            for clause in ConstraintsToCnf._cnf_to_clauses(to_cnf(expression), parser.stride, indexes):
+                key = frozenset(clause)
+                if key not in seen:
+                    seen.add(key)
+                    clauses.append(clause)
+        return clauses, cardinality_asts
+
+    @staticmethod
+    def _sympy_constraints_to_clauses(constraints, shape):
+        """
+        Function that parses a list of string with sympy and converts each constraint to cnf on its own.
+        :param constraints: Constraints as a list of strings.
+        :param shape: Shape in which we consider our variables to be.
+        :return: The clauses of the cnfs, as lists of integer literals, without duplicates among these constraints,
+            and no ASTs, since sympy does not parse cardinality functions.
+        """
+        stride = constraints_parser.ConstraintsParser(shape).stride
+        total_vars = np.prod(shape)
+        indexes = {}
+        clauses, seen = [], set()
+        for constraint in constraints:
+            expression = ConstraintsToCnf._parse_constraints_monoprocess([constraint])
+            for var in expression.atoms():
+                if not var.is_Boolean:
+                    ConstraintsToCnf._assert_is_valid_variable(str(var), shape, stride, total_vars)
+            for clause in ConstraintsToCnf._cnf_to_clauses(to_cnf(expression), stride, indexes):
+                key = frozenset(clause)
+                if key not in seen:
+                    seen.add(key)
+                    clauses.append(clause)
+        return clauses, []
+
+    @staticmethod
+    def _constraints_to_clauses_multiprocess(constraints, shape, nprocesses, encoder, parser="native"):
+        """
+        Generator that converts a list of string to clauses, each process converting chunks of
+        CONSTRAINTS_CHUNK_SIZE constraints and returning their clauses as lists of integer literals, which are
+        yielded as soon as the chunk is converted.
+        Duplicated clauses are only removed within each chunk, so that nothing grows with the number of clauses
+        already yielded: a clause repeated in different chunks is written more than once, which does not change the
+        models of the cnf.
+        :param constraints: Constraints as a list of strings.
+        :param shape: Shape in which we consider our variables to be.
+        :param nprocesses: Number of processes to use.
+        :param encoder: _TseitinEncoder of the constraints with cardinality functions, which share the numbering of
+            its auxiliary variables. Their clauses are yielded after the ones of the chunk they are in.
+        :param parser: Refer to expression_to_cnf.
+        :return: Generator of the clauses of the cnf of the "and" of all the constraints, or the clause [True] alone
+            if there are none.
+        """
+        chunks = (constraints[start:start + CONSTRAINTS_CHUNK_SIZE]
+                  for start in range(0, len(constraints), CONSTRAINTS_CHUNK_SIZE))
+        if parser == "native":
+            to_clauses = partial(ConstraintsToCnf._constraints_to_clauses, shape=shape)
+        else:
+            to_clauses = partial(ConstraintsToCnf._sympy_constraints_to_clauses, shape=shape)
+
+        def all_clauses(chunks_results):
+            empty = True
+            for chunk_clauses, cardinality_asts in chunks_results:
+                for constraint_ast in cardinality_asts:
+                    encoder.add(constraint_ast)
+                # the clauses of the encoder are handed over, only the numbering of its auxiliary variables is kept
+                chunk_clauses, encoder.clauses = chunk_clauses + encoder.clauses, []
+                empty = empty and not chunk_clauses
+                yield from chunk_clauses
+
+            # the cnf of the whole conjunction is then True, written as sympy writes it
+            if empty:
+                yield [True]
+
         if nprocesses == 1:
-            constraints_expression = ConstraintsToCnf._parse_constraints_monoprocess(constraints)
+            yield from all_clauses(map(to_clauses, chunks))
         else:
-            constraints_expression = ConstraintsToCnf._parse_constraints_multiprocess(constraints, nprocesses)
+            # imap keeps the order of the constraints, and hands the results over as the chunks are converted
+            with Pool(processes=nprocesses) as pool:
+                yield from all_clauses(pool.imap(to_clauses, chunks))
+
+    @staticmethod
+    def _cnf_to_clauses(cnf, stride, indexes):
+        """
+        Function that walks a sympy cnf expression into clauses of integer literals, as if the variables were
+        reshaped as a single vector, numbered from 1 as in DIMACS.
+        :param cnf: Sympy boolean expression, expected to be a cnf.
+        :param stride: Numpy array specifying the stride over each dimension.
+        :param indexes: Dict from the sympy symbols to their index, used as a cache and updated.
+        :return: The clauses, as lists of integer literals, with the clause [False] if the cnf is False.
+        """
+        if cnf is sympy.true:
+            return []
+        if cnf is sympy.false:
+            return [[False]]
+
+        clauses = []
+        for clause in (cnf.args if isinstance(cnf, sympy.And) else (cnf,)):
+            literals = []
+            for literal in (clause.args if isinstance(clause, sympy.Or) else (clause,)):
+                negated = isinstance(literal, sympy.Not)
+                symbol = literal.args[0] if negated else literal
+                if symbol not in indexes:
+                    items = list(map(lambda x: int(x), regex.findall(r"[0-9]+", str(symbol))))
+                    indexes[symbol] = int(ConstraintsToCnf._get_index(np.array(items), stride)) + 1
+                literals.append(-indexes[symbol] if negated else indexes[symbol])
+            clauses.append(literals)
+        return clauses
 
-        # check variables for correctness (shape wise and name/format)
-        for var in constraints_expression.atoms():
-            if not var.is_Boolean:
-                ConstraintsToCnf._assert_is_valid_variable(str(var), shape, stride, total_vars)
+    @staticmethod
+    def _chunks(a, n):
+        """
+        Split a list in n chunks of almost the same length.
+        """
+        k, m = divmod(len(a), n)
+        return (a[i * k + min(i, m):(i + 1) * k + min(i + 1, m)] for i in range(n))
 
-        # now that we have our constraints, convert them to CNF
-        print("converting to cnf")
-        constraints_cnf = to_cnf(constraints_expression)
+    @staticmethod
+    def _ast_to_sympy(constraints_asts, shape, symbols=None):
+        """
+        Function that converts ASTs of `constraints_parser` to a sympy expression, naming the variables as the
+        sympy parser does (X.1.2 -> X_1_2).
+        :param constraints_asts: List of ASTs.
+        :param shape: Shape in which we consider our variables to be.
+        :param symbols: Dict from the variables to their sympy symbol, used as a cache and updated.
+        :return: A simpy expression, the "and" of all the constraints.
+        """
+        symbols = {} if symbols is None else symbols
+
+        def leaf(node):
+            if isinstance(node, bool):
+                return sympy.true if node else sympy.false
+            if abs(node) not in symbols:
+                index = np.unravel_index(abs(node) - 1, shape)
+                symbols[abs(node)] = sympy.Symbol("X_" + "_".join(str(item) for item in index))
+            return symbols[node] if node > 0 else sympy.Not(symbols[-node])
+
+        def operator(name, arguments):
+            if isinstance(name, tuple):
+                raise ValueError("Cardinality functions can not be converted to sympy expressions")
+            # as the sympy parser, which does not evaluate the operators '&', '|' and '^', but evaluates functions
+            if name in ("and", "or", "xor"):
+                return _SYMPY_OPERATORS[name](*arguments, evaluate=False)
+            return _SYMPY_OPERATORS[name](*arguments)
+
+        return sympy.And(
+            *[constraints_parser.fold(node, leaf, operator) for node in constraints_asts], evaluate=False
+        )
 
-        # write output file to DIMAC format
-        print("writing to DIMACS")
-        ConstraintsToCnf._to_dimacs(shape, stride, total_vars, constraints_cnf, constraint_file, output_file)
+    @staticmethod
+    def _sympy_to_ast(expression, stride):
+        """
+        Function that converts a sympy expression to an AST of `constraints_parser`.
+        :param expression: Sympy expression over valid variables.
+        :param stride: Numpy array specifying the stride over each dimension.
+        :return: The AST of the expression.
+        """
+        if expression is sympy.true or expression is sympy.false:
+            return bool(expression)
+        if isinstance(expression, sympy.Symbol):
+            items = list(map(lambda x: int(x), regex.findall(r"[0-9]+", str(expression))))
+            return int(ConstraintsToCnf._get_index(np.array(items), stride)) + 1
+        for cls, name in _SYMPY_OPERATORS_INVERSE:
+            if isinstance(expression, cls):
+                arguments = [ConstraintsToCnf._sympy_to_ast(arg, stride) for arg in expression.args]
+                return constraints_parser.apply(name, arguments)
+        raise ValueError("Operator '%s' is not supported" % expression.func)
 
     @staticmethod
     def _parse_constraints_monoprocess(constraints):
@@ -157,15 +582,10 @@ class ConstraintsToCnf:
         :return: A simpy expression, the "and" of all the constraints.
         """
 
-        # stackoverflow to split constraints to each process
-        def chunks(a, n):
-            k, m = divmod(len(a), n)
-            return (a[i * k + min(i, m):(i + 1) * k + min(i + 1, m)] for i in range(n))
-
         # open pool of processes, each one will contribute to parsing part of the constraints
         with Pool(processes=nprocesses) as pool:
             multiple_results = [pool.apply_async(ConstraintsToCnf._parse_constraints_monoprocess, [chunk]) for chunk in
-                                chunks(constraints, nprocesses)]
+                                ConstraintsToCnf._chunks(constraints, nprocesses)]
 
             constraints_list = [res.get() for res in multiple_results]
             constraints_expression = sympy.And(*constraints_list, evaluate=False)
@@ -257,62 +677,70 @@ class ConstraintsToCnf:
         return np.dot(stride, index)
 
     @staticmethod
-    def _to_dimacs(shape, stride, total_vars, cnf, input_file, output_file):
+    def _clauses_to_dimacs(shape, total_vars, clauses, n_aux, input_file, output_file,
+                           auxiliary="the tseitin encoding"):
         """
-        Writes the constraints expressed by the sympy cnf expression
-        as a DIMACS file, where all variables that were referred in the input_file
-        as if being in a tensor of the specified shape are renamed as if they were
-        in a 1 dimensional vector.
+        Writes clauses of integer literals as a DIMACS file.
+        The clauses are consumed in chunks of DIMACS_CHUNK_SIZE clauses, written to a temporary file next to the
+        output file while they are counted, so that neither the clauses nor the file are ever held in memory; the
+        header is then written, followed by the copy of the temporary file.
 
         :param shape: Shape in which we consider our variables to be.
-        :param stride: Numpy array specifying the stride over each dimension.
         :param total_vars: Total number of variables (given by the shape).
-        :param cnf: Sympy boolean expression, expected to be a cnf.
+        :param clauses: Iterable of clauses, each one a list of non-zero integer literals, or the clause [True] alone
+            for the constant True. A clause [False] makes the whole cnf the constant False.
+        :param n_aux: Number of auxiliary variables, numbered after the total_vars variables of the shape, or a
+            function returning it, called once all the clauses have been consumed.
+        :param auxiliary: What introduced the auxiliary variables, for the header.
         :param input_file: Refer to epression_to_cnf.
         :param output_file: Refer to expression_to_cnf.
         """
-        # build a dict mapping the multi dim variable to single index var (X.1.2.3 -> Xi)
-        variables = list(cnf.atoms())
-        translate_dict = {}
-        for var in variables:
-            var_name = str(var)
-            # get all indexes as ints and compute the 1 dimensional index
-            if not var.is_Boolean:
-                items = list(map(lambda x: int(x), regex.findall(r"[0-9]+", var_name)))
-                index = ConstraintsToCnf._get_index(np.array(items), stride)
-                translate_dict[var_name] = str(index + 1)  # +1 because pysdd start from 1 and not 0
-
-        # reduce clauses to list (ands) of lists (clauses)
-        clauses = str(cnf)
-        # translate vars as if having a single dimension
-        clauses = regex.sub(r"X((_[0-9]+)|[0-9]+)(_[0-9]+)*", lambda x: translate_dict[x.group(0)], clauses)
-        # remove whitespace, ~ into -, remove parenthesis
-        clauses = regex.sub(r" ", "", clauses)
-        clauses = regex.sub(r"~", "-", clauses)
-        clauses = regex.sub(r"\(|\)", "", clauses)
-        # split clauses
-        clauses = clauses.split("&")
-        # split literals
-        clauses = [clause.split("|") for clause in clauses]
-        # append 0 for DIMACS format at the end of a clause
-        [clause.append("0") for clause in clauses]
-        number_of_clauses = len(clauses)
-
-        # let's write the output string that will then become a file
-        output = "c This file was generated with the constraints_to_cnf module in this project.\n"
-        output += "c Starting from file '%s'.\n" % input_file
-        output += "c There are %s variables present in the constraints, and %s total variables, given by the shape " \
-                  "%s.\n" % (len(variables), total_vars, list(shape))
-        output += "c\n"
-        output += "p cnf %s %s\n" % (total_vars, number_of_clauses)
-        clauses = [" ".join(clause) for clause in clauses]
-        clauses = "\n".join(clauses)
-        output += clauses
-        output += "\n\n"
-
-        # let's write the output file
-        with open(output_file, "w") as output_file:
-            output_file.write(output)
+        present, n_clauses = set(), 0
+        with tempfile.TemporaryFile("w+", dir=os.path.dirname(os.path.abspath(output_file))) as body:
+            chunk = []
+            for clause in clauses:
+                if clause == [False]:
+                    # the cnf is then False, written alone as sympy writes it
+                    body.seek(0)
+                    body.truncate()
+                    present, n_clauses, n_aux, chunk = set(), 0, 0, [clause]
+                    break
+                chunk.append(clause)
+                if len(chunk) == DIMACS_CHUNK_SIZE:
+                    n_clauses += ConstraintsToCnf._write_clauses(body, chunk, present, total_vars)
+                    chunk = []
+            n_clauses += ConstraintsToCnf._write_clauses(body, chunk, present, total_vars)
+            n_aux = n_aux() if callable(n_aux) else n_aux
+
+            header = "c This file was generated with the constraints_to_cnf module in this project.\n"
+            header += "c Starting from file '%s'.\n" % input_file
+            header += "c There are %s variables present in the constraints, and %s total variables, given by the " \
+                      "shape %s.\n" % (len(present), total_vars, list(shape))
+            if n_aux:
+                header += "c Variables %s to %s are auxiliary variables of %s.\n" % (
+                    total_vars + 1, total_vars + n_aux, auxiliary
+                )
+            header += "c\n"
+            header += "p cnf %s %s\n" % (total_vars + n_aux, n_clauses)
+
+            body.seek(0)
+            with open(output_file, "w") as output_file:
+                output_file.write(header)
+                shutil.copyfileobj(body, output_file)
+                output_file.write("\n")
+
+    @staticmethod
+    def _write_clauses(file, clauses, present, total_vars):
+        """
+        Writes a chunk of clauses in the DIMACS format, adding the variables of the shape they contain to present.
+        :return: The number of clauses written.
+        """
+        present.update(
+            abs(literal) for clause in clauses for literal in clause
+            if not isinstance(literal, bool) and abs(literal) <= total_vars
+        )
+        file.write("".join(" ".join(map(str, clause + [0])) + "\n" for clause in clauses))
+        return len(clauses)
 
 
 if __name__ == "__main__":
@@ -320,5 +748,15 @@ if __name__ == "__main__":
     parser.add_argument("-i", "--input", type=str, required=True, help="Path to the input file")
     parser.add_argument("-o", "--output", type=str, required=True, help="Path to the output file")
     parser.add_argument("-p", "--nprocesses", type=int, required=False, default=1, help="Number of processes to use")
+    parser.add_argument(
+        "-e", "--encoding", type=str, required=False, default="cnf", choices=ENCODINGS,
+        help="'cnf' for an equivalent CNF, 'tseitin' for an equisatisfiable CNF of linear size with auxiliary variables"
+    )
+    parser.add_argument(
+        "--parser", type=str, required=False, default="native", choices=PARSERS,
+        help="'native' for the parser of constraints_parser, 'sympy' for sympy's parse_expr"
+    )
     args = parser.parse_args()
-    ConstraintsToCnf.expression_to_cnf(args.input, args.output, args.nprocesses)
+    ConstraintsToCnf.expression_to_cnf(
+        args.input, args.output, args.nprocesses, encoding=args.encoding, parser=args.parser
+    )
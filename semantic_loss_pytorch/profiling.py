@@ -0,0 +1,258 @@
+"""
+Opt-in profiling of the loading and the evaluation of semantic losses.
+
+Nothing is recorded unless a `Profile` is active. Inside `profile()`, timings and counters of the instrumented
+phases are recorded to the returned object, which can be queried or exported to JSON:
+
+    with profiling.profile() as prof:
+        sl = SemanticLoss(sdd_file, vtree_file)
+        sl(logits=x).backward()
+    prof.total_time("load.sdd_read"), prof.counter("forward.nodes_visited")
+    prof.to_json("profile.json")
+
+Recorded timings (seconds): `load.vtree_read`, `load.sdd_read` (file parsing), `load.normalize`,
+`compile.linearize`, `compile.simplify`, `forward`, `backward` (from the gradient of the outputs of the loss to
+the gradient of its input) and `circuit.backward` (the analytic backward sweep of the compiled circuit).
+
+Recorded counters: `load.sdd_read.*` and `load.normalize.*` with the `nodes_created`, `unique_hits` and
+`unique_misses` of the managers, `forward.nodes_visited` and `forward.elements_visited` by the circuit passes, and
+`forward.tensors_allocated`, the number of new tensors (not views) returned by torch operations during the forward.
+"""
+import contextlib
+import functools
+import inspect
+import json
+import threading
+import time
+from typing import Callable, Dict, List, Optional
+
+import torch
+from torch.overrides import TorchFunctionMode
+
+
+class Profile:
+    """
+    Timings and counters recorded while the profile is active, see `profile`.
+    Recording is thread-safe, so that a profile can be shared by data-parallel threads.
+    """
+
+    def __init__(self):
+        self.timings: Dict[str, List[float]] = {}
+        self.counters: Dict[str, int] = {}
+        self._lock = threading.Lock()
+
+    def add_time(self, name: str, seconds: float):
+        with self._lock:
+            self.timings.setdefault(name, []).append(seconds)
+
+    def count(self, name: str, value: int = 1):
+        with self._lock:
+            self.counters[name] = self.counters.get(name, 0) + value
+
+    @contextlib.contextmanager
+    def timer(self, name: str):
+        """
+        Records the wall time of the body of the `with` statement under `name`.
+        """
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.add_time(name, time.perf_counter() - start)
+
+    def counter(self, name: str) -> int:
+        return self.counters.get(name, 0)
+
+    def calls(self, name: str) -> int:
+        return len(self.timings.get(name, ()))
+
+    def total_time(self, name: str) -> float:
+        return sum(self.timings.get(name, ()))
+
+    def reset(self):
+        with self._lock:
+            self.timings.clear()
+            self.counters.clear()
+
+    def summary(self) -> Dict[str, Dict]:
+        """
+        Returns the number of calls and the total, mean, minimum and maximum time of each timing, and the counters.
+        """
+        with self._lock:
+            timings = {
+                name: {
+                    "calls": len(times),
+                    "total": sum(times),
+                    "mean": sum(times) / len(times),
+                    "min": min(times),
+                    "max": max(times),
+                }
+                for name, times in sorted(self.timings.items())
+            }
+            return {"timings": timings, "counters": dict(sorted(self.counters.items()))}
+
+    def to_json(self, filename: str = None) -> str:
+        """
+        Returns the `summary` as a JSON string, also written to `filename` if given.
+        """
+        text = json.dumps(self.summary(), indent=2)
+        if filename is not None:
+            with open(filename, "w") as f:
+                f.write(text)
+        return text
+
+
+_active: Optional[Profile] = None
+
+
+def active() -> Optional[Profile]:
+    """
+    Returns the active profile, if any.
+    """
+    return _active
+
+
+@contextlib.contextmanager
+def profile(prof: Profile = None):
+    """
+    Activates `prof` (a new `Profile` by default) for the body of the `with` statement and returns it.
+    Profiles are global to the process, the previous one is restored on exit.
+    """
+    global _active
+    previous, _active = _active, prof if prof is not None else Profile()
+    try:
+        yield _active
+    finally:
+        _active = previous
+
+
+@contextlib.contextmanager
+def timed(name: str):
+    """
+    Records the wall time of the body of the `with` statement in the active profile, if any.
+    """
+    prof = _active
+    if prof is None:
+        yield
+    else:
+        with prof.timer(name):
+            yield
+
+
+def count(name: str, value: int = 1):
+    """
+    Increments a counter of the active profile, if any.
+    """
+    prof = _active
+    if prof is not None:
+        prof.count(name, value)
+
+
+def count_manager(prefix: str, manager, before: Dict[str, int] = None) -> Dict[str, int]:
+    """
+    Records the nodes created by an `SddManager` and the hits and misses of its unique table since `before`,
+    a previous result of this function, under `prefix`. Returns the current totals of the manager.
+    """
+    totals = {
+        "nodes_created": manager.id_counter,
+        "unique_hits": manager.unique_hits,
+        "unique_misses": manager.unique_misses,
+    }
+    for name, value in totals.items():
+        count(prefix + "." + name, value - (before or {}).get(name, 0))
+    return totals
+
+
+def count_circuit(circuit):
+    """
+    Records the nodes and elements visited by a pass over a `CompiledCircuit`.
+    """
+    count("forward.nodes_visited", circuit.n_nodes)
+    count("forward.elements_visited", circuit.n_elements)
+
+
+def count_psdd(psdd):
+    """
+    Records the nodes and elements visited by a pass over a PSDD, counted only when a profile is active.
+    """
+    if _active is not None:
+        count("forward.nodes_visited", psdd._node_count())
+        count("forward.elements_visited", psdd.size())
+
+
+class _TensorCounter(TorchFunctionMode):
+    """
+    Counts the new tensors, not views or inputs, returned by the torch operations called while active.
+    """
+
+    def __init__(self):
+        super().__init__()
+        self.tensors = 0
+
+    def __torch_function__(self, func, types, args=(), kwargs=None):
+        outputs = func(*args, **(kwargs or {}))
+        results = outputs if isinstance(outputs, (tuple, list)) else (outputs,)
+        for result in results:
+            if isinstance(result, torch.Tensor) and result._base is None and not any(result is a for a in args):
+                self.tensors += 1
+        return outputs
+
+
+def _time_backward(prof: Profile, outputs, inputs: List[torch.Tensor]):
+    """
+    Records as `backward` the time from the gradient reaching any of `outputs` to the last gradient reaching
+    `inputs`, which must be tensors created for this forward only, so that their hooks fire once.
+    """
+    inputs = [x for x in inputs if x.requires_grad]
+    outputs = [y for y in outputs if isinstance(y, torch.Tensor) and y.requires_grad]
+    if not inputs or not outputs:
+        return
+
+    state = {"start": None, "pending": len(inputs)}
+
+    def start(grad):
+        if state["start"] is None:
+            state["start"] = time.perf_counter()
+
+    def end(grad):
+        state["pending"] -= 1
+        if state["pending"] == 0 and state["start"] is not None:
+            prof.add_time("backward", time.perf_counter() - state["start"])
+
+    for y in outputs:
+        y.register_hook(start)
+    for x in inputs:
+        x.register_hook(end)
+
+
+def profiled_forward(forward: Callable) -> Callable:
+    """
+    Decorates the `forward` of a loss taking `logits` or `probabilities`, recording its wall time, the tensors it
+    allocates and the wall time of its backward pass in the active profile, if any.
+    """
+    signature = inspect.signature(forward)
+
+    @functools.wraps(forward)
+    def wrapper(*args, **kwargs):
+        prof = _active
+        if prof is None:
+            return forward(*args, **kwargs)
+
+        bound = signature.bind(*args, **kwargs)
+        inputs = []
+        for name in ("logits", "probabilities"):
+            x = bound.arguments.get(name)
+            if isinstance(x, torch.Tensor) and x.requires_grad and torch.is_grad_enabled():
+                # a fresh view, so that the gradient hook is not left on the input of the caller
+                bound.arguments[name] = x = x.view_as(x)
+                inputs.append(x)
+
+        counter = _TensorCounter()
+        with prof.timer("forward"), counter:
+            outputs = forward(*bound.args, **bound.kwargs)
+        prof.count("forward.tensors_allocated", counter.tensors)
+
+        _time_backward(prof, outputs if isinstance(outputs, tuple) else (outputs,), inputs)
+        return outputs
+
+    return wrapper
@@ -18,6 +18,8 @@ class SddManager:
         self.var_count = vtree.var_count
         self.unique = {}
         self.id_counter = 0
+        self.unique_hits = 0
+        self.unique_misses = 0
 
         self._setup_var_to_vtree(vtree)
         self._setup_terminal_sdds()
@@ -62,11 +64,17 @@ class SddManager:
         Elements is a list of prime,sub pairs:
             [ (p1,s1),(p2,s2),...,(pn,sn) ]"""
         elements = self._canonical_elements(elements)
-        if elements not in self.unique:
+        # normalized SDDs, as saved from a PSddManager, can have the same
+        # elements (e.g. true,true) at different vtree nodes
+        key = (vtree_node.id,elements)
+        if key not in self.unique:
+            self.unique_misses += 1
             node_type = SddNode.DECOMPOSITION
             node = self.Node(node_type,elements,vtree_node,self)
-            self.unique[elements] = node
-        return self.unique[elements]
+            self.unique[key] = node
+        else:
+            self.unique_hits += 1
+        return self.unique[key]
 
 class PSddManager(SddManager):
     Node = PSddNode # native node class
@@ -74,6 +82,7 @@ class PSddManager(SddManager):
     def __init__(self,vtree):
         SddManager.__init__(self,vtree)
         self._setup_true_false_sdds()
+        self.apply_cache = {}
 
     def _setup_true_false_sdds(self):
         """PSDDs are normalized, so we create a unique true/false SDD/PSDD
@@ -161,3 +170,141 @@ class PSddManager(SddManager):
             right = self._normalize_sdd(alpha,vtree.right)
             elements = [ (left,right) ]
         return self.lookup_node(elements,vtree)
+
+    ########################################
+    # CONSTRUCTION
+    ########################################
+
+    def literal_sdd(self,literal,vtree=None):
+        """Returns a literal normalized for vtree (the root of the vtree by
+        default)"""
+        if vtree is None: vtree = self.vtree
+        return self._normalize_sdd(self.literals[literal],vtree)
+
+    def _leaf_apply(self,alpha,beta,op,vtree):
+        """Apply op to two SDDs normalized for the same leaf vtree node,
+        represented as the set of values of its variable they allow"""
+        var = vtree.var
+        nodes = [ self.false_sdds[vtree.id],self.literals[-var],
+                  self.literals[var],self.true_sdds[vtree.id] ]
+        def mask(node):
+            if node.is_false(): return 0
+            elif node.is_true(): return 3
+            else: return 2 if node.literal > 0 else 1
+        if op == 'and': return nodes[mask(alpha) & mask(beta)]
+        else:           return nodes[mask(alpha) | mask(beta)]
+
+    def apply(self,alpha,beta,op):
+        """Conjoin (op='and') or disjoin (op='or') two SDDs normalized for
+        the same vtree node.
+
+        The primes of the result are the consistent conjunctions of the
+        primes of alpha and beta, and elements with the same sub are merged,
+        so that the result is compressed and found in the unique table.
+        Results are cached in apply_cache."""
+        if op not in ('and','or'):
+            raise ValueError("op must be 'and' or 'or', got %r" % op)
+        vtree = alpha.vtree
+        if beta.vtree is not vtree:
+            raise ValueError("SDDs must be normalized for the same vtree node")
+
+        true,false = self.true_sdds[vtree.id],self.false_sdds[vtree.id]
+        if alpha is beta: return alpha
+        if op == 'and':
+            if alpha is false or beta is false: return false
+            if alpha is true: return beta
+            if beta is true: return alpha
+        else:
+            if alpha is true or beta is true: return true
+            if alpha is false: return beta
+            if beta is false: return alpha
+
+        key = (op,alpha.id,beta.id) if alpha.id < beta.id else (op,beta.id,alpha.id)
+        if key in self.apply_cache: return self.apply_cache[key]
+
+        if vtree.is_leaf():
+            node = self._leaf_apply(alpha,beta,op,vtree)
+        else:
+            primes = {} # sub -> primes with that sub, in insertion order
+            for p,s in alpha.elements:
+                for q,r in beta.elements:
+                    prime = self.apply(p,q,'and')
+                    if prime.is_false_sdd: continue
+                    primes.setdefault(self.apply(s,r,op),[]).append(prime)
+            elements = []
+            for sub,sub_primes in primes.items():
+                prime = sub_primes[0]
+                for other in sub_primes[1:]:
+                    prime = self.apply(prime,other,'or')
+                elements.append((prime,sub))
+            node = self.lookup_node(elements,vtree)
+
+        self.apply_cache[key] = node
+        return node
+
+    def conjoin(self,*nodes):
+        """Conjoin SDDs normalized for the same vtree node, pairwise so that
+        intermediate SDDs stay small"""
+        return self._apply_all(list(nodes),'and')
+
+    def disjoin(self,*nodes):
+        """Disjoin SDDs normalized for the same vtree node"""
+        return self._apply_all(list(nodes),'or')
+
+    def _apply_all(self,nodes,op):
+        if not nodes: raise ValueError("at least one SDD is needed")
+        while len(nodes) > 1:
+            pairs = [ self.apply(nodes[i],nodes[i+1],op)
+                      for i in range(0,len(nodes)-1,2) ]
+            nodes = pairs + nodes[len(pairs)*2:]
+        return nodes[0]
+
+    def implication_sdd(self,antecedent,consequent,vtree=None):
+        """Returns the SDD of antecedent => consequent, for two literals,
+        normalized for vtree (the root of the vtree by default)"""
+        if vtree is None: vtree = self.vtree
+        return self.disjoin(self.literal_sdd(-antecedent,vtree),
+                            self.literal_sdd(consequent,vtree))
+
+    def cardinality_sdd(self,variables,counts,vtree=None):
+        """Returns the SDD, normalized for vtree (the root of the vtree by
+        default), of the assignments where the number of true variables
+        among variables is in counts.
+
+        The primes of each decomposition node are the numbers of true
+        variables in its left vtree, grouped by the sub they lead to, so the
+        SDD is built directly, with size quadratic in the number of
+        variables and without calling apply."""
+        if vtree is None: vtree = self.vtree
+        variables = set(variables)
+        # number of constrained variables below each vtree node
+        sizes = {}
+        for node in vtree.post_order():
+            if node.is_leaf(): sizes[node.id] = int(node.var in variables)
+            else: sizes[node.id] = sizes[node.left.id] + sizes[node.right.id]
+        return self._cardinality_sdd(frozenset(counts),vtree,sizes,{})
+
+    def _cardinality_sdd(self,counts,vtree,sizes,cache):
+        size = sizes[vtree.id]
+        counts = frozenset( c for c in counts if 0 <= c <= size )
+        key = (vtree.id,counts)
+        if key in cache: return cache[key]
+
+        if not counts:
+            node = self.false_sdds[vtree.id]
+        elif len(counts) == size + 1:
+            node = self.true_sdds[vtree.id]
+        elif vtree.is_leaf():
+            node = self.literals[vtree.var if 1 in counts else -vtree.var]
+        else:
+            primes = {} # sub -> counts of the left vtree leading to it
+            for count in range(sizes[vtree.left.id] + 1):
+                sub_counts = [ c - count for c in counts ]
+                sub = self._cardinality_sdd(sub_counts,vtree.right,sizes,cache)
+                primes.setdefault(sub,[]).append(count)
+            elements = [ (self._cardinality_sdd(left_counts,vtree.left,sizes,cache),sub)
+                         for sub,left_counts in primes.items() ]
+            node = self.lookup_node(elements,vtree)
+
+        cache[key] = node
+        return node
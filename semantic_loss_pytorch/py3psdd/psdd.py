@@ -136,9 +136,22 @@ class PSddNode(NormalizedSddNode):
         return pr
 
     def value(self,evidence=InstMap(),clear_data=True):
-        """Compute the (un-normalized) value of a PSDD given evidence"""
+        """Compute the (un-normalized) value of a PSDD given evidence
+
+        The value of each node is kept in a call-local list, so that
+        concurrent calls do not interfere.  If clear_data=False, it is also
+        left in the data field of the node."""
         if self.is_false_sdd: return 0.0
-        for node in self.as_positive_list(clear_data=clear_data):
+        values = self._values(evidence)
+        if not clear_data: self._store_data(values,positive=True)
+        return values[-1]
+
+    def _values(self,evidence):
+        """Returns the (un-normalized) value of each node of the PSDD, in the
+        order of as_positive_list"""
+        self._linearize_positive()
+        values = [ None ] * len(self._positive_array)
+        for index,node in enumerate(self._positive_array):
             if node.is_false():
                 value = 0.0
             elif node.is_true():
@@ -152,12 +165,13 @@ class PSddNode(NormalizedSddNode):
                 value = node.theta_sum if sim else 0.0
             else: # node.is_decomposition()            
                 value = 0.0
-                for p,s in node.positive_elements:
+                positions = self._positive_array_elements[index]
+                for (p,s),(pi,si) in zip(node.positive_elements,positions):
                     theta = node.theta[(p,s)]
-                    value += (p.data/p.theta_sum)*(s.data/s.theta_sum)*theta
-            node.data = value
+                    value += (values[pi]/p.theta_sum)*(values[si]/s.theta_sum)*theta
+            values[index] = value
 
-        return value
+        return values
 
     def probability(self,evidence=InstMap(),clear_data=True):
         """Compute the probability of evidence in a PSDD"""
@@ -171,20 +185,27 @@ class PSddNode(NormalizedSddNode):
         = var_marginals[lit] = value(lit,e)
         = var_marginals[0]   = value(e)
 
-        Populates a field on each node:
+        Values and contexts are kept in call-local lists, so that concurrent
+        calls do not interfere.  If clear_data=False, populates fields on
+        each node:
+        = node.data has the value of node
         = node.pr_context has probability of context
         = node.pr_node has probability of node"""
         var_marginals = [ 0.0 ] * (2*self.vtree.var_count+1)
         if self.is_false_sdd: return var_marginals
 
+        self._linearize_positive()
+        array = self._positive_array
         if do_bottom_up: # do not call value if done already
-            self.value(evidence=evidence,clear_data=False)
-        for node in self.as_positive_list(clear_data=False): # init field
-            node.pr_context = 0.0
-
-        value = self.data
-        self.pr_context = 1.0
-        for node in self.as_positive_list(reverse=True,clear_data=clear_data):
+            values = self._values(evidence)
+        else: # values left on the nodes by value(clear_data=False)
+            values = [ node.data for node in array ]
+
+        value = values[-1]
+        pr_contexts = [ 0.0 ] * len(array)
+        pr_contexts[-1] = 1.0
+        for index in range(len(array)-1,-1,-1):
+            node,pr_context = array[index],pr_contexts[index]
             if node.is_true() or node.is_literal():
                 # accumulate variable marginals
                 var = node.vtree.var
@@ -192,20 +213,26 @@ class PSddNode(NormalizedSddNode):
                 pr_neg = node.theta[0]/node.theta_sum
                 if var in evidence:
                     val = evidence[var]
-                    if val: var_marginals[ var] += pr_pos*node.pr_context
-                    else:   var_marginals[-var] += pr_neg*node.pr_context
+                    if val: var_marginals[ var] += pr_pos*pr_context
+                    else:   var_marginals[-var] += pr_neg*pr_context
                 else:
-                    var_marginals[ var] += pr_pos*node.pr_context
-                    var_marginals[-var] += pr_neg*node.pr_context
+                    var_marginals[ var] += pr_pos*pr_context
+                    var_marginals[-var] += pr_neg*pr_context
             else: # node.is_decomposition()
                 # accumulate node marginals
-                for p,s in node.positive_elements:
+                positions = self._positive_array_elements[index]
+                for (p,s),(pi,si) in zip(node.positive_elements,positions):
                     theta = node.theta[(p,s)]/node.theta_sum
-                    pr_p = p.data/p.theta_sum
-                    pr_s = s.data/s.theta_sum
-                    p.pr_context += theta*pr_s*node.pr_context
-                    s.pr_context += theta*pr_p*node.pr_context
-            node.pr_node = node.pr_context*(node.data/node.theta_sum)
+                    pr_p = values[pi]/p.theta_sum
+                    pr_s = values[si]/s.theta_sum
+                    pr_contexts[pi] += theta*pr_s*pr_context
+                    pr_contexts[si] += theta*pr_p*pr_context
+
+        if not clear_data:
+            for node,node_value,pr_context in zip(array,values,pr_contexts):
+                node.data = node_value
+                node.pr_context = pr_context
+                node.pr_node = pr_context*(node_value/node.theta_sum)
 
         var_marginals[0] = value
         return var_marginals
@@ -215,11 +242,16 @@ class PSddNode(NormalizedSddNode):
         Returns (un-normalized) MPE value and instantiation.
 
         If evidence is inconsistent with the PSDD, will return arbitrary
-        instanatiation consistent with evidence."""
+        instanatiation consistent with evidence.
+
+        The MPE of each node is kept in a call-local list, so that
+        concurrent calls do not interfere."""
         if self.is_false_sdd:
             inst = InstMap.from_bitset(0,self.vtree.var_count).concat(evidence)
             return 0.0,inst
-        for node in self.as_positive_list(clear_data=False):
+        self._linearize_positive()
+        results = [ None ] * len(self._positive_array)
+        for index,node in enumerate(self._positive_array):
             if node.is_false():
                 var = node.vtree.var
                 mpe_val = 0.0
@@ -237,26 +269,27 @@ class PSddNode(NormalizedSddNode):
                     mpe_ind = theta.index(mpe_val)
             else: # node.is_decomposition()
                 pels = node.positive_elements
-                pvals = [ p.data[0]/p.theta_sum for p,s in pels ]
-                svals = [ s.data[0]/s.theta_sum for p,s in pels ]
+                positions = self._positive_array_elements[index]
+                pvals = [ results[pi][0]/p.theta_sum for (p,s),(pi,si) in zip(pels,positions) ]
+                svals = [ results[si][0]/s.theta_sum for (p,s),(pi,si) in zip(pels,positions) ]
                 vals = [ pval*sval*node.theta[el] for pval,sval,el \
                          in zip(pvals,svals,pels) ]
-                mpe_val,mpe_ind = max(list(zip(vals,pels)))
-            node.data = (mpe_val,mpe_ind)
+                mpe_val,mpe_el = max(list(zip(vals,pels)))
+                mpe_ind = positions[pels.index(mpe_el)] # positions of prime and sub
+            results[index] = (mpe_val,mpe_ind)
 
         mpe_inst = InstMap()
-        queue = [self] if self.data is not None else []
+        queue = [len(results)-1]
         while queue:
-            node = queue.pop()
+            index = queue.pop()
+            node = self._positive_array[index]
             if node.is_decomposition():
-                prime,sub = node.data[1]
+                prime,sub = results[index][1]
                 queue.append(prime)
                 queue.append(sub)
             else:
-                mpe_inst[node.vtree.var] = node.data[1]
+                mpe_inst[node.vtree.var] = results[index][1]
 
-        # clear_data
-        for node in self._positive_array: node.data = None
         return mpe_val,mpe_inst
 
     def enumerate_mpe(self,pmanager,evidence=InstMap()):
@@ -319,7 +352,7 @@ class PSddNode(NormalizedSddNode):
         """Alternative computation of the KL-divergence between two PSDDs.
         The PSDDs must have the same structure, but may have different
         parameters.  This one uses node marginals to compute the KL."""
-        self.marginals()
+        self.marginals(clear_data=False)
         kl = 0.0
         for n1,n2 in zip(self.as_positive_list(),other.as_positive_list()):
             assert n1.id == n2.id
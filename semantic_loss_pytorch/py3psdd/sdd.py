@@ -37,6 +37,7 @@ class SddNode:
         self.data = None  # data field
         self._bit = False  # internal bit field
         self._array = None  # internal array field
+        self._array_elements = None  # positions of the elements of each node in _array
         # this is needed by normalized SDDs later
         self.is_false_sdd = node_type == SddNode.FALSE
 
@@ -166,9 +167,66 @@ class SddNode:
                 node.data = None
 
     def _linearize(self):
-        """linearize SDD"""
+        """linearize SDD
+
+        The traversal does not mark the bits of the nodes, so that SDDs
+        sharing nodes can be linearized concurrently."""
         if self._array is not None: return  # already linearized
-        self._array = list(self)
+        array = SddNode._post_order_list(self)
+        self._array_elements = SddNode._element_positions(array)
+        self._array = array
+
+    @staticmethod
+    def _post_order_list(root, positive=False):
+        """Returns the nodes of an SDD in post-order (children before
+        parents), in the same order as SddNode.__iter__.
+
+        Visited nodes are kept in a local set instead of the bit field of
+        the nodes.  If positive=True, false SDD nodes are skipped as in
+        NormalizedSddNode.positive_iter."""
+        nodes, visited = [], set()
+        stack = [(root, False)]
+        while stack:
+            node, expanded = stack.pop()
+            if expanded:
+                nodes.append(node)
+                continue
+            if id(node) in visited: continue
+            if positive and node.is_false_sdd: continue
+            visited.add(id(node))
+
+            stack.append((node, True))
+            if node.is_decomposition():
+                for p, s in reversed(node.elements):
+                    if positive and s.is_false_sdd: continue
+                    stack.append((s, False))
+                    stack.append((p, False))
+        return nodes
+
+    @staticmethod
+    def _element_positions(array, positive=False):
+        """For each node of a linearized SDD, returns the positions in array
+        of the prime and of the sub of each of its elements (of each of its
+        positive elements if positive=True), or None for terminal nodes.
+
+        Evaluators use these positions to keep the value of each node in a
+        call-local list, instead of the data field of the nodes."""
+        position = {id(node): index for index, node in enumerate(array)}
+        element_positions = []
+        for node in array:
+            if node.is_decomposition():
+                elements = node.positive_elements if positive else node.elements
+                element_positions.append(tuple((position[id(p)], position[id(s)]) for p, s in elements))
+            else:
+                element_positions.append(None)
+        return element_positions
+
+    def _store_data(self, values, positive=False):
+        """Stores the values computed by an evaluator in the data field of
+        the nodes, for callers asking for clear_data=False."""
+        array = self._positive_array if positive else self._array
+        for node, value in zip(array, values):
+            node.data = value
 
     def _is_bits_and_data_clear(self):
         """sanity check, for testing"""
@@ -370,6 +428,7 @@ class NormalizedSddNode(SddNode):
             self.positive_elements = \
                 tuple((p, s) for p, s in self.elements if not s.is_false_sdd)
         self._positive_array = None
+        self._positive_array_elements = None
 
     def _positive_node_count(self):
         """Returns the number of (decision and terminal) nodes in the SDD"""
@@ -395,10 +454,16 @@ class NormalizedSddNode(SddNode):
         if first_call:
             self.clear_bits(clear_data=clear_data)
 
+    def _linearize_positive(self):
+        """linearize SDD, skipping false SDD nodes.  See SddNode._linearize"""
+        if self._positive_array is not None: return  # already linearized
+        array = SddNode._post_order_list(self, positive=True)
+        self._positive_array_elements = SddNode._element_positions(array, positive=True)
+        self._positive_array = array
+
     def as_positive_list(self, reverse=False, clear_data=True):
         """iterating over an SDD's nodes, as a list.  See SddNode.as_list"""
-        if self._positive_array is None:
-            self._positive_array = list(self.positive_iter())
+        self._linearize_positive()
         if reverse:
             for node in reversed(self._positive_array):
                 yield node
@@ -412,8 +477,14 @@ class NormalizedSddNode(SddNode):
     def model_count(self, evidence=InstMap(), clear_data=True):
         """Compute model count of a normalized SDD.
 
-        SddNode.model_count does not assume the SDD is normalized."""
-        for node in self.as_list(clear_data=clear_data):
+        SddNode.model_count does not assume the SDD is normalized.
+
+        The count of each node is kept in a call-local list, so that
+        concurrent calls do not interfere.  If clear_data=False, it is also
+        left in the data field of the node."""
+        self._linearize()
+        counts = [None] * len(self._array)
+        for index, (node, elements) in enumerate(zip(self._array, self._array_elements)):
             if node.is_false():
                 count = 0
             elif node.is_true():
@@ -421,17 +492,21 @@ class NormalizedSddNode(SddNode):
             elif node.is_literal():
                 count = 1 if evidence.is_compatible(node.literal) else 0
             else:  # node.is_decomposition()
-                count = sum(p.data * s.data for p, s in node.elements)
-            node.data = count
+                count = sum(counts[p] * counts[s] for p, s in elements)
+            counts[index] = count
 
+        if not clear_data: self._store_data(counts)
         return count
 
     def get_weighted_mpe(self, lit_weights, clear_data=True):
         """Compute the MPE instation given weights associated with literals.
 
-        Assumes the SDD is normalized.
+        Assumes the SDD is normalized.  Intermediate results are kept in a
+        call-local list, see NormalizedSddNode.model_count.
         """
-        for node in self.as_positive_list(clear_data=clear_data):
+        self._linearize_positive()
+        results = [None] * len(self._positive_array)
+        for index, node in enumerate(self._positive_array):
             if node.is_false():
                 # No configuration on false
                 data = (0, [])
@@ -446,17 +521,22 @@ class NormalizedSddNode(SddNode):
                 else:
                     data = (lit_weights[-node.literal - 1][0], [node.literal])
             else:  # node is_decomposition()
-                data = max(((p.data[0] * s.data[0], p.data[1] + s.data[1]) for p, s in node.positive_elements)
-                           , key=lambda x: x[0])
-            node.data = data
+                data = max(((results[p][0] * results[s][0], results[p][1] + results[s][1])
+                            for p, s in self._positive_array_elements[index]), key=lambda x: x[0])
+            results[index] = data
+
+        if not clear_data: self._store_data(results, positive=True)
         return data
 
     def weighted_model_count(self, lit_weights, clear_data=True):
         """ Compute weighted model count given literal weights
 
-        Assumes the SDD is normalized.
+        Assumes the SDD is normalized.  Intermediate results are kept in a
+        call-local list, see NormalizedSddNode.model_count.
         """
-        for node in self.as_list(clear_data=clear_data):
+        self._linearize()
+        results = [None] * len(self._array)
+        for index, (node, elements) in enumerate(zip(self._array, self._array_elements)):
             if node.is_false():
                 data = 0
             elif node.is_true():
@@ -467,8 +547,10 @@ class NormalizedSddNode(SddNode):
                 else:
                     data = lit_weights[-node.literal - 1][0]
             else:  # node is_decomposition
-                data = sum(p.data * s.data for p, s in node.elements)
-            node.data = data
+                data = sum(results[p] * results[s] for p, s in elements)
+            results[index] = data
+
+        if not clear_data: self._store_data(results)
         return data
 
     def generate_tf_ac(self, litleaves, clear_data=True):
@@ -542,7 +624,8 @@ class NormalizedSddNode(SddNode):
     def generate_pt_ac_v2(self, trueprobs, clear_data=True):
         """
         Generates a pytorch arithmetic circuit according to the weighted model counting procedure for this SDD.
-        Assumes the SDD is normalized.
+        Assumes the SDD is normalized.  Intermediate results are kept in a call-local list, so that the same SDD can
+        be evaluated concurrently, see NormalizedSddNode.model_count.
         """
 
         # Going to need tensorflow for this, but not for the rest of the project, so import here
@@ -550,7 +633,9 @@ class NormalizedSddNode(SddNode):
         true_tensor = torch.ones(1, device=trueprobs.device)
         false_tensor = torch.zeros(1, device=trueprobs.device)
 
-        for node in self.as_list(clear_data=clear_data):
+        self._linearize()
+        results = [None] * len(self._array)
+        for index, (node, elements) in enumerate(zip(self._array, self._array_elements)):
             if node.is_false():
                 data = false_tensor
             elif node.is_true():
@@ -562,21 +647,23 @@ class NormalizedSddNode(SddNode):
                     data = 1.0 - trueprobs[:, -node.literal - 1]
             else:  # node.is_decomposition
                 res = []
-                for p, s in node.elements:
-                    if p.data is false_tensor or s.data is false_tensor:
+                for p, s in elements:
+                    if results[p] is false_tensor or results[s] is false_tensor:
                         pass
-                    elif p.data is true_tensor:
-                        res.append(s.data)
-                    elif s.data is true_tensor:
-                        res.append(p.data)
+                    elif results[p] is true_tensor:
+                        res.append(results[s])
+                    elif results[s] is true_tensor:
+                        res.append(results[p])
                     else:
-                        res.append(s.data * p.data)
+                        res.append(results[s] * results[p])
 
                 if len(res) == 0:
                     res.append(false_tensor)
 
                 data = torch.stack(res, dim=0).sum(dim=0)
-            node.data = data
+            results[index] = data
+
+        if not clear_data: self._store_data(results)
         return data
 
     def count_variables(self):
@@ -1,15 +1,205 @@
+import math
 import os
+from typing import List, Optional, Sequence, Tuple
 
 import torch
+import torch.nn.functional as F
 from torch.nn.modules.loss import _Loss
+from torch.utils.checkpoint import checkpoint
 
-from semantic_loss_pytorch.py3psdd import PSddManager, SddManager, Vtree, io
+from semantic_loss_pytorch import cache, profiling
+from semantic_loss_pytorch.circuit import CompiledCircuit
+from semantic_loss_pytorch.py3psdd import PSddManager, PSddNode, SddManager, Vtree, io
 
 
 # For numerical stability
 EPSILON = 1e-9
 
 
+def categorical_groups(shape: Sequence[int], dim: int = -1) -> List[List[int]]:
+    """
+    Returns the groups of variables of an output with the given shape (without the batch dimension) that form
+    categorical variables over `dim`, as indices of the flattened output. For example, the groups of a `[4, 3]`
+    output with a softmax over the last dimension are `[[0, 1, 2], [3, 4, 5], [6, 7, 8], [9, 10, 11]]`.
+    """
+    indices = torch.arange(torch.Size(shape).numel()).reshape(shape)
+    return indices.movedim(dim, -1).reshape(-1, shape[dim]).tolist()
+
+
+def group_tensors(groups: Sequence[Sequence[int]]) -> Tuple[torch.Tensor, torch.Tensor]:
+    """
+    Returns the `[n_groups, max_group_size]` tensors of the variable indices of each group, padded with 0,
+    and of the mask of the variables that are not padding.
+    """
+    size = max(len(group) for group in groups)
+    index = torch.tensor([list(group) + [0] * (size - len(group)) for group in groups], dtype=torch.long)
+    mask = torch.tensor([[True] * len(group) + [False] * (size - len(group)) for group in groups])
+    return index, mask
+
+
+def literal_weights(
+    x: torch.Tensor,
+    from_logits: bool,
+    log_space: bool,
+    group_index: Optional[torch.Tensor] = None,
+    group_mask: Optional[torch.Tensor] = None,
+) -> Tuple[torch.Tensor, torch.Tensor]:
+    """
+    Returns the weights of the positive and negative literals, with shape `[batch, n_vars]`.
+    Log-weights are computed directly from the logits when working in log-space.
+
+    The positive weights of variables in categorical groups are the probabilities of their categories, given by a
+    softmax over the logits of the group, while their negative weights are not used by the circuit.
+
+    Args:
+        x: logits or probabilities, the first dimension is the batch
+        from_logits: whether `x` contains logits
+        log_space: whether to return log-weights
+        group_index: indices of the variables of each categorical group, see `group_tensors`
+        group_mask: mask of the indices in `group_index` that are not padding
+    """
+    # need to reshape as a 1d vector of variables for each sample, needed by psdd for the torch AC
+    x = x.reshape(x.size(0), -1)
+
+    if group_index is None or group_mask is None:
+        return _bernoulli_weights(x, from_logits, log_space)
+
+    categories = x[:, group_index]
+    if from_logits:
+        categories = categories.masked_fill(~group_mask, -float("inf"))
+        categories = F.log_softmax(categories, dim=-1) if log_space else F.softmax(categories, dim=-1)
+    elif log_space:
+        categories = torch.log(categories)
+
+    # grouped variables get placeholder bernoulli weights, then their positive weights are overwritten
+    grouped = group_index[group_mask]
+    positive, negative = _bernoulli_weights(
+        x.index_fill(1, grouped, 0.0 if from_logits else 0.5), from_logits, log_space
+    )
+    return positive.index_copy(1, grouped, categories[:, group_mask]), negative
+
+
+def apply_evidence(
+    positive: torch.Tensor,
+    negative: torch.Tensor,
+    evidence: torch.Tensor,
+    log_space: bool,
+    group_index: Optional[torch.Tensor] = None,
+    group_mask: Optional[torch.Tensor] = None,
+) -> Tuple[torch.Tensor, torch.Tensor]:
+    """
+    Returns the literal weights with the weights of the literals contradicting the evidence set to 0 (`-inf` in
+    log-space), so that the circuit computes the weighted model count of the constraint and the evidence.
+
+    Args:
+        positive: weights of the positive literals, with shape `[batch, n_vars]`
+        negative: weights of the negative literals, with shape `[batch, n_vars]`
+        evidence: value of each variable, 1 if true, 0 if false and -1 if unknown, with shape `[batch, ...]`
+        log_space: whether the weights are log-weights
+        group_index: indices of the variables of each categorical group, see `group_tensors`. A category is
+            excluded when it is false or when another category of its group is true.
+        group_mask: mask of the indices in `group_index` that are not padding
+    """
+    evidence = evidence.reshape(evidence.size(0), -1)
+    keep_positive = evidence != 0
+    keep_negative = evidence != 1
+
+    if group_index is not None and group_mask is not None:
+        true = (evidence == 1)[:, group_index] & group_mask
+        other_true = true.sum(dim=-1, keepdim=True) - true.long()
+        grouped = group_index[group_mask]
+        keep_positive = keep_positive.index_copy(
+            1, grouped, keep_positive[:, grouped] & (other_true == 0)[:, group_mask]
+        )
+
+    zero = -float("inf") if log_space else 0.0
+    return (
+        torch.where(keep_positive, positive, torch.full_like(positive, zero)),
+        torch.where(keep_negative, negative, torch.full_like(negative, zero)),
+    )
+
+
+def evidence_wmc(
+    positive: torch.Tensor,
+    negative: torch.Tensor,
+    log_space: bool,
+    group_index: Optional[torch.Tensor] = None,
+    group_mask: Optional[torch.Tensor] = None,
+) -> torch.Tensor:
+    """
+    Returns the weighted model count of the evidence alone (its logarithm in log-space), with shape `[batch]`,
+    from the weights of the literals of the variables of the circuit returned by `apply_evidence`.
+    Independent variables contribute the sum of their literal weights, categorical groups the sum of the weights
+    of their categories.
+    """
+    variables = torch.logaddexp(positive, negative) if log_space else positive + negative
+    if group_index is None or group_mask is None:
+        return variables.sum(dim=-1) if log_space else variables.prod(dim=-1)
+
+    grouped = group_index[group_mask]
+    if log_space:
+        categories = positive[:, group_index].masked_fill(~group_mask, -float("inf")).logsumexp(dim=-1)
+        return variables.index_fill(1, grouped, 0.0).sum(dim=-1) + categories.sum(dim=-1)
+    categories = positive[:, group_index].masked_fill(~group_mask, 0.0).sum(dim=-1)
+    return variables.index_fill(1, grouped, 1.0).prod(dim=-1) * categories.prod(dim=-1)
+
+
+def independent_weights(
+    positive: torch.Tensor, negative: torch.Tensor, var_count: int, log_space: bool
+) -> Tuple[torch.Tensor, torch.Tensor, torch.Tensor]:
+    """
+    Returns, for the variables after the first `var_count` ones, which are not in the circuit and therefore are
+    independent of the constraint, the log-weights of their positive and negative literals, with no gradient
+    where a weight is 0, and their probability of being true.
+    """
+    positive, negative = positive[:, var_count:], negative[:, var_count:]
+    if log_space:
+        return positive, negative, torch.exp(positive - torch.logaddexp(positive, negative))
+    probability = positive / (positive + negative)
+    return CompiledCircuit._safe_log(positive), CompiledCircuit._safe_log(negative), probability
+
+
+def _auxiliary_weights(
+    positive: torch.Tensor, negative: torch.Tensor, n_vars: int, auxiliary_vars: int, log_space: bool
+) -> Tuple[torch.Tensor, torch.Tensor]:
+    """
+    Returns the literal weights with the neutral weights (1, 0 in log-space) of `auxiliary_vars` auxiliary variables
+    inserted after the first `n_vars` variables.
+    """
+    neutral = positive.new_full((positive.size(0), auxiliary_vars), 0.0 if log_space else 1.0)
+    return (
+        torch.cat([positive[:, :n_vars], neutral, positive[:, n_vars:]], dim=1),
+        torch.cat([negative[:, :n_vars], neutral, negative[:, n_vars:]], dim=1),
+    )
+
+
+def _bernoulli_weights(x: torch.Tensor, from_logits: bool, log_space: bool) -> Tuple[torch.Tensor, torch.Tensor]:
+    """
+    Returns the weights of the positive and negative literals of independent variables, see `literal_weights`.
+    """
+    if from_logits:
+        if log_space:
+            return F.logsigmoid(x), F.logsigmoid(-x)
+        x = torch.sigmoid(x)
+
+    if log_space:
+        return torch.log(x), torch.log1p(-x)
+    return x, 1.0 - x
+
+
+def reduce_wmc(wmc_per_sample: torch.Tensor, log_space: bool) -> Tuple[torch.Tensor, torch.Tensor]:
+    """
+    Returns the loss and the average weighted model count (its logarithm in log-space) of a batch,
+    reducing the first dimension.
+    """
+    if log_space:
+        wmc = torch.logsumexp(wmc_per_sample, dim=0) - math.log(wmc_per_sample.size(0))
+        return -wmc, wmc
+
+    wmc = torch.mean(wmc_per_sample, dim=0)
+    return -torch.log(wmc), wmc
+
+
 class SemanticLoss(_Loss):
     """
     Module containing the semantic loss.
@@ -18,6 +208,24 @@ class SemanticLoss(_Loss):
     https://github.com/UCLA-StarAI/Semantic-Loss/blob/master/complex_constraints/compute_mpe.py,
     from the semantic loss paper, currently it's basically the same class except for names changed to my liking
     and different imports and comments.
+
+    The circuit is compiled once, when the loss is instantiated, into a level-scheduled tensor program
+    (see `CompiledCircuit`), so that each forward runs a fixed number of batched operations per circuit layer.
+    Set `compiled=False` to evaluate the circuit node by node with `generate_pt_ac_v2`, which is kept only as
+    a reference implementation.
+
+    With `log_space=True` the circuit is evaluated with log-probabilities from end to end, so that the weighted
+    model count does not underflow on deep circuits in single or half precision. In this mode `wmc` and
+    `wmc_per_sample` are returned as logarithms.
+
+    Variables can be grouped into categorical variables with `categorical_groups`: the network output of the
+    variables of a group is normalized with a softmax instead of a sigmoid, and exactly one variable of each group
+    is true without compiling this constraint into the SDD. The variables of each group must be exactly the
+    variables of a node of the vtree.
+
+    With `chunk_size` (or `max_memory`) the batch is streamed through the circuit in slices. The node values
+    of each slice are not kept for the backward pass but recomputed, so peak memory does not grow with the
+    batch size.
     """
 
     @staticmethod
@@ -33,60 +241,779 @@ class SemanticLoss(_Loss):
         assert os.path.isfile(vtree_file), f"{vtree_file} is not a file."
 
         # load vtree and sdd files and construct the PSDD
-        vtree = Vtree.read(vtree_file)
+        with profiling.timed("load.vtree_read"):
+            vtree = Vtree.read(vtree_file)
         manager = SddManager(vtree)
-        alpha = io.sdd_read(sdd_file, manager)
+        with profiling.timed("load.sdd_read"):
+            alpha = io.sdd_read(sdd_file, manager)
+        profiling.count_manager("load.sdd_read", manager)
+
         pmanager = PSddManager(vtree)
-        psdd = pmanager.copy_and_normalize_sdd(alpha, vtree)
+        with profiling.timed("load.normalize"):
+            psdd = pmanager.copy_and_normalize_sdd(alpha, vtree)
+        profiling.count_manager("load.normalize", pmanager)
 
         return psdd
 
-    def __init__(self, sdd_file: str, vtree_file: str, *args, **kwargs):
+    def __init__(
+        self,
+        sdd_file: str = None,
+        vtree_file: str = None,
+        *args,
+        psdd: PSddNode = None,
+        compiled: bool = True,
+        log_space: bool = False,
+        categorical_groups: Sequence[Sequence[int]] = None,
+        simplify: bool = True,
+        cache_dir: str = None,
+        chunk_size: int = None,
+        max_memory: int = None,
+        auxiliary_vars: int = 0,
+        **kwargs,
+    ):
+        """
+        Args:
+            sdd_file: Name of the `sdd` file to use.
+            vtree_file: Name of the `vtree` file to use.
+            psdd: normalized SDD of the constraint, for example built with `semantic_loss_pytorch.builders`,
+                to use instead of the `sdd` and `vtree` files
+            compiled: whether to evaluate the compiled circuit or the reference node-by-node implementation
+            log_space: whether to evaluate the circuit with log-probabilities
+            categorical_groups: groups of variables forming categorical variables, as indices of the flattened
+                network output, see `categorical_groups` to build them from the shape of the output
+            simplify: whether to remove the nodes that do not contribute to the weighted model count from the
+                compiled circuit, see `CompiledCircuit.simplify`
+            cache_dir: directory where compiled circuits are stored, keyed by the content of the `sdd` and
+                `vtree` files. When the circuit is found in the cache, the files are not parsed at all and
+                the PSDD is only loaded if `psdd` is accessed. The directory can be shared between processes.
+            chunk_size: maximum number of samples evaluated at once, the whole batch by default
+            max_memory: memory budget in bytes of the evaluation of each chunk, used to choose the chunk size
+                from the size of the circuit when `chunk_size` is not given
+            auxiliary_vars: number of auxiliary variables of the constraint, numbered after the variables of the
+                input, such as the ones introduced by the Tseitin encoding and the cardinality functions of
+                `constraints_to_cnf`. Their literals get neutral weights (1, 0 in log-space): since their value is
+                determined by the other variables, the weighted model count is the one of the constraint over the
+                input. They are not part of the outputs, and inputs have `auxiliary_vars` less variables
+        """
         super().__init__(*args, **kwargs)
-        # instantiate the psdd
-        self.psdd = self._import_psdd(sdd_file, vtree_file)
 
+        if (psdd is None) == (sdd_file is None or vtree_file is None):
+            raise ValueError("Either the sdd and vtree files or psdd must be provided")
+        if psdd is not None and cache_dir is not None:
+            raise ValueError("cache_dir is keyed by the sdd and vtree files, it cannot be used with psdd")
+        if chunk_size is not None and max_memory is not None:
+            raise ValueError("Only one between chunk_size and max_memory can be provided")
+        if chunk_size is not None and chunk_size < 1:
+            raise ValueError("chunk_size must be a positive integer")
+
+        self.sdd_file = sdd_file
+        self.vtree_file = vtree_file
+        self.compiled = compiled
+        self.log_space = log_space
+        self.chunk_size = chunk_size
+        self.max_memory = max_memory
+        self.auxiliary_vars = auxiliary_vars
+        self.categorical_groups = categorical_groups
+        self._psdd = psdd
+        self._register_groups(self, categorical_groups)
+
+        # compile the psdd to a tensor program, or load it from the cache
+        def compile_fn():
+            psdd = self.psdd
+            with profiling.timed("compile.linearize"):
+                arrays = CompiledCircuit.linearize(psdd, groups=categorical_groups)
+            if simplify:
+                with profiling.timed("compile.simplify"):
+                    arrays = CompiledCircuit.simplify(arrays)
+            return arrays
+
+        if cache_dir is None:
+            arrays = compile_fn()
+        else:
+            key = cache.cache_key(
+                sdd_file, vtree_file, simplify=simplify, categorical_groups=categorical_groups
+            )
+            arrays = cache.load_or_compile(cache_dir, key, compile_fn)
+        self.circuit = CompiledCircuit(arrays=arrays)
+
+        if not 0 <= auxiliary_vars <= self.circuit.var_count:
+            raise ValueError(
+                f"auxiliary_vars must be between 0 and the {self.circuit.var_count} variables of the circuit"
+            )
+
+    @staticmethod
+    def _register_groups(module: torch.nn.Module, groups: Optional[Sequence[Sequence[int]]]):
+        """
+        Register the `group_index` and `group_mask` buffers of the categorical groups on `module`, see `group_tensors`.
+        """
+        group_index, group_mask = group_tensors(groups) if groups else (None, None)
+        module.register_buffer("group_index", group_index, persistent=False)
+        module.register_buffer("group_mask", group_mask, persistent=False)
+
+    @property
+    def psdd(self):
+        """
+        The normalized PSDD of the constraint, loaded on first access.
+        """
+        if self._psdd is None:
+            self._psdd = self._import_psdd(self.sdd_file, self.vtree_file)
+        return self._psdd
+
+    @property
+    def _input_var_count(self) -> int:
+        """
+        Number of variables of the circuit that are variables of the input, that is without the auxiliary variables.
+        """
+        return self.circuit.var_count - self.auxiliary_vars
+
+    def _weights(
+        self, logits: torch.Tensor = None, probabilities: torch.Tensor = None, evidence: torch.Tensor = None
+    ) -> Tuple[torch.Tensor, torch.Tensor]:
+        """
+        Returns the weights of the positive and negative literals of the input, with shape `[batch, n_vars]`,
+        where the evidence, if any, has been applied, followed by the ones of the auxiliary variables, if any.
+        """
+        if (logits is None) == (probabilities is None):
+            raise ValueError("Only logits or probabilities can be provided, neither both nor none")
+
+        x = logits if logits is not None else probabilities
+        positive, negative = literal_weights(
+            x,
+            from_logits=logits is not None,
+            log_space=self.log_space,
+            group_index=self.group_index,
+            group_mask=self.group_mask,
+        )
+        if evidence is not None:
+            positive, negative = apply_evidence(
+                positive, negative, evidence, self.log_space, group_index=self.group_index, group_mask=self.group_mask
+            )
+        if self.auxiliary_vars:
+            positive, negative = _auxiliary_weights(
+                positive, negative, self._input_var_count, self.auxiliary_vars, self.log_space
+            )
+        return positive, negative
+
+    def _wmc_per_sample(self, positive: torch.Tensor, negative: torch.Tensor) -> torch.Tensor:
+        """
+        Returns the weighted model count (its logarithm in log-space) of each sample, with shape `[batch]`.
+        """
+        if self.compiled:
+            profiling.count_circuit(self.circuit)
+            return self.circuit(positive, negative, log_space=self.log_space)[:, 0]
+        elif self.categorical_groups:
+            raise ValueError("Categorical groups are only supported by the compiled circuit")
+
+        profiling.count_psdd(self.psdd)
+        if self.log_space:
+            return torch.log(self.psdd.generate_pt_ac_v2(positive.exp()))
+        else:
+            return self.psdd.generate_pt_ac_v2(positive)
+
+    def _wmc_and_entropy_per_sample(self, positive: torch.Tensor, negative: torch.Tensor) -> torch.Tensor:
+        """
+        Returns the weighted model count (its logarithm in log-space) and the entropy of the constrained
+        distribution of each sample, computed in the same walk over the circuit, stacked with shape `[batch, 2]`.
+        """
+        profiling.count_circuit(self.circuit)
+        wmc, entropy = self.circuit.wmc_and_entropy(positive, negative, log_space=self.log_space)
+        return torch.stack([wmc[:, 0], entropy[:, 0]], dim=1)
+
+    def _chunked_wmc_per_sample(
+        self, positive: torch.Tensor, negative: torch.Tensor, output_entropy: bool = False
+    ) -> torch.Tensor:
+        """
+        Same as `_wmc_per_sample` (or `_wmc_and_entropy_per_sample` with `output_entropy`), but evaluating
+        at most `chunk_size` samples at once.
+        Each chunk is checkpointed, so that only its inputs are stored for the backward pass.
+        """
+        per_sample = self._wmc_and_entropy_per_sample if output_entropy else self._wmc_per_sample
+        chunk_size = self.chunk_size
+        if chunk_size is None and self.max_memory is not None:
+            chunk_size = self.circuit.chunk_size(self.max_memory, dtype=positive.dtype)
+
+        if chunk_size is None or positive.size(0) <= chunk_size:
+            return per_sample(positive, negative)
+
+        return torch.cat([
+            checkpoint(per_sample, positive_chunk, negative_chunk, use_reentrant=False)
+            for positive_chunk, negative_chunk in zip(positive.split(chunk_size), negative.split(chunk_size))
+        ])
+
+    def _condition_on_evidence(
+        self, wmc_per_sample: torch.Tensor, positive: torch.Tensor, negative: torch.Tensor
+    ) -> torch.Tensor:
+        """
+        Divide the weighted model count of each sample by the one of its evidence, see `evidence_wmc`.
+        """
+        var_count = self._input_var_count
+        normalizer = evidence_wmc(
+            positive[:, :var_count],
+            negative[:, :var_count],
+            self.log_space,
+            group_index=self.group_index,
+            group_mask=self.group_mask,
+        )
+        return wmc_per_sample - normalizer if self.log_space else wmc_per_sample / normalizer
+
+    def marginals(
+        self,
+        logits: torch.FloatTensor = None,
+        probabilities: torch.FloatTensor = None,
+        evidence: torch.Tensor = None,
+    ) -> torch.FloatTensor:
+        """
+        Returns the probability of each variable being true given the constraint (and the evidence), for each sample.
+        The marginals of all the variables are computed with one upward and one downward sweep over the compiled
+        circuit, and they are differentiable, so that they can be used as a constrained output layer.
+
+        Args:
+            logits: input tensor that will be interpreted as logits
+            probabilities: input tensor that will be interpreted as probabilities
+            evidence: known values of the variables of each sample, see `forward`
+
+        Returns:
+            the constrained marginals, with shape `[batch, n_vars]` where `n_vars` is the number of variables
+            in each sample of the input. Variables not in the constraint keep their unconstrained probability.
+        """
+        positive, negative = self._weights(logits=logits, probabilities=probabilities, evidence=evidence)
+
+        marginals = self.circuit.marginals(positive, negative, log_space=self.log_space)[:, :self._input_var_count]
+
+        _, _, independent = independent_weights(positive, negative, self.circuit.var_count, self.log_space)
+        return torch.cat([marginals, independent], dim=1)
+
+    def mpe(
+        self,
+        logits: torch.FloatTensor = None,
+        probabilities: torch.FloatTensor = None,
+        evidence: torch.Tensor = None,
+    ) -> Tuple[torch.Tensor, torch.FloatTensor]:
+        """
+        Returns the most probable assignment satisfying the constraint (and the evidence) for each sample,
+        decoded with one max-product pass over the compiled circuit for the whole batch.
+
+        Args:
+            logits: input tensor that will be interpreted as logits
+            probabilities: input tensor that will be interpreted as probabilities
+            evidence: known values of the variables of each sample, see `forward`
+
+        Returns:
+            the `[batch, n_vars]` 0/1 tensor of the most probable assignments, where variables not in the
+            constraint take their most probable value, and the `[batch]` tensor of their log-probabilities
+            (`-inf` when no assignment satisfies the constraint and the evidence)
+        """
+        positive, negative = self._weights(logits=logits, probabilities=probabilities, evidence=evidence)
+
+        assignment, log_probability = self.circuit.mpe(positive, negative, log_space=self.log_space)
+        assignment = assignment[:, :self._input_var_count]
+
+        positive, negative, _ = independent_weights(
+            positive.detach(), negative.detach(), self.circuit.var_count, self.log_space
+        )
+        independent = positive >= negative
+        log_probability = log_probability + torch.maximum(positive, negative).sum(dim=-1)
+        return torch.cat([assignment, independent.long()], dim=1), log_probability
+
+    def top_k(
+        self,
+        k: int,
+        logits: torch.FloatTensor = None,
+        probabilities: torch.FloatTensor = None,
+        evidence: torch.Tensor = None,
+    ) -> Tuple[torch.Tensor, torch.FloatTensor]:
+        """
+        Returns the `k` most probable assignments satisfying the constraint (and the evidence) for each sample,
+        decoded with one k-best max-product pass over the compiled circuit for the whole batch.
+
+        Args:
+            k: number of assignments returned for each sample
+            logits: input tensor that will be interpreted as logits
+            probabilities: input tensor that will be interpreted as probabilities
+            evidence: known values of the variables of each sample, see `forward`
+
+        Returns:
+            the `[batch, k, n_vars]` 0/1 tensor of the assignments, sorted by decreasing probability, and the
+            `[batch, k]` tensor of their log-probabilities. Variables not in the constraint take their most
+            probable value in all the assignments. When less than `k` assignments satisfy the constraint and
+            the evidence, the remaining ones have log-probability `-inf`.
+        """
+        positive, negative = self._weights(logits=logits, probabilities=probabilities, evidence=evidence)
+
+        assignments, log_probability = self.circuit.top_k(positive, negative, k, log_space=self.log_space)
+        assignments = assignments[:, :, :self._input_var_count]
+
+        positive, negative, _ = independent_weights(
+            positive.detach(), negative.detach(), self.circuit.var_count, self.log_space
+        )
+        independent = (positive >= negative).long().unsqueeze(1).expand(-1, k, -1)
+        log_probability = log_probability + torch.maximum(positive, negative).sum(dim=-1, keepdim=True)
+        return torch.cat([assignments, independent], dim=2), log_probability
+
+    def sample(
+        self,
+        logits: torch.FloatTensor = None,
+        probabilities: torch.FloatTensor = None,
+        n_samples: int = 1,
+        evidence: torch.Tensor = None,
+        generator: torch.Generator = None,
+    ) -> torch.Tensor:
+        """
+        Draws exact samples of the assignments satisfying the constraint (and the evidence) from the distribution
+        given by the input, conditioned on the constraint. All the samples of the batch are drawn with one upward
+        and one downward pass over the compiled circuit.
+
+        Args:
+            logits: input tensor that will be interpreted as logits
+            probabilities: input tensor that will be interpreted as probabilities
+            n_samples: number of samples drawn for each sample of the input
+            evidence: known values of the variables of each sample, see `forward`
+            generator: random number generator used to draw the samples, for reproducibility
+
+        Returns:
+            the `[batch, n_samples, n_vars]` 0/1 tensor of the samples, where variables not in the constraint
+            are drawn independently
+        """
+        positive, negative = self._weights(logits=logits, probabilities=probabilities, evidence=evidence)
+
+        samples = self.circuit.sample(
+            positive, negative, n_samples=n_samples, log_space=self.log_space, generator=generator
+        )[:, :, :self._input_var_count]
+
+        _, _, probability = independent_weights(
+            positive.detach(), negative.detach(), self.circuit.var_count, self.log_space
+        )
+        uniform = probability.new_empty(probability.size(0), n_samples, probability.size(1)).uniform_(
+            generator=generator
+        )
+        independent = uniform < probability.unsqueeze(1)
+        return torch.cat([samples, independent.long()], dim=2)
+
+    def scriptable(self) -> "ScriptableSemanticLoss":
+        """
+        Returns a variant of this loss that can be scripted with `torch.jit.script`, see `ScriptableSemanticLoss`.
+        The compiled circuit is shared with this loss.
+        """
+        if self.auxiliary_vars:
+            raise ValueError("Auxiliary variables are not supported by ScriptableSemanticLoss")
+        return ScriptableSemanticLoss(
+            self.circuit, log_space=self.log_space, categorical_groups=self.categorical_groups
+        )
+
+    def scorer(self, from_logits: bool = True, marginals: bool = True) -> "CircuitScorer":
+        """
+        Returns a module computing the weighted model count and the constrained marginals of each sample without
+        autograd, see `CircuitScorer`. The compiled circuit is shared with this loss.
+        """
+        if self.auxiliary_vars:
+            raise ValueError("Auxiliary variables are not supported by CircuitScorer")
+        return CircuitScorer(
+            self.circuit,
+            log_space=self.log_space,
+            from_logits=from_logits,
+            categorical_groups=self.categorical_groups,
+            marginals=marginals,
+        )
+
+    def export_onnx(
+        self, filename: str, n_vars: int = None, from_logits: bool = True, marginals: bool = True, **kwargs
+    ):
+        """
+        Exports the scoring of network outputs with the constraint to an ONNX model, see `CircuitScorer.export_onnx`.
+
+        Args:
+            filename: path of the `.onnx` file to write
+            n_vars: number of variables of each sample of the input, the variables of the constraint by default
+            from_logits: whether the input of the model are logits or probabilities
+            marginals: whether the model also outputs the constrained marginals
+            kwargs: additional arguments of `torch.onnx.export`
+        """
+        self.scorer(from_logits=from_logits, marginals=marginals).export_onnx(filename, n_vars=n_vars, **kwargs)
+
+    @profiling.profiled_forward
     def forward(
         self,
         logits: torch.FloatTensor = None,
         probabilities: torch.FloatTensor = None,
         output_wmc: bool = False,
-        output_wmc_per_sample: bool = False
+        output_wmc_per_sample: bool = False,
+        evidence: torch.Tensor = None,
+        conditional: bool = False,
+        output_entropy: bool = False,
     ) -> torch.FloatTensor:
         """
         Returns the semantic loss related to the instance of this class, using the `x` input.
-        If input are logits, the sigmoid function is applied to the input.
+        If input are logits, the sigmoid function is applied to the input (or the log-sigmoid in log-space).
         
         Args:
             logits: input tensor that will be interpreted as logits
                 (a sigmoid activation function will turn them in probabilities)
             probabilities: input tensor that will be interpreted as probabilities
-            output_wmc: whether to output weighted model counts
+            output_wmc: whether to output weighted model counts (their logarithm in log-space)
             output_wmc_per_sample: whether to output weighted model counts for each sample in the batch
+                (their logarithm in log-space)
+            evidence: known values of the variables of each sample, with the same shape of the input: 1 if the
+                variable is true, 0 if it is false and -1 if it is unknown. The weighted model count is computed
+                over the assignments consistent with the evidence
+            conditional: whether to divide the weighted model count by the one of the evidence alone, that is to
+                compute the probability of the constraint given the evidence
+            output_entropy: whether to output the entropy (in nats) of the distribution of each sample conditioned
+                on the constraint (and the evidence), computed in the same walk over the circuit as the weighted
+                model count. Gradients of the whole walk are then computed by autograd
 
         Returns:
             the weighted model count for the input tensor logits or probabilites with respect to the psdd
         """
 
-        if (logits is None) == (probabilities is None):
-            raise ValueError("Only logits or probabilities can be provided, neither both nor none")
+        if evidence is not None and not self.compiled:
+            raise ValueError("Evidence is only supported by the compiled circuit")
+        if output_entropy and not self.compiled:
+            raise ValueError("Entropy is only supported by the compiled circuit")
+
+        positive, negative = self._weights(logits=logits, probabilities=probabilities, evidence=evidence)
+
+        if output_entropy:
+            wmc_per_sample, entropy = self._chunked_wmc_per_sample(positive, negative, output_entropy=True).unbind(1)
+            positive_rest, negative_rest, _ = independent_weights(
+                positive, negative, self.circuit.var_count, self.log_space
+            )
+            entropy = entropy + CompiledCircuit.bernoulli_entropy(positive_rest, negative_rest, log_space=True).sum(-1)
+        else:
+            wmc_per_sample = self._chunked_wmc_per_sample(positive, negative)
+        if conditional:
+            wmc_per_sample = self._condition_on_evidence(wmc_per_sample, positive, negative)
+        loss, wmc = reduce_wmc(wmc_per_sample, log_space=self.log_space)
+
+        outputs = (loss,)
+        if output_wmc:
+            outputs = outputs + (wmc,)
+        if output_wmc_per_sample:
+            outputs = outputs + (wmc_per_sample,)
+        if output_entropy:
+            outputs = outputs + (entropy,)
+        
+        return outputs if len(outputs) > 1 else outputs[0]
+
+
+class ScriptableSemanticLoss(torch.nn.Module):
+    """
+    Semantic loss over a compiled circuit, with static control flow and a fixed output signature.
+    The circuit lives entirely in the registered buffers of the `CompiledCircuit`, so this module can be
+    scripted with `torch.jit.script`, saved in TorchScript artifacts or compiled with `torch.compile`.
+    Use `SemanticLoss.scriptable()` to build it from a loaded constraint.
+    """
 
-        # set logits to probabilities
+    def __init__(
+        self, circuit: CompiledCircuit, log_space: bool = False, categorical_groups: Sequence[Sequence[int]] = None
+    ):
+        super().__init__()
+        self.circuit = circuit
+        self.log_space = log_space
+        SemanticLoss._register_groups(self, categorical_groups)
+
+    def forward(
+        self,
+        logits: Optional[torch.Tensor] = None,
+        probabilities: Optional[torch.Tensor] = None,
+        evidence: Optional[torch.Tensor] = None,
+        conditional: bool = False,
+    ) -> Tuple[torch.Tensor, torch.Tensor, torch.Tensor]:
+        """
+        Returns the semantic loss, the weighted model count and the weighted model count of each sample.
+        See `SemanticLoss.forward`.
+        """
         if logits is not None:
-            probabilities = torch.sigmoid(logits)
+            if probabilities is not None:
+                raise ValueError("Only logits or probabilities can be provided, neither both nor none")
+            positive, negative = literal_weights(
+                logits, True, self.log_space, group_index=self.group_index, group_mask=self.group_mask
+            )
+        elif probabilities is not None:
+            positive, negative = literal_weights(
+                probabilities, False, self.log_space, group_index=self.group_index, group_mask=self.group_mask
+            )
+        else:
+            raise ValueError("Only logits or probabilities can be provided, neither both nor none")
 
-        # need to reshape as a 1d vector of variables for each sample, needed by psdd for the torch AC
-        batch_size = probabilities.size(-1)
-        probs_as_vector = probabilities.reshape(batch_size, -1)
+        if evidence is not None:
+            positive, negative = apply_evidence(
+                positive, negative, evidence, self.log_space, group_index=self.group_index, group_mask=self.group_mask
+            )
 
-        wmc_per_sample = self.psdd.generate_pt_ac_v2(probs_as_vector)
-        wmc = torch.mean(wmc_per_sample)
-        loss = -torch.log(wmc)
+        wmc_per_sample = self.circuit(positive, negative, log_space=self.log_space)[:, 0]
+        if conditional:
+            var_count = self.circuit.var_count
+            normalizer = evidence_wmc(
+                positive[:, :var_count],
+                negative[:, :var_count],
+                self.log_space,
+                group_index=self.group_index,
+                group_mask=self.group_mask,
+            )
+            wmc_per_sample = wmc_per_sample - normalizer if self.log_space else wmc_per_sample / normalizer
+
+        loss, wmc = reduce_wmc(wmc_per_sample, log_space=self.log_space)
+        return loss, wmc, wmc_per_sample
+
+
+class CircuitScorer(torch.nn.Module):
+    """
+    Weighted model count of the roots of a compiled circuit and constrained marginals of the variables, computed
+    without autograd: one upward sweep over the circuit and, for the marginals, one analytic downward sweep
+    (see `CompiledCircuit.downward`). Each layer of the circuit is a fixed number of gathers, products and segment
+    sums over the index buffers of the circuit, so the module can be exported to ONNX (see `export_onnx`), where
+    the buffers become initializers and the size of the graph grows with the depth of the circuit, not with its
+    number of nodes.
+    Use `SemanticLoss.scorer()` or `MultiConstraintSemanticLoss.scorer()` to build it from a loaded constraint.
+    """
+
+    def __init__(
+        self,
+        circuit: CompiledCircuit,
+        log_space: bool = False,
+        from_logits: bool = True,
+        categorical_groups: Sequence[Sequence[int]] = None,
+        marginals: bool = True,
+    ):
+        super().__init__()
+        self.circuit = circuit
+        self.log_space = log_space
+        self.from_logits = from_logits
+        self.marginals = marginals
+        SemanticLoss._register_groups(self, categorical_groups)
+
+    def forward(self, x: torch.Tensor):
+        """
+        Args:
+            x: logits or probabilities (see `from_logits`), the first dimension is the batch
+
+        Returns:
+            the weighted model count (its logarithm in log-space) of each sample and root, with shape
+            `[batch, n_roots]`, and, if `marginals`, the probability of each variable being true given the first
+            root, with shape `[batch, n_vars]`, as returned by `SemanticLoss.marginals`
+        """
+        positive, negative = literal_weights(
+            x, self.from_logits, self.log_space, group_index=self.group_index, group_mask=self.group_mask
+        )
+        circuit = self.circuit
+        table = circuit.literal_table(positive, negative, log_space=self.log_space)
+        values = circuit.upward(table, log_space=self.log_space)
+        wmc = values.index_select(0, circuit.roots).t()
+        if not self.marginals:
+            return wmc
+
+        # derivative of the first root (of its logarithm, in log-space) with respect to every row of the table
+        root_grad = torch.zeros_like(wmc)
+        root_grad[:, 0] = 1.0
+        leaves = circuit.downward(values, root_grad, log_space=self.log_space)[:circuit.node_ptr[1]]
+        grads = leaves.new_zeros(table.shape).index_add_(0, circuit.leaf_index, leaves)
+
+        # the positive weight of a variable is used by its positive literal and by its `true` row
+        var_count = circuit.var_count
+        positive_grad, true_grad = grads[:var_count].t(), grads[2 * var_count:3 * var_count].t()
+        _, _, independent = independent_weights(positive, negative, var_count, self.log_space)
+        positive, negative = positive[:, :var_count], negative[:, :var_count]
+        if self.log_space:
+            marginals = positive_grad + true_grad * torch.exp(positive - torch.logaddexp(positive, negative))
+        else:
+            marginals = positive * (positive_grad + true_grad) / wmc[:, :1]
+        return wmc, torch.cat([marginals, independent], dim=1)
+
+    def export_onnx(self, filename: str, n_vars: int = None, **kwargs):
+        """
+        Exports this module to an ONNX model with a dynamic batch size, through `torch.onnx.export`, which needs
+        the `onnx` and `onnxscript` packages.
+        The model takes the `logits` (or `probabilities`) input with shape `[batch, n_vars]`, and returns the
+        `wmc` output (`log_wmc` in log-space) and, if `marginals`, the `marginals` output, see `forward`.
+
+        Args:
+            filename: path of the `.onnx` file to write
+            n_vars: number of variables of each sample of the input, the variables of the circuit by default
+            kwargs: additional arguments of `torch.onnx.export`
+        """
+        n_vars = self.circuit.var_count if n_vars is None else n_vars
+        if n_vars < self.circuit.var_count:
+            raise ValueError(f"The circuit is defined over {self.circuit.var_count} variables, got {n_vars}")
+
+        example = torch.rand(2, n_vars)
+        input_name = "logits" if self.from_logits else "probabilities"
+        output_names = ["log_wmc" if self.log_space else "wmc"] + (["marginals"] if self.marginals else [])
+        kwargs.setdefault("opset_version", 18)
+        torch.onnx.export(
+            self,
+            (example,),
+            filename,
+            input_names=[input_name],
+            output_names=output_names,
+            dynamic_shapes=({0: torch.export.Dim("batch")},),
+            dynamo=True,
+            **kwargs,
+        )
+
+
+class MultiConstraintSemanticLoss(_Loss):
+    """
+    Semantic loss of several independent constraints applied to the same network output.
+    All the constraints are compiled into a single circuit and evaluated in one pass: SDDs defined over the
+    same vtree are loaded in the same manager, so that structurally identical nodes are shared through its
+    unique table and evaluated only once.
+    The loss is the weighted sum of the semantic losses of the constraints.
+    """
+
+    @staticmethod
+    def _import_psdds(sdd_files: Sequence[str], vtree_files: Sequence[str]) -> List[PSddNode]:
+        """
+        Load the PSDD of each pair of `sdd` and `vtree` files, using one manager for each distinct vtree.
+        :param sdd_files: Names of the `sdd` files to use.
+        :param vtree_files: Names of the `vtree` files to use, one for each `sdd` file.
+        """
+        managers = {}
+        psdds = []
+        for sdd_file, vtree_file in zip(sdd_files, vtree_files):
+            assert os.path.isfile(sdd_file), f"{sdd_file} is not a file."
+            assert os.path.isfile(vtree_file), f"{vtree_file} is not a file."
+
+            # vtrees are identified by their content, so that copies of the same file share the manager
+            vtree_key = cache.cache_key(vtree_file)
+            if vtree_key not in managers:
+                with profiling.timed("load.vtree_read"):
+                    vtree = Vtree.read(vtree_file)
+                managers[vtree_key] = (vtree, SddManager(vtree), PSddManager(vtree), {}, {})
+            vtree, manager, pmanager, manager_counts, pmanager_counts = managers[vtree_key]
+
+            with profiling.timed("load.sdd_read"):
+                alpha = io.sdd_read(sdd_file, manager)
+            manager_counts.update(profiling.count_manager("load.sdd_read", manager, manager_counts))
+            with profiling.timed("load.normalize"):
+                psdds.append(pmanager.copy_and_normalize_sdd(alpha, vtree))
+            pmanager_counts.update(profiling.count_manager("load.normalize", pmanager, pmanager_counts))
+
+        return psdds
+
+    def __init__(
+        self,
+        sdd_files: Sequence[str],
+        vtree_files: Sequence[str],
+        *args,
+        weights: Sequence[float] = None,
+        log_space: bool = False,
+        categorical_groups: Sequence[Sequence[int]] = None,
+        simplify: bool = True,
+        cache_dir: str = None,
+        **kwargs,
+    ):
+        """
+        Args:
+            sdd_files: Names of the `sdd` files to use, one for each constraint.
+            vtree_files: Names of the `vtree` files to use, one for each constraint.
+            weights: weight of the loss of each constraint, all constraints have weight 1 by default
+            log_space: whether to evaluate the circuit with log-probabilities
+            categorical_groups: groups of variables forming categorical variables, see `SemanticLoss`
+            simplify: whether to simplify the compiled circuit, see `SemanticLoss`
+            cache_dir: directory where compiled circuits are stored, see `SemanticLoss`
+        """
+        super().__init__(*args, **kwargs)
+
+        if len(sdd_files) != len(vtree_files):
+            raise ValueError("There must be a vtree file for each sdd file")
+        if weights is None:
+            weights = [1.0] * len(sdd_files)
+        if len(weights) != len(sdd_files):
+            raise ValueError("There must be a weight for each constraint")
+
+        self.sdd_files = list(sdd_files)
+        self.vtree_files = list(vtree_files)
+        self.log_space = log_space
+        self.register_buffer("weights", torch.tensor(weights, dtype=torch.float), persistent=False)
+        SemanticLoss._register_groups(self, categorical_groups)
+
+        def compile_fn():
+            psdds = self._import_psdds(self.sdd_files, self.vtree_files)
+            with profiling.timed("compile.linearize"):
+                arrays = CompiledCircuit.linearize(psdds, groups=categorical_groups)
+            if simplify:
+                with profiling.timed("compile.simplify"):
+                    arrays = CompiledCircuit.simplify(arrays)
+            return arrays
+
+        if cache_dir is None:
+            arrays = compile_fn()
+        else:
+            key = cache.cache_key(
+                *self.sdd_files,
+                *self.vtree_files,
+                n_constraints=len(self.sdd_files),
+                simplify=simplify,
+                categorical_groups=categorical_groups,
+            )
+            arrays = cache.load_or_compile(cache_dir, key, compile_fn)
+        self.circuit = CompiledCircuit(arrays=arrays)
+        self.categorical_groups = categorical_groups
+
+    def scorer(self, from_logits: bool = True, marginals: bool = True) -> CircuitScorer:
+        """
+        Returns a module computing the weighted model count of each constraint and sample without autograd, see
+        `CircuitScorer`. The marginals are the ones given the first constraint.
+        """
+        return CircuitScorer(
+            self.circuit,
+            log_space=self.log_space,
+            from_logits=from_logits,
+            categorical_groups=self.categorical_groups,
+            marginals=marginals,
+        )
+
+    def export_onnx(
+        self, filename: str, n_vars: int = None, from_logits: bool = True, marginals: bool = True, **kwargs
+    ):
+        """
+        Exports the scoring of network outputs with the constraints to an ONNX model, see `SemanticLoss.export_onnx`.
+        """
+        self.scorer(from_logits=from_logits, marginals=marginals).export_onnx(filename, n_vars=n_vars, **kwargs)
+
+    @profiling.profiled_forward
+    def forward(
+        self,
+        logits: torch.FloatTensor = None,
+        probabilities: torch.FloatTensor = None,
+        output_wmc: bool = False,
+        output_wmc_per_sample: bool = False
+    ) -> torch.FloatTensor:
+        """
+        Returns the weighted sum of the semantic losses of the constraints, see `SemanticLoss.forward`.
+
+        Args:
+            logits: input tensor that will be interpreted as logits
+            probabilities: input tensor that will be interpreted as probabilities
+            output_wmc: whether to output the weighted model count of each constraint, with shape `[n_constraints]`
+            output_wmc_per_sample: whether to output the weighted model count of each constraint for each sample
+                in the batch, with shape `[batch, n_constraints]`
+
+        Returns:
+            the weighted sum of the semantic losses of the constraints
+        """
+
+        if (logits is None) == (probabilities is None):
+            raise ValueError("Only logits or probabilities can be provided, neither both nor none")
+
+        x = logits if logits is not None else probabilities
+        positive, negative = literal_weights(
+            x,
+            from_logits=logits is not None,
+            log_space=self.log_space,
+            group_index=self.group_index,
+            group_mask=self.group_mask,
+        )
+
+        profiling.count_circuit(self.circuit)
+        wmc_per_sample = self.circuit(positive, negative, log_space=self.log_space)
+        losses, wmc = reduce_wmc(wmc_per_sample, log_space=self.log_space)
+        loss = torch.sum(self.weights.to(losses.dtype) * losses)
 
         outputs = (loss,)
         if output_wmc:
             outputs = outputs + (wmc,)
         if output_wmc_per_sample:
             outputs = outputs + (wmc_per_sample,)
-        
+
         return outputs if len(outputs) > 1 else outputs[0]
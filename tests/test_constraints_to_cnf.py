@@ -7,17 +7,20 @@ TODO: operators that go recursively when doing test_output_equivalence_iteration
 TODO: operators using N > 2 arguments when doing test_output_equivalence_iterations
 """
 
+import itertools
 import os
 import random
 import shutil
 import pytest
 
 import numpy as np
-from sympy import to_cnf
+from sympy import Equivalent, Symbol, satisfiable, to_cnf
 from sympy.logic.utilities.dimacs import load_file
 from sympy.parsing.sympy_parser import parse_expr
 
 # add parent directory so we can import the module
+from semantic_loss_pytorch.constraints_parser import ConstraintsParser
+from semantic_loss_pytorch import constraints_to_cnf
 from semantic_loss_pytorch.constraints_to_cnf import ConstraintsToCnf
 
 
@@ -434,6 +437,100 @@ class TestOutput:
         assert input_parsed_by_sympy.equals(output_parsed_by_sympy)
         assert to_cnf(input_parsed_by_sympy).equals(output_parsed_by_sympy)
 
+    def test_output_processes(self):
+        string = "shape [30]\n"
+        for i in range(0, 28):
+            string += "(X%s & X%s) | Xor(X%s, X%s)\n" % (i, i + 1, i + 1, i + 2)
+        string += "X0 | X1\n"
+        string += "X1 | X0\n"
+        inputfilepath = to_file_in_tmp(string, self.test_output_processes)
+
+        outputs = []
+        for nprocesses in (1, 3):
+            outputfilepath = os.path.join(TEMPORARY_DIR, "processes%s.txt" % nprocesses)
+            toDIMACS(inputfilepath, outputfilepath, nprocesses=nprocesses)
+            with open(outputfilepath, "r") as outputfile:
+                outputs.append([s for s in outputfile.read().split("\n") if s != "" and s[0] != "c"])
+        assert outputs[0] == outputs[1]
+        # 4 clauses for each of the first constraints, and the last two are the same clause
+        assert outputs[0][0] == "p cnf 30 113"
+
+    def test_output_false(self):
+        string = "shape [4]\n"
+        string += "X0 | X1\n"
+        string += "X2 & False\n"
+        inputfilepath = to_file_in_tmp(string, self.test_output_false)
+        outputfilepath = os.path.join(TEMPORARY_DIR, "false.txt")
+
+        toDIMACS(inputfilepath, outputfilepath)
+
+        with open(outputfilepath, "r") as outputfile:
+            string = [s for s in outputfile.read().split("\n") if s != "" and s[0] != "c"]
+            assert string == ["p cnf 4 1", "False 0"]
+
+    def test_output_chunks(self, monkeypatch):
+        string = "shape [10,10]\n"
+        for i in range(10):
+            string += "X%s.0 | X%s.1 | ~X%s.%s\n" % (i, i, (i + 1) % 10, i)
+        inputfilepath = to_file_in_tmp(string, self.test_output_chunks)
+
+        outputs = []
+        for chunk_size in (1 << 16, 3):
+            monkeypatch.setattr(constraints_to_cnf, "DIMACS_CHUNK_SIZE", chunk_size)
+            for parser in ("native", "sympy"):
+                outputfilepath = os.path.join(TEMPORARY_DIR, "chunks_%s_%s.txt" % (chunk_size, parser))
+                toDIMACS(inputfilepath, outputfilepath, parser=parser)
+                with open(outputfilepath, "r") as outputfile:
+                    outputs.append(outputfile.read())
+        assert "p cnf 100 10\n" in outputs[0]
+        assert "1 2 -11 0\n" in outputs[0]
+        assert all(output == outputs[0] for output in outputs)
+
+    def test_output_streaming(self, monkeypatch):
+        string = "shape [10,10]\n"
+        for i in range(10):
+            string += "X%s.0 | X%s.1\n" % (i, i)
+            string += "ExactlyOne(X%s.2, X%s.3, X%s.4)\n" % (i, i, i)
+        # duplicated in an other chunk
+        string += "X0.1 | X0.0\n"
+        inputfilepath = to_file_in_tmp(string, self.test_output_streaming)
+
+        outputs = []
+        for chunk_size, nprocesses in ((1 << 10, 1), (1, 1), (3, 2)):
+            monkeypatch.setattr(constraints_to_cnf, "CONSTRAINTS_CHUNK_SIZE", chunk_size)
+            outputfilepath = os.path.join(TEMPORARY_DIR, "streaming_%s_%s.txt" % (chunk_size, nprocesses))
+            toDIMACS(inputfilepath, outputfilepath, nprocesses=nprocesses)
+            with open(outputfilepath, "r") as outputfile:
+                outputs.append([s for s in outputfile.read().split("\n") if s != "" and s[0] not in "cp"])
+        # duplicates are only removed within a chunk
+        assert [output.count("1 2 0") for output in outputs] == [1, 2, 2]
+        assert all(set(output) == set(outputs[0]) for output in outputs)
+
+        # a False constraint in the last chunk discards the clauses already written
+        with open(inputfilepath, "a") as inputfile:
+            inputfile.write("X9.9 & False\n")
+        toDIMACS(inputfilepath, outputfilepath, nprocesses=2)
+        with open(outputfilepath, "r") as outputfile:
+            string = [s for s in outputfile.read().split("\n") if s != "" and s[0] != "c"]
+            assert string == ["p cnf 100 1", "False 0"]
+
+    def test_output_sympy_processes(self, monkeypatch):
+        string = "shape [6,6]\n"
+        for i in range(6):
+            string += "Equivalent(X%s.0, X%s.1 | X%s.2) | (X%s.3 & X%s.4)\n" % (i, i, i, (i + 1) % 6, i)
+        inputfilepath = to_file_in_tmp(string, self.test_output_sympy_processes)
+
+        # the constraints parsed by sympy are also converted to cnf one at a time in the processes
+        outputs = []
+        for chunk_size, nprocesses, parser in ((1 << 10, 1, "native"), (1 << 10, 1, "sympy"), (2, 3, "sympy")):
+            monkeypatch.setattr(constraints_to_cnf, "CONSTRAINTS_CHUNK_SIZE", chunk_size)
+            outputfilepath = os.path.join(TEMPORARY_DIR, "sympy_processes_%s_%s.txt" % (nprocesses, parser))
+            toDIMACS(inputfilepath, outputfilepath, nprocesses=nprocesses, parser=parser)
+            with open(outputfilepath, "r") as outputfile:
+                outputs.append([s for s in outputfile.read().split("\n") if s != "" and s[0] != "c"])
+        assert outputs[0][0] == "p cnf 36 %s" % (len(outputs[0]) - 1)
+        assert all(output == outputs[0] for output in outputs)
+
     operators = [
         ("%s | %s", 2), ("%s & %s", 2), ("Xor(%s, %s)", 2), ("Nand(%s, %s)", 2), ("Nor(%s, %s)", 2),
         ("ITE(%s, %s ,%s)", 3), ("%s >> %s", 2), ("%s << %s", 2), ("Implies(%s, %s)", 2), ("Equivalent(%s, %s)", 2)
@@ -526,3 +623,220 @@ class TestOutput:
             input_parsed_by_sympy = parse_expr(prepareinput, evaluate=False)
 
             assert to_cnf(input_parsed_by_sympy).equals(output_parsed_by_sympy)
+
+
+class TestParser:
+
+    def test_variables(self):
+        parser = ConstraintsParser([4, 3])
+        assert parser.parse("X0.0") == 1
+        assert parser.parse("X.1.1") == 5
+        assert parser.parse("~X3.2") == -12
+        assert parser.parse("~~X3.2") == 12
+
+    def test_precedence(self):
+        constraints = [
+            "X0 | X1 & X2", "X0 & X1 | X2", "X0 ^ X1 & X2 | X3", "~X0 >> X1", "X0 >> X1 >> X2", "X0 << X1 & X2",
+            "X0 >> X1 | X2 << X3", "~(X0 | X1) & X2", "(X0 ^ X1) & (X2 | ~X3)", "X0 | X1 | X2 | X3",
+        ]
+        parser = ConstraintsParser([4])
+        for constraint in constraints:
+            native = ConstraintsToCnf._ast_to_sympy([parser.parse(constraint)], [4])
+            # evaluated, as sympy translates '^' to a negation when not evaluating
+            expected = parse_expr(constraint.replace("X", "X_"))
+            assert not satisfiable(~Equivalent(native, expected)), constraint
+
+    def test_functions(self):
+        parser = ConstraintsParser([6])
+        assert parser.parse("Xor(X0, ~X1, X2)") == ("xor", 1, -2, 3)
+        assert parser.parse("ITE(X0, X1 ,X2)") == ("ite", 1, 2, 3)
+        assert parser.parse("Implies(X0, X1 & X2)") == ("implies", 1, ("and", 2, 3))
+        assert parser.parse("Equivalent(X0, X1, X2)") == ("equivalent", 1, 2, 3)
+        assert parser.parse("Nand(X0, Nor(X1, X2))") == ("nand", 1, ("nor", 2, 3))
+        assert parser.parse("And(X0, Or(X1, X2), True)") == ("and", 1, ("or", 2, 3), True)
+        assert parser.parse("Not(X0 | X1)") == ("not", ("or", 1, 2))
+
+    def test_errors(self):
+        parser = ConstraintsParser([4, 3])
+        constraints = [
+            "", "X0.0 &", "(X0.0", "X0.0)", "()", "X0.0 X0.1", "X0.0 ! X0.1", "And(X0.0,)", "Foo(X0.0)", "Xor",
+            "ITE(X0.0, X0.1)", "X0", "X0.0.0", "X4.0", "X0.3", "X_0_0",
+        ]
+        for constraint in constraints:
+            with pytest.raises(ValueError):
+                parser.parse(constraint)
+
+    def test_long_constraints(self):
+        n = 20000
+        parser = ConstraintsParser([n])
+        assert parser.parse(" | ".join("X%s" % i for i in range(n))) == ("or",) + tuple(range(1, n + 1))
+        assert parser.parse("(" * n + "X0" + ")" * n) == 1
+        assert parser.parse("~" * (n + 1) + "X0") == -1
+
+    def test_sympy_parser(self):
+        string = "shape [4,3]\n"
+        string += "X0.0 >> (~X0.1 & ~X0.2)\n"
+        string += "X1.1 | Xor(X2.0, X3.2)\n"
+        inputfilepath = to_file_in_tmp(string, self.test_sympy_parser)
+
+        outputs = []
+        for parser in ("native", "sympy"):
+            for encoding in ("cnf", "tseitin"):
+                outputfilepath = os.path.join(TEMPORARY_DIR, "parser_%s_%s.txt" % (parser, encoding))
+                toDIMACS(inputfilepath, outputfilepath, encoding=encoding, parser=parser)
+                outputs.append(load_file(outputfilepath))
+        symbols = sorted(outputs[0].atoms(Symbol), key=str)
+        assert outputs[0] == outputs[2]
+        # the sympy parser sorts the arguments, the auxiliary variables are numbered differently
+        assert sorted(projected_models(outputs[1], symbols)) == sorted(projected_models(outputs[3], symbols))
+
+        with pytest.raises(ValueError):
+            toDIMACS(inputfilepath, os.path.join(TEMPORARY_DIR, "parser.txt"), parser="lark")
+
+
+def projected_models(expression, symbols):
+    models = [
+        tuple(model[symbol] for symbol in symbols) for model in satisfiable(expression, all_models=True) if model
+    ]
+    return models
+
+
+class TestTseitin:
+
+    operators = TestOutput.operators + [
+        ("Equivalent(%s, %s, %s)", 3), ("Xor(%s, %s, %s)", 3), ("(%s & %s) | (%s & ~%s)", 4), ("~(%s | (%s >> %s))", 3)
+    ]
+
+    def random_constraints(self, n_vars, nconstraints):
+        string = "shape [%s]\n" % n_vars
+        prepareinput = []
+        for _ in range(nconstraints):
+            operator, requiredargs = self.operators[random.randrange(0, len(self.operators))]
+            vars = [random.randrange(0, n_vars) for _ in range(requiredargs)]
+            negations = ["~" if random.randrange(0, 2) else "" for _ in vars]
+            prepareinput.append(operator % tuple("%scnf_%s" % (neg, var + 1) for neg, var in zip(negations, vars)))
+            string += operator % tuple("%sX%s" % (neg, var) for neg, var in zip(negations, vars)) + "\n"
+        return string, prepareinput
+
+    def test_same_models(self):
+        for iteration in range(10):
+            string, prepareinput = self.random_constraints(6, 4)
+            inputfilepath = to_file_in_tmp(string, self.test_same_models)
+            outputfilepath = os.path.join(TEMPORARY_DIR, "tseitin1.txt")
+
+            toDIMACS(inputfilepath, outputfilepath, encoding="tseitin")
+
+            input_parsed_by_sympy = parse_expr(" & ".join("(%s)" % c for c in prepareinput), evaluate=False)
+            output_parsed_by_sympy = load_file(outputfilepath)
+            symbols = sorted(input_parsed_by_sympy.atoms(Symbol), key=str)
+
+            # auxiliary variables are fully defined: each model of the constraints has exactly one extension
+            expected = projected_models(input_parsed_by_sympy, symbols)
+            models = projected_models(output_parsed_by_sympy, symbols)
+            assert sorted(models) == sorted(expected)
+
+    def test_header(self):
+        string = "shape [4,3]\n"
+        string += "(X0.0 & X1.1) | (X0.1 & X1.2) | (X2.0 & X3.0)\n"
+        string += "X0.0 | X0.1\n"
+        inputfilepath = to_file_in_tmp(string, self.test_header)
+        outputfilepath = os.path.join(TEMPORARY_DIR, "tseitin2.txt")
+
+        toDIMACS(inputfilepath, outputfilepath, encoding="tseitin")
+
+        with open(outputfilepath, "r") as outputfile:
+            lines = [s for s in outputfile.read().split("\n") if s != ""]
+        assert "c Variables 13 to 15 are auxiliary variables of the tseitin encoding." in lines
+        lines = [s for s in lines if s[0] != "c"]
+        # 3 clauses for each conjunction, 1 for the disjunction of the auxiliary variables and 1 for the last line
+        assert lines[0] == "p cnf 15 11"
+        assert "1 2 0" in lines
+
+    def test_linear_size(self):
+        # the disjunction of conjunctions of a one-hot constraint, exponential when distributed by to_cnf
+        n = 24
+        string = "shape [%s]\n" % n
+        string += " | ".join(
+            "(%s)" % " & ".join(("X%s" if i == j else "~X%s") % j for j in range(n)) for i in range(n)
+        ) + "\n"
+        inputfilepath = to_file_in_tmp(string, self.test_linear_size)
+        outputfilepath = os.path.join(TEMPORARY_DIR, "tseitin3.txt")
+
+        toDIMACS(inputfilepath, outputfilepath, encoding="tseitin")
+
+        with open(outputfilepath, "r") as outputfile:
+            header = [s for s in outputfile.read().split("\n") if s.startswith("p cnf")][0]
+        assert header == "p cnf %s %s" % (n + n, n * (n + 1) + 1)
+
+    def test_unknown_encoding(self):
+        inputfilepath = to_file_in_tmp("shape [2]\nX0\n", self.test_unknown_encoding)
+        with pytest.raises(ValueError):
+            toDIMACS(inputfilepath, os.path.join(TEMPORARY_DIR, "tseitin4.txt"), encoding="bdd")
+
+
+class TestCardinality:
+
+    def count_true(self, model, variables):
+        return sum(model[abs(v) - 1] == (v > 0) for v in variables)
+
+    def assert_models(self, outputfilepath, n_vars, satisfies):
+        # every assignment of the variables that satisfies the constraint extends to exactly one model
+        output_parsed_by_sympy = load_file(outputfilepath)
+        symbols = [Symbol("cnf_%s" % (i + 1)) for i in range(n_vars)]
+        models = [
+            tuple(model.get(symbol, False) for symbol in symbols)
+            for model in satisfiable(output_parsed_by_sympy, all_models=True) if model
+        ]
+        expected = [model for model in itertools.product([False, True], repeat=n_vars) if satisfies(model)]
+        assert sorted(models) == sorted(expected)
+
+    def test_parse(self):
+        parser = ConstraintsParser([2, 3])
+        assert parser.parse("ExactlyOne(X0.0, X0.1, X0.2)") == (("exactly", 1), 1, 2, 3)
+        assert parser.parse("AtMostK(2, X0.0, ~X1.1, X1.2 & X0.1)") == (("atmost", 2), 1, -5, ("and", 6, 2))
+        assert parser.parse("X1.0 >> AtLeastK(1, X0.0, X0.1)") == ("implies", 4, (("atleast", 1), 1, 2))
+        for constraint in ["AtMostK(X0.0, X0.1)", "AtMostK(1, X0.0, 2)", "AtLeastK(1, )", "X0.0 | 1", "ExactlyOne"]:
+            with pytest.raises(ValueError):
+                parser.parse(constraint)
+
+    def test_same_models(self):
+        n_vars = 5
+        constraints = [
+            ("ExactlyOne(X0, ~X1, X2, X3)", lambda m: self.count_true(m, [1, -2, 3, 4]) == 1),
+            ("AtMostK(2, X0, X1, X2, ~X3, X4)", lambda m: self.count_true(m, [1, 2, 3, -4, 5]) <= 2),
+            ("AtLeastK(3, X0, X1, X2, X3)", lambda m: self.count_true(m, [1, 2, 3, 4]) >= 3),
+            ("AtMostK(0, X1, X2)", lambda m: self.count_true(m, [2, 3]) == 0),
+            ("AtLeastK(3, X1, X2)", lambda m: False),
+            ("X4 >> AtMostK(1, X0, X1, X2)", lambda m: not m[4] or self.count_true(m, [1, 2, 3]) <= 1),
+            ("ExactlyOne(X0, X1) | ~AtLeastK(2, X2, X3, X4)",
+             lambda m: self.count_true(m, [1, 2]) == 1 or self.count_true(m, [3, 4, 5]) < 2),
+        ]
+        for constraint, satisfies in constraints:
+            string = "shape [%s]\n" % n_vars
+            # a tautology, so that all the variables are in the models
+            string += "X0 | X1 | X2 | X3 | X4 | ~X0\n"
+            string += constraint + "\n"
+            inputfilepath = to_file_in_tmp(string, self.test_same_models)
+
+            for encoding in ("cnf", "tseitin"):
+                outputfilepath = os.path.join(TEMPORARY_DIR, "cardinality1.txt")
+                toDIMACS(inputfilepath, outputfilepath, encoding=encoding)
+                self.assert_models(outputfilepath, n_vars, satisfies)
+
+    def test_linear_size(self):
+        n, k = 200, 3
+        string = "shape [%s]\n" % n
+        string += "AtMostK(%s, %s)\n" % (k, ", ".join("X%s" % i for i in range(n)))
+        string += "ExactlyOne(%s)\n" % ", ".join("X%s" % i for i in range(n))
+        inputfilepath = to_file_in_tmp(string, self.test_linear_size)
+        outputfilepath = os.path.join(TEMPORARY_DIR, "cardinality2.txt")
+
+        toDIMACS(inputfilepath, outputfilepath)
+
+        with open(outputfilepath, "r") as outputfile:
+            lines = [s for s in outputfile.read().split("\n") if s != ""]
+        assert any(s.startswith("c Variables %s to " % (n + 1)) and s.endswith("cardinality functions.") for s in lines)
+        n_vars, n_clauses = [int(item) for item in [s for s in lines if s.startswith("p cnf")][0].split()[2:]]
+        # at most 1 auxiliary variable and 4 clauses for each of the k + 1 counters of each variable
+        assert n_vars - n <= (k + 1) * n + 2 * n
+        assert n_clauses <= 4 * ((k + 1) * n + 2 * n) + 2
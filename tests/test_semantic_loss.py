@@ -0,0 +1,1022 @@
+import glob
+import itertools
+import json
+import math
+import multiprocessing
+import os
+from concurrent.futures import ThreadPoolExecutor
+
+import pytest
+import torch
+
+from semantic_loss_pytorch import (
+    CircuitScorer,
+    CompiledCircuit,
+    MultiConstraintSemanticLoss,
+    SemanticLoss,
+    builders,
+    cache,
+    categorical_groups,
+    profiling,
+)
+from semantic_loss_pytorch.constraints_to_cnf import ConstraintsToCnf
+from semantic_loss_pytorch.py3psdd import io
+
+
+FIXTURES_DIR = os.path.join(
+    os.path.dirname(os.path.dirname(os.path.abspath(__file__))), "semantic_loss_pytorch", "py3psdd", "2to3testing"
+)
+SDD_FILES = sorted(glob.glob(os.path.join(FIXTURES_DIR, "sdds", "*.sdd")))[::20]
+# deep circuit with 80k nodes over 69 variables
+LARGE_SDD_FILE = os.path.join(
+    FIXTURES_DIR, "sdds", "SAT_seed1337_variables23_clauses50_maxperclause10_nmodels0_multinomial3_simplifyFalse.sdd"
+)
+
+
+def vtree_of(sdd_file):
+    return sdd_file.replace(os.sep + "sdds" + os.sep, os.sep + "vtrees" + os.sep).replace(".sdd", ".vtree")
+
+
+def load(sdd_file, **kwargs):
+    return SemanticLoss(sdd_file, vtree_of(sdd_file), **kwargs)
+
+
+torch.manual_seed(1337)
+
+
+class TestCompiledCircuit:
+
+    @pytest.mark.parametrize("sdd_file", SDD_FILES)
+    def test_same_wmc_as_reference(self, sdd_file):
+        sl = load(sdd_file)
+        x = torch.rand(8, sl.circuit.var_count, dtype=torch.float64)
+
+        _, compiled = sl(probabilities=x, output_wmc_per_sample=True)
+        sl.compiled = False
+        _, reference = sl(probabilities=x, output_wmc_per_sample=True)
+
+        assert compiled.shape == (8,)
+        assert torch.allclose(compiled, reference.expand_as(compiled))
+
+    @pytest.mark.parametrize("sdd_file", SDD_FILES[:3])
+    def test_same_gradient_as_reference(self, sdd_file):
+        sl = load(sdd_file)
+        logits = torch.randn(4, sl.circuit.var_count, dtype=torch.float64, requires_grad=True)
+
+        compiled, = torch.autograd.grad(sl(logits=logits), logits)
+        sl.compiled = False
+        reference, = torch.autograd.grad(sl(logits=logits), logits)
+
+        assert torch.allclose(compiled, reference)
+
+    def test_batch_shape(self):
+        sl = load(SDD_FILES[0])
+        x = torch.rand(5, 1, sl.circuit.var_count)
+
+        loss, wmc, wmc_per_sample = sl(probabilities=x, output_wmc=True, output_wmc_per_sample=True)
+        assert loss.shape == () and wmc.shape == ()
+        assert wmc_per_sample.shape == (5,)
+
+    def test_too_few_variables(self):
+        sl = load(SDD_FILES[0])
+        with pytest.raises(ValueError):
+            sl(probabilities=torch.rand(2, sl.circuit.var_count - 1))
+
+
+class TestLogSpace:
+
+    @pytest.mark.parametrize("sdd_file", SDD_FILES[:4])
+    def test_same_loss_as_probabilities(self, sdd_file):
+        sl = load(sdd_file)
+        log_sl = load(sdd_file, log_space=True)
+        logits = torch.randn(8, sl.circuit.var_count, dtype=torch.float64, requires_grad=True)
+
+        loss, wmc_per_sample = sl(logits=logits, output_wmc_per_sample=True)
+        log_loss, log_wmc_per_sample = log_sl(logits=logits, output_wmc_per_sample=True)
+        assert torch.allclose(loss, log_loss)
+        assert torch.allclose(torch.log(wmc_per_sample), log_wmc_per_sample)
+
+        grad, = torch.autograd.grad(loss, logits)
+        log_grad, = torch.autograd.grad(log_loss, logits)
+        assert torch.allclose(grad, log_grad)
+
+    def test_no_underflow_in_float32(self):
+        sl = load(LARGE_SDD_FILE)
+        log_sl = load(LARGE_SDD_FILE, log_space=True)
+        logits = torch.randn(4, sl.circuit.var_count) * 300
+
+        assert torch.isinf(sl(logits=logits))
+        log_loss = log_sl(logits=logits.requires_grad_())
+        assert torch.isfinite(log_loss)
+        assert torch.allclose(log_loss.double(), log_sl(logits=logits.double()))
+
+        grad, = torch.autograd.grad(log_loss, logits)
+        assert not torch.isnan(grad).any()
+
+
+def graph_size(tensor):
+    seen, queue = set(), [tensor.grad_fn]
+    while queue:
+        fn = queue.pop()
+        if fn is None or fn in seen:
+            continue
+        seen.add(fn)
+        queue.extend(next_fn for next_fn, _ in fn.next_functions)
+    return len(seen)
+
+
+class TestAnalyticBackward:
+
+    @pytest.mark.parametrize("log_space", [False, True])
+    @pytest.mark.parametrize("sdd_file", SDD_FILES[:4])
+    def test_same_gradient_as_autograd(self, sdd_file, log_space):
+        sl = load(sdd_file, log_space=log_space)
+        logits = torch.randn(8, sl.circuit.var_count, dtype=torch.float64, requires_grad=True)
+        positive, negative = sl._weights(logits=logits)
+
+        analytic, = torch.autograd.grad(
+            sl.circuit(positive, negative, log_space=log_space).sum(), logits, retain_graph=True
+        )
+        table = sl.circuit.literal_table(positive, negative, log_space=log_space)
+        recorded, = torch.autograd.grad(sl.circuit.upward(table, log_space=log_space)[sl.circuit.roots].sum(), logits)
+
+        assert torch.allclose(analytic, recorded)
+
+    def test_constant_graph_size(self):
+        small, large = load(SDD_FILES[0]), load(LARGE_SDD_FILE)
+        for sl in (small, large):
+            sl.loss = sl(logits=torch.randn(2, sl.circuit.var_count, requires_grad=True))
+        assert graph_size(small.loss) == graph_size(large.loss)
+
+
+class TestScriptable:
+
+    @pytest.mark.parametrize("log_space", [False, True])
+    def test_torchscript(self, log_space, tmp_path):
+        sl = load(SDD_FILES[1], log_space=log_space)
+        scripted = torch.jit.script(sl.scriptable())
+        logits = torch.randn(4, sl.circuit.var_count)
+
+        loss, wmc, wmc_per_sample = scripted(logits=logits)
+        expected = sl(logits=logits, output_wmc=True, output_wmc_per_sample=True)
+        for output, reference in zip((loss, wmc, wmc_per_sample), expected):
+            assert torch.allclose(output, reference)
+
+        torch.jit.save(scripted, str(tmp_path / "semantic_loss.pt"))
+        loaded = torch.jit.load(str(tmp_path / "semantic_loss.pt"))
+        assert torch.allclose(loaded(probabilities=torch.sigmoid(logits))[0], loss)
+
+    @pytest.mark.parametrize("log_space", [False, True])
+    def test_compile_without_graph_breaks(self, log_space):
+        sl = load(SDD_FILES[1], log_space=log_space)
+        logits = torch.randn(4, sl.circuit.var_count, requires_grad=True)
+
+        compiled = torch.compile(sl, fullgraph=True, backend="eager")
+        grad, = torch.autograd.grad(compiled(logits=logits), logits)
+        expected, = torch.autograd.grad(sl(logits=logits), logits)
+        assert torch.allclose(grad, expected)
+
+
+class TestOnnx:
+
+    @pytest.mark.parametrize("log_space", [False, True])
+    @pytest.mark.parametrize("from_logits", [False, True])
+    def test_scorer(self, log_space, from_logits):
+        sl = load(SDD_FILES[2], log_space=log_space)
+        x = torch.randn(4, sl.circuit.var_count + 2, dtype=torch.float64)
+        x = x if from_logits else torch.sigmoid(x)
+        inputs = {"logits": x} if from_logits else {"probabilities": x}
+
+        scorer = sl.scorer(from_logits=from_logits)
+        assert isinstance(scorer, CircuitScorer)
+        wmc, marginals = scorer(x)
+        _, expected = sl(**inputs, output_wmc_per_sample=True)
+        assert torch.allclose(wmc[:, 0], expected)
+        assert torch.allclose(marginals, sl.marginals(**inputs))
+
+    @pytest.mark.parametrize("log_space", [False, True])
+    def test_scorer_categorical(self, log_space):
+        base = load(SDD_FILES[2])
+        sl = load(SDD_FILES[2], categorical_groups=vtree_groups(base.psdd, 2), log_space=log_space)
+        logits = torch.randn(4, sl.circuit.var_count, dtype=torch.float64)
+
+        wmc, marginals = sl.scorer()(logits)
+        assert torch.allclose(wmc[:, 0], sl(logits=logits, output_wmc_per_sample=True)[1])
+        assert torch.allclose(marginals, sl.marginals(logits=logits))
+
+    @pytest.mark.parametrize("log_space", [False, True])
+    def test_export(self, log_space, tmp_path):
+        pytest.importorskip("onnxscript")
+        onnx = pytest.importorskip("onnx")
+        onnxruntime = pytest.importorskip("onnxruntime")
+        sl = load(SDD_FILES[5], log_space=log_space)
+        sl.export_onnx(str(tmp_path / "constraint.onnx"))
+
+        # the graph is a fixed number of operations for each layer of the circuit
+        graph = onnx.load(str(tmp_path / "constraint.onnx")).graph
+        assert len(graph.node) < 60 * sl.circuit.n_layers
+
+        session = onnxruntime.InferenceSession(str(tmp_path / "constraint.onnx"))
+        for batch_size in [1, 7]:
+            logits = torch.randn(batch_size, sl.circuit.var_count)
+            wmc, marginals = session.run(None, {"logits": logits.numpy()})
+            _, expected = sl(logits=logits, output_wmc_per_sample=True)
+            assert torch.allclose(torch.from_numpy(wmc)[:, 0], expected, atol=1e-5)
+            assert torch.allclose(torch.from_numpy(marginals), sl.marginals(logits=logits), atol=1e-5)
+
+
+class TestSimplify:
+
+    @pytest.mark.parametrize("log_space", [False, True])
+    @pytest.mark.parametrize("sdd_file", SDD_FILES[:6])
+    def test_same_wmc_for_any_weights(self, sdd_file, log_space):
+        sl = load(sdd_file, simplify=False)
+        simplified = CompiledCircuit(arrays=CompiledCircuit.simplify(sl.circuit.to_arrays()))
+        positive = torch.rand(4, sl.circuit.var_count, dtype=torch.float64, requires_grad=True)
+        negative = torch.rand(4, sl.circuit.var_count, dtype=torch.float64, requires_grad=True)
+        if log_space:
+            positive, negative = torch.log(positive), torch.log(negative)
+
+        wmc = sl.circuit(positive, negative, log_space=log_space)
+        simplified_wmc = simplified(positive, negative, log_space=log_space)
+        assert torch.allclose(wmc, simplified_wmc)
+
+        grads = torch.autograd.grad(wmc.sum(), (positive, negative))
+        simplified_grads = torch.autograd.grad(simplified_wmc.sum(), (positive, negative))
+        assert all(torch.allclose(grad, simplified_grad) for grad, simplified_grad in zip(grads, simplified_grads))
+
+    @pytest.mark.parametrize("sdd_file", SDD_FILES[:6])
+    def test_fold_true(self, sdd_file):
+        sl = load(sdd_file, simplify=False)
+        simplified = CompiledCircuit(arrays=CompiledCircuit.simplify(sl.circuit.to_arrays(), fold_true=True))
+        x = torch.rand(4, sl.circuit.var_count, dtype=torch.float64)
+
+        assert simplified.n_nodes <= CompiledCircuit(arrays=CompiledCircuit.simplify(sl.circuit.to_arrays())).n_nodes
+        assert torch.allclose(sl.circuit(x, 1 - x), simplified(x, 1 - x))
+
+    def test_size_report(self, tmp_path):
+        sl = load(SDD_FILES[3])
+        report = sl.circuit.size_report()
+        assert report["nodes_before"] == load(SDD_FILES[3], simplify=False).circuit.n_nodes
+        assert report["nodes_after"] == sl.circuit.n_nodes < report["nodes_before"]
+        assert report["elements_after"] == sl.circuit.n_elements < report["elements_before"]
+
+        # the report survives the cache
+        load(SDD_FILES[3], cache_dir=str(tmp_path))
+        assert load(SDD_FILES[3], cache_dir=str(tmp_path)).circuit.size_report() == report
+
+    def test_idempotent(self):
+        arrays = CompiledCircuit.simplify(load(SDD_FILES[3]).circuit.to_arrays())
+        simplified_again = CompiledCircuit.simplify(arrays)
+        assert all((arrays[name] == simplified_again[name]).all() for name in arrays)
+
+
+def vtree_groups(psdd, n_groups):
+    """
+    Returns disjoint groups of variables of internal vtree nodes, as 0-based indices.
+    """
+    groups, grouped = [], set()
+    for vtree in psdd.vtree.post_order():
+        variables = vtree.variables()
+        if not vtree.is_leaf() and len(variables) <= 4 and not variables & grouped:
+            groups.append(sorted(var - 1 for var in variables))
+            grouped |= variables
+    return groups[:n_groups]
+
+
+class TestCategorical:
+
+    @pytest.mark.parametrize("log_space", [False, True])
+    @pytest.mark.parametrize("sdd_file", SDD_FILES[1:4])
+    def test_same_wmc_as_conditioning(self, sdd_file, log_space):
+        base = load(sdd_file)
+        groups = vtree_groups(base.psdd, 2)
+        sl = load(sdd_file, categorical_groups=groups, log_space=log_space)
+        logits = torch.randn(4, base.circuit.var_count, dtype=torch.float64)
+
+        wmc_per_sample = sl(logits=logits, output_wmc_per_sample=True)[1]
+        if log_space:
+            wmc_per_sample = wmc_per_sample.exp()
+
+        # sum the wmc of the circuit without groups conditioned on each choice of the categories
+        expected = torch.zeros(4, dtype=torch.float64)
+        for categories in itertools.product(*[range(len(group)) for group in groups]):
+            positive, negative = torch.sigmoid(logits), torch.sigmoid(-logits)
+            pr = torch.ones(4, dtype=torch.float64)
+            for group, category in zip(groups, categories):
+                pr = pr * torch.softmax(logits[:, group], dim=-1)[:, category]
+                for k, var in enumerate(group):
+                    positive[:, var], negative[:, var] = float(k == category), float(k != category)
+            expected += pr * base.circuit(positive, negative)[:, 0]
+
+        assert torch.allclose(wmc_per_sample, expected)
+        assert sl.circuit.n_nodes < base.circuit.n_nodes
+
+    @pytest.mark.parametrize("log_space", [False, True])
+    def test_probabilities(self, log_space):
+        base = load(SDD_FILES[2])
+        groups = vtree_groups(base.psdd, 2)
+        sl = load(SDD_FILES[2], categorical_groups=groups, log_space=log_space)
+        logits = torch.randn(4, base.circuit.var_count, dtype=torch.float64)
+
+        probabilities = torch.sigmoid(logits)
+        for group in groups:
+            probabilities[:, group] = torch.softmax(logits[:, group], dim=-1)
+        assert torch.allclose(sl(probabilities=probabilities), sl(logits=logits))
+
+    def test_one_hot_probabilities(self):
+        base = load(SDD_FILES[2])
+        groups = vtree_groups(base.psdd, 2)
+        sl = load(SDD_FILES[2], categorical_groups=groups)
+
+        probabilities = torch.rand(4, base.circuit.var_count, dtype=torch.float64)
+        for group in groups:
+            probabilities[:, group] = torch.eye(len(group), dtype=torch.float64)[0]
+        probabilities.requires_grad_()
+
+        grad, = torch.autograd.grad(sl(probabilities=probabilities), probabilities)
+        assert not torch.isnan(grad).any()
+
+    def test_scriptable(self):
+        base = load(SDD_FILES[2])
+        sl = load(SDD_FILES[2], categorical_groups=vtree_groups(base.psdd, 2))
+        logits = torch.randn(4, sl.circuit.var_count)
+        assert torch.allclose(torch.jit.script(sl.scriptable())(logits=logits)[0], sl(logits=logits))
+
+    def test_groups_not_in_vtree(self):
+        base = load(SDD_FILES[2])
+        with pytest.raises(ValueError):
+            load(SDD_FILES[2], categorical_groups=[[0, base.circuit.var_count - 1]])
+
+    def test_categorical_groups(self):
+        assert categorical_groups([4, 3]) == [[0, 1, 2], [3, 4, 5], [6, 7, 8], [9, 10, 11]]
+        assert categorical_groups([2, 3], dim=0) == [[0, 3], [1, 4], [2, 5]]
+
+
+class TestEvidence:
+
+    @staticmethod
+    def brute_force(sl, logits, evidence, groups):
+        """
+        Returns the weighted model count of the constraint and of the evidence, enumerating all the assignments.
+        """
+        var_count = sl.circuit.var_count
+        assignments = torch.tensor(list(itertools.product([0, 1], repeat=var_count)), dtype=torch.float64)
+        is_model = load(SDD_FILES[0]).circuit(assignments, 1 - assignments)[:, 0]
+
+        weights = torch.where(assignments[:, None] == 1, torch.sigmoid(logits), torch.sigmoid(-logits))
+        is_categorical = torch.ones(len(assignments), dtype=torch.bool)
+        for group in groups:
+            is_categorical &= assignments[:, group].sum(dim=-1) == 1
+            weights[:, :, group] = torch.where(
+                assignments[:, None, group] == 1, torch.softmax(logits[:, group], dim=-1), torch.ones(1).double()
+            )
+        weights = weights.prod(dim=-1) * is_categorical[:, None]
+        consistent = ((evidence == -1) | (assignments[:, None] == evidence)).all(dim=-1)
+
+        return (weights * consistent * is_model[:, None]).sum(dim=0), (weights * consistent).sum(dim=0)
+
+    @pytest.mark.parametrize("categorical", [False, True])
+    @pytest.mark.parametrize("log_space", [False, True])
+    def test_same_wmc_as_brute_force(self, log_space, categorical):
+        groups = vtree_groups(load(SDD_FILES[0]).psdd, 2) if categorical else []
+        sl = load(SDD_FILES[0], log_space=log_space, categorical_groups=groups or None)
+        logits = torch.randn(8, sl.circuit.var_count, dtype=torch.float64)
+
+        # evidence consistent with the categorical groups, with unknown variables
+        evidence = torch.randint(0, 2, (8, sl.circuit.var_count))
+        for group in groups:
+            evidence[:, group] = torch.eye(len(group), dtype=torch.long)[torch.randint(0, len(group), (8,))]
+        evidence[torch.rand(evidence.shape) < 0.5] = -1
+        evidence[0] = -1
+
+        wmc_per_sample = sl(logits=logits, evidence=evidence, output_wmc_per_sample=True)[1]
+        conditional = sl(logits=logits, evidence=evidence, conditional=True, output_wmc_per_sample=True)[1]
+        if log_space:
+            wmc_per_sample, conditional = wmc_per_sample.exp(), conditional.exp()
+
+        expected, evidence_wmc = self.brute_force(sl, logits, evidence, groups)
+        assert torch.allclose(wmc_per_sample, expected)
+        assert torch.allclose(conditional, expected / evidence_wmc)
+
+        # without evidence, the conditional weighted model count is the unconditional one
+        unconditional = sl(logits=logits[:1], output_wmc_per_sample=True)[1]
+        assert torch.allclose(conditional[:1], unconditional.exp() if log_space else unconditional)
+
+    def test_gradient(self):
+        sl = load(SDD_FILES[0], log_space=True)
+        logits = torch.randn(4, sl.circuit.var_count, dtype=torch.float64, requires_grad=True)
+
+        # observe some variables of models of the constraint, so that the evidence is consistent
+        assignments = torch.tensor(list(itertools.product([0, 1], repeat=sl.circuit.var_count)))
+        models = assignments[sl.circuit(assignments.double(), 1 - assignments.double())[:, 0] > 0]
+        evidence = models[torch.randint(0, len(models), (4,))]
+        evidence[torch.rand(evidence.shape) < 0.5] = -1
+
+        loss = sl(logits=logits, evidence=evidence, conditional=True)
+        grad, = torch.autograd.grad(loss, logits)
+        assert torch.isfinite(grad).all()
+        # observed variables get no gradient from the conditional probability
+        assert torch.allclose(grad[evidence != -1], torch.zeros(1, dtype=torch.float64))
+
+    def test_scriptable(self):
+        sl = load(SDD_FILES[1])
+        logits = torch.randn(4, sl.circuit.var_count)
+        evidence = torch.randint(-1, 2, logits.shape)
+
+        scripted = torch.jit.script(sl.scriptable())
+        expected = sl(logits=logits, evidence=evidence, conditional=True)
+        assert torch.allclose(scripted(logits=logits, evidence=evidence, conditional=True)[0], expected)
+
+    def test_reference_not_supported(self):
+        sl = load(SDD_FILES[0], compiled=False)
+        with pytest.raises(ValueError):
+            sl(probabilities=torch.rand(2, 10), evidence=torch.ones(2, 10))
+
+
+class TestMarginals:
+
+    @pytest.mark.parametrize("log_space", [False, True])
+    def test_same_as_brute_force(self, log_space):
+        sl = load(SDD_FILES[0], log_space=log_space)
+        var_count = sl.circuit.var_count
+        logits = torch.randn(5, var_count + 2, dtype=torch.float64)
+
+        assignments = torch.tensor(list(itertools.product([0, 1], repeat=var_count)), dtype=torch.float64)
+        is_model = sl.circuit(assignments, 1 - assignments)[:, 0]
+        probabilities = torch.sigmoid(logits[:, :var_count])
+        weights = torch.where(assignments[:, None] == 1, probabilities, 1 - probabilities)
+        weights = weights.prod(dim=-1) * is_model[:, None]
+        expected = (weights[:, :, None] * assignments[:, None]).sum(dim=0) / weights.sum(dim=0)[:, None]
+
+        marginals = sl.marginals(logits=logits)
+        assert marginals.shape == logits.shape
+        assert torch.allclose(marginals[:, :var_count], expected)
+        # variables not in the constraint are independent
+        assert torch.allclose(marginals[:, var_count:], torch.sigmoid(logits[:, var_count:]))
+
+    @pytest.mark.parametrize("sdd_file", SDD_FILES[1:4])
+    def test_same_as_evidence(self, sdd_file):
+        sl = load(sdd_file, log_space=True)
+        var_count = sl.circuit.var_count
+        logits = torch.randn(2, var_count, dtype=torch.float64)
+
+        # P(x_i | constraint) = WMC(constraint, x_i) / WMC(constraint), one forward pass per variable
+        wmc = sl(logits=logits, output_wmc_per_sample=True)[1]
+        expected = torch.empty_like(logits)
+        for i in range(var_count):
+            evidence = torch.full(logits.shape, -1)
+            evidence[:, i] = 1
+            expected[:, i] = (sl(logits=logits, evidence=evidence, output_wmc_per_sample=True)[1] - wmc).exp()
+
+        assert torch.allclose(sl.marginals(logits=logits), expected)
+
+    @pytest.mark.parametrize("log_space", [False, True])
+    def test_differentiable(self, log_space):
+        sl = load(SDD_FILES[0], log_space=log_space)
+        logits = torch.randn(2, sl.circuit.var_count, dtype=torch.float64, requires_grad=True)
+        assert torch.autograd.gradcheck(lambda x: sl.marginals(logits=x), (logits,))
+
+        with torch.no_grad():
+            assert not sl.marginals(logits=logits).requires_grad
+
+    def test_categorical(self):
+        groups = vtree_groups(load(SDD_FILES[0]).psdd, 2)
+        sl = load(SDD_FILES[0], categorical_groups=groups)
+        marginals = sl.marginals(logits=torch.randn(4, sl.circuit.var_count))
+        for group in groups:
+            assert torch.allclose(marginals[:, group].sum(dim=-1), torch.ones(1))
+
+
+class TestMpe:
+
+    @pytest.mark.parametrize("log_space", [False, True])
+    def test_same_as_brute_force(self, log_space):
+        sl = load(SDD_FILES[0], log_space=log_space)
+        var_count = sl.circuit.var_count
+        logits = torch.randn(6, var_count + 2, dtype=torch.float64)
+
+        assignments = torch.tensor(list(itertools.product([0, 1], repeat=var_count)))
+        is_model = sl.circuit(assignments.double(), 1 - assignments.double())[:, 0] > 0
+        log_weights = torch.where(
+            assignments[:, None] == 1,
+            torch.nn.functional.logsigmoid(logits[:, :var_count]),
+            torch.nn.functional.logsigmoid(-logits[:, :var_count]),
+        ).sum(dim=-1)
+        best = log_weights.masked_fill(~is_model[:, None], -float("inf")).max(dim=0)
+
+        assignment, log_probability = sl.mpe(logits=logits)
+        assert torch.equal(assignment[:, :var_count], assignments[best.indices])
+        # variables not in the constraint take their most probable value
+        assert torch.equal(assignment[:, var_count:], (logits[:, var_count:] >= 0).long())
+        expected = best.values + torch.nn.functional.logsigmoid(logits[:, var_count:].abs()).sum(dim=-1)
+        assert torch.allclose(log_probability, expected)
+
+    @pytest.mark.parametrize("sdd_file", SDD_FILES[1:4])
+    def test_same_as_reference(self, sdd_file):
+        sl = load(sdd_file)
+        probabilities = torch.rand(3, sl.circuit.var_count, dtype=torch.float64)
+        assignment, log_probability = sl.mpe(probabilities=probabilities)
+
+        for sample in range(len(probabilities)):
+            lit_weights = [[1 - p, p] for p in probabilities[sample].tolist()]
+            weight, literals = sl.psdd.get_weighted_mpe(lit_weights)
+            expected = torch.zeros(sl.circuit.var_count, dtype=torch.long)
+            expected[[literal - 1 for literal in literals if literal > 0]] = 1
+            assert torch.equal(assignment[sample], expected)
+            assert log_probability[sample].item() == pytest.approx(math.log(weight))
+
+    def test_evidence(self):
+        sl = load(SDD_FILES[1], log_space=True)
+        logits = torch.randn(8, sl.circuit.var_count)
+        evidence = sl.mpe(logits=torch.randn(8, sl.circuit.var_count))[0]
+        evidence[torch.rand(evidence.shape) < 0.7] = -1
+
+        assignment, _ = sl.mpe(logits=logits, evidence=evidence)
+        assert torch.all((evidence == -1) | (assignment == evidence))
+        assert torch.all(sl.circuit(assignment.double(), 1 - assignment.double()) == 1)
+
+    def test_categorical(self):
+        groups = vtree_groups(load(SDD_FILES[0]).psdd, 2)
+        sl = load(SDD_FILES[0], categorical_groups=groups)
+        assignment, _ = sl.mpe(logits=torch.randn(16, sl.circuit.var_count))
+        for group in groups:
+            assert torch.all(assignment[:, group].sum(dim=-1) == 1)
+
+
+class TestTopK:
+
+    @pytest.mark.parametrize("log_space", [False, True])
+    def test_same_as_brute_force(self, log_space):
+        sl = load(SDD_FILES[0], log_space=log_space)
+        var_count = sl.circuit.var_count
+        logits = torch.randn(3, var_count, dtype=torch.float64)
+
+        assignments = torch.tensor(list(itertools.product([0, 1], repeat=var_count)))
+        is_model = sl.circuit(assignments.double(), 1 - assignments.double())[:, 0] > 0
+        log_weights = torch.where(
+            assignments[:, None] == 1,
+            torch.nn.functional.logsigmoid(logits),
+            torch.nn.functional.logsigmoid(-logits),
+        ).sum(dim=-1)
+        best = log_weights.masked_fill(~is_model[:, None], -float("inf")).topk(7, dim=0)
+
+        top, log_probability = sl.top_k(7, logits=logits)
+        assert torch.equal(top, assignments[best.indices.t()])
+        assert torch.allclose(log_probability, best.values.t())
+        # the best assignment is the MPE
+        assert torch.equal(top[:, 0], sl.mpe(logits=logits)[0])
+
+    def test_more_than_models(self):
+        sl = load(SDD_FILES[0])
+        n_models = sl.psdd.model_count()
+        top, log_probability = sl.top_k(n_models + 5, probabilities=torch.rand(2, sl.circuit.var_count))
+
+        assert torch.isfinite(log_probability[:, :n_models]).all()
+        assert torch.isinf(log_probability[:, n_models:]).all()
+        assert len({tuple(assignment) for assignment in top[0, :n_models].tolist()}) == n_models
+
+    def test_categorical(self):
+        groups = vtree_groups(load(SDD_FILES[0]).psdd, 2)
+        sl = load(SDD_FILES[0], categorical_groups=groups)
+        top, log_probability = sl.top_k(20, logits=torch.randn(4, sl.circuit.var_count))
+
+        assert torch.all(log_probability[:, :-1] >= log_probability[:, 1:])
+        for group in groups:
+            assert torch.all(top[..., group].sum(dim=-1) == 1)
+
+
+class TestSample:
+
+    @pytest.mark.parametrize("log_space", [False, True])
+    def test_same_distribution_as_marginals(self, log_space):
+        sl = load(SDD_FILES[1], log_space=log_space)
+        logits = torch.randn(2, sl.circuit.var_count + 2, dtype=torch.float64)
+        samples = sl.sample(logits=logits, n_samples=20000, generator=torch.Generator().manual_seed(0))
+
+        assert samples.shape == (2, 20000, logits.size(1))
+        models = samples[:, :1000, :-2].reshape(-1, sl.circuit.var_count).double()
+        assert torch.all(sl.circuit(models, 1 - models) == 1)
+        assert torch.allclose(samples.double().mean(dim=1), sl.marginals(logits=logits), atol=0.02)
+
+    def test_same_distribution_as_brute_force(self):
+        sl = load(SDD_FILES[0])
+        var_count = sl.circuit.var_count
+        probabilities = torch.rand(1, var_count, dtype=torch.float64)
+        samples = sl.sample(probabilities=probabilities, n_samples=20000, generator=torch.Generator().manual_seed(0))
+
+        assignments = torch.tensor(list(itertools.product([0, 1], repeat=var_count)))
+        is_model = sl.circuit(assignments.double(), 1 - assignments.double())[:, 0]
+        weights = torch.where(assignments == 1, probabilities, 1 - probabilities).prod(dim=-1) * is_model
+        frequencies = (samples[0, :, None] == assignments).all(dim=-1).double().mean(dim=0)
+        assert torch.allclose(frequencies, weights / weights.sum(), atol=0.01)
+
+    def test_generator(self):
+        sl = load(SDD_FILES[1])
+        logits = torch.randn(4, sl.circuit.var_count)
+        first = sl.sample(logits=logits, n_samples=8, generator=torch.Generator().manual_seed(42))
+        second = sl.sample(logits=logits, n_samples=8, generator=torch.Generator().manual_seed(42))
+        assert torch.equal(first, second)
+
+    def test_evidence_and_categorical(self):
+        groups = vtree_groups(load(SDD_FILES[0]).psdd, 2)
+        sl = load(SDD_FILES[0], categorical_groups=groups)
+        logits = torch.randn(4, sl.circuit.var_count)
+        evidence = sl.mpe(logits=torch.randn(4, sl.circuit.var_count))[0]
+        evidence[torch.rand(evidence.shape) < 0.7] = -1
+
+        samples = sl.sample(logits=logits, n_samples=100, evidence=evidence)
+        assert torch.all((evidence[:, None] == -1) | (samples == evidence[:, None]))
+        for group in groups:
+            assert torch.all(samples[..., group].sum(dim=-1) == 1)
+
+
+class TestEntropy:
+
+    @staticmethod
+    def brute_force(sl, logits, evidence=None):
+        """
+        Returns the entropy of the distribution of each sample conditioned on the constraint and the evidence,
+        enumerating all the assignments.
+        """
+        var_count = sl.circuit.var_count
+        assignments = torch.tensor(list(itertools.product([0, 1], repeat=var_count)), dtype=torch.float64)
+        is_model = sl.circuit(assignments, 1 - assignments)[:, 0]
+        if evidence is not None:
+            is_model = is_model[:, None] * ((evidence == -1) | (assignments[:, None] == evidence)).all(dim=-1)
+
+        weights = torch.where(assignments[:, None] == 1, torch.sigmoid(logits), torch.sigmoid(-logits))
+        weights = weights.prod(dim=-1) * (is_model if evidence is not None else is_model[:, None])
+        probabilities = weights / weights.sum(dim=0)
+        positive = probabilities > 0
+        log_probabilities = torch.log(torch.where(positive, probabilities, torch.ones_like(probabilities)))
+        return -(probabilities * log_probabilities).sum(dim=0)
+
+    @pytest.mark.parametrize("log_space", [False, True])
+    def test_same_as_brute_force(self, log_space):
+        sl = load(SDD_FILES[0], log_space=log_space)
+        var_count = sl.circuit.var_count
+        logits = torch.randn(4, var_count + 2, dtype=torch.float64, requires_grad=True)
+
+        loss, wmc_per_sample, entropy = sl(logits=logits, output_wmc_per_sample=True, output_entropy=True)
+        assert torch.allclose(loss, sl(logits=logits))
+        assert torch.allclose(wmc_per_sample, sl(logits=logits, output_wmc_per_sample=True)[1])
+
+        # variables not in the constraint add their own entropy
+        independent = torch.distributions.Bernoulli(logits=logits[:, var_count:]).entropy().sum(dim=-1)
+        expected = self.brute_force(sl, logits[:, :var_count]) + independent
+        assert torch.allclose(entropy, expected)
+
+        grad, = torch.autograd.grad(entropy.sum(), logits)
+        expected_grad, = torch.autograd.grad(expected.sum(), logits)
+        assert torch.allclose(grad, expected_grad)
+
+    def test_evidence(self):
+        sl = load(SDD_FILES[0], log_space=True)
+        logits = torch.randn(4, sl.circuit.var_count, dtype=torch.float64, requires_grad=True)
+        evidence = sl.mpe(logits=torch.randn(4, sl.circuit.var_count))[0]
+        evidence[torch.rand(evidence.shape) < 0.5] = -1
+
+        entropy = sl(logits=logits, evidence=evidence, conditional=True, output_entropy=True)[1]
+        assert torch.allclose(entropy, self.brute_force(sl, logits, evidence))
+        grad, = torch.autograd.grad(entropy.sum(), logits)
+        assert torch.isfinite(grad).all()
+
+    def test_chunked(self):
+        sl = load(SDD_FILES[1], log_space=True)
+        chunked = load(SDD_FILES[1], log_space=True, chunk_size=3)
+        logits = torch.randn(10, sl.circuit.var_count, dtype=torch.float64)
+        assert torch.allclose(
+            chunked(logits=logits, output_entropy=True)[1], sl(logits=logits, output_entropy=True)[1]
+        )
+
+    def test_categorical(self):
+        groups = vtree_groups(load(SDD_FILES[0]).psdd, 2)
+        sl = load(SDD_FILES[0], categorical_groups=groups)
+        probabilities = torch.rand(4, sl.circuit.var_count, dtype=torch.float64)
+        for group in groups:
+            probabilities[:, group] /= probabilities[:, group].sum(dim=-1, keepdim=True)
+
+        # the categorical models are some of the models of the SDD, so top-k enumerates all of them
+        _, entropy = sl(probabilities=probabilities, output_entropy=True)
+        top, log_probability = sl.top_k(sl.psdd.model_count(), probabilities=probabilities)
+        log_probability = log_probability - log_probability.logsumexp(dim=-1, keepdim=True)
+        finite = torch.isfinite(log_probability)
+        expected = -(log_probability.exp() * log_probability.masked_fill(~finite, 0.0)).sum(dim=-1)
+        assert torch.allclose(entropy, expected)
+
+
+class TestBuilders:
+
+    @staticmethod
+    def brute_force(shape, predicate, probabilities):
+        n_vars = math.prod(shape)
+        wmc = torch.zeros(probabilities.shape[0], dtype=probabilities.dtype)
+        for bits in itertools.product([0, 1], repeat=n_vars):
+            x = torch.tensor(bits).reshape(shape)
+            if predicate(x):
+                assignment = torch.tensor(bits, dtype=torch.bool)
+                wmc += torch.where(assignment, probabilities, 1 - probabilities).prod(dim=-1)
+        return wmc
+
+    @pytest.mark.parametrize("build, predicate", [
+        (lambda m: builders.exactly_one(m, (3, 3)), lambda x: (x.sum(-1) == 1).all()),
+        (lambda m: builders.exactly_k(m, (3, 3), 2, dim=0), lambda x: (x.sum(0) == 2).all()),
+        (lambda m: builders.at_most_k(m, (3, 3), 1, dim=0), lambda x: (x.sum(0) <= 1).all()),
+        (lambda m: builders.at_least_k(m, (3, 3), 2), lambda x: (x.sum(-1) >= 2).all()),
+        (
+            lambda m: m.conjoin(builders.exactly_one(m, (3, 3)), builders.at_most_k(m, (3, 3), 1, dim=0)),
+            lambda x: (x.sum(-1) == 1).all() and (x.sum(0) <= 1).all(),
+        ),
+        (
+            lambda m: builders.neighbour_implications(m, (3, 3), constraint=builders.exactly_one(m, (3, 3))),
+            lambda x: (x.sum(-1) == 1).all() and (x[:-1] <= x[1:]).all(),
+        ),
+    ])
+    def test_same_wmc_as_brute_force(self, build, predicate):
+        manager = builders.shape_manager((3, 3))
+        sl = SemanticLoss(psdd=build(manager))
+        probabilities = torch.rand(4, 9, dtype=torch.float64)
+
+        _, wmc = sl(probabilities=probabilities, output_wmc_per_sample=True)
+        assert torch.allclose(wmc, self.brute_force((3, 3), predicate, probabilities))
+
+    def test_same_loss_as_files(self, tmp_path):
+        manager = builders.shape_manager((4, 3))
+        psdd = manager.conjoin(builders.exactly_one(manager, (4, 3)), builders.at_most_k(manager, (4, 3), 2, dim=0))
+        manager.vtree.save(str(tmp_path / "constraint.vtree"))
+        io.sdd_save(psdd, str(tmp_path / "constraint.sdd"))
+        logits = torch.randn(8, 12, dtype=torch.float64)
+
+        built = SemanticLoss(psdd=psdd)
+        loaded = SemanticLoss(str(tmp_path / "constraint.sdd"), str(tmp_path / "constraint.vtree"))
+        assert torch.allclose(built(logits=logits), loaded(logits=logits))
+
+    def test_categorical_groups(self):
+        # the rows are vtree nodes, so exactly_one can be evaluated on categorical distributions over them
+        manager = builders.shape_manager((4, 3))
+        sl = SemanticLoss(psdd=builders.exactly_one(manager, (4, 3)), categorical_groups=categorical_groups((4, 3)))
+        logits = torch.randn(8, 12, dtype=torch.float64)
+
+        assert torch.allclose(sl(logits=logits), torch.zeros((), dtype=torch.float64), atol=1e-12)
+
+    def test_sdd_size_is_polynomial(self):
+        manager = builders.shape_manager((256,))
+        assert builders.at_most_k(manager, (256,), 16).size() < 256 * 17 * 4
+
+    def test_psdd_and_files_are_exclusive(self, tmp_path):
+        psdd = builders.exactly_one(builders.shape_manager((3,)), (3,))
+        with pytest.raises(ValueError):
+            SemanticLoss()
+        with pytest.raises(ValueError):
+            SemanticLoss(SDD_FILES[0], vtree_of(SDD_FILES[0]), psdd=psdd)
+        with pytest.raises(ValueError):
+            SemanticLoss(psdd=psdd, cache_dir=str(tmp_path))
+
+
+class TestAuxiliaryVariables:
+
+    CONSTRAINTS = (
+        "shape [3,3]\nExactlyOne(X0.0, X0.1, X0.2)\nAtMostK(1, X0.0, X1.0, X2.0)\nAtLeastK(2, X1.1, X2.1, X2.2)\n"
+    )
+
+    @staticmethod
+    def predicate(x):
+        return x[0].sum() == 1 and x[:, 0].sum() <= 1 and x[1, 1] + x[2, 1] + x[2, 2] >= 2
+
+    @pytest.fixture(params=["cnf", "tseitin"])
+    def files(self, request, tmp_path):
+        """
+        Converts the constraints to DIMACS with each encoding, then compiles the clauses to `sdd` and `vtree` files.
+        """
+        (tmp_path / "constraints.txt").write_text(self.CONSTRAINTS)
+        ConstraintsToCnf.expression_to_cnf(
+            str(tmp_path / "constraints.txt"), str(tmp_path / "dimacs.txt"), encoding=request.param
+        )
+        lines = [line.split() for line in (tmp_path / "dimacs.txt").read_text().splitlines() if line[:1] not in "c"]
+        var_count = int(lines[0][2])
+        clauses = [[int(literal) for literal in line[:-1]] for line in lines[1:]]
+
+        manager = builders.shape_manager((var_count,))
+        psdd = manager.conjoin(*[manager.disjoin(*map(manager.literal_sdd, clause)) for clause in clauses])
+        manager.vtree.save(str(tmp_path / "constraint.vtree"))
+        io.sdd_save(psdd, str(tmp_path / "constraint.sdd"))
+        return str(tmp_path / "constraint.sdd"), str(tmp_path / "constraint.vtree"), var_count - 9
+
+    @pytest.mark.parametrize("log_space", [False, True])
+    def test_same_wmc_as_brute_force(self, files, log_space):
+        sdd_file, vtree_file, auxiliary_vars = files
+        assert auxiliary_vars > 0
+        sl = SemanticLoss(sdd_file, vtree_file, log_space=log_space, auxiliary_vars=auxiliary_vars)
+        probabilities = torch.rand(4, 3, 3, dtype=torch.float64)
+
+        _, wmc = sl(probabilities=probabilities, output_wmc_per_sample=True)
+        expected = TestBuilders.brute_force((3, 3), self.predicate, probabilities.reshape(4, 9))
+        assert torch.allclose(wmc.exp() if log_space else wmc, expected)
+
+        # the auxiliary variables are not part of the outputs, variables after the input ones are independent
+        assert sl.marginals(probabilities=probabilities).shape == (4, 9)
+        assignment, _ = sl.mpe(probabilities=torch.rand(4, 10, dtype=torch.float64))
+        assert assignment.shape == (4, 10)
+        assert all(self.predicate(x) for x in assignment[:, :9].reshape(4, 3, 3))
+
+    def test_conditional(self, files):
+        sdd_file, vtree_file, auxiliary_vars = files
+        sl = SemanticLoss(sdd_file, vtree_file, auxiliary_vars=auxiliary_vars)
+        probabilities = torch.rand(4, 9, dtype=torch.float64)
+        evidence = torch.full((4, 9), -1)
+        evidence[:, 0] = 0
+
+        _, wmc = sl(probabilities=probabilities, evidence=evidence, conditional=True, output_wmc_per_sample=True)
+        observed = probabilities.clone()
+        observed[:, 0] = 0.0
+        # the probability of the constraint given that X0.0 is false
+        assert torch.allclose(wmc, TestBuilders.brute_force((3, 3), self.predicate, observed))
+
+    def test_required(self, files):
+        sdd_file, vtree_file, auxiliary_vars = files
+        with pytest.raises(ValueError):
+            SemanticLoss(sdd_file, vtree_file)(probabilities=torch.rand(2, 9))
+        with pytest.raises(ValueError):
+            SemanticLoss(sdd_file, vtree_file, auxiliary_vars=auxiliary_vars + 10)
+        with pytest.raises(ValueError):
+            SemanticLoss(sdd_file, vtree_file, auxiliary_vars=auxiliary_vars).scriptable()
+
+
+class TestProfiling:
+
+    def test_records_loading_and_evaluation(self, tmp_path):
+        with profiling.profile() as prof:
+            sl = load(SDD_FILES[5])
+            logits = torch.randn(8, sl.circuit.var_count, requires_grad=True)
+            sl(logits).backward()
+
+        for name in ["load.vtree_read", "load.sdd_read", "load.normalize", "compile.linearize", "forward", "backward"]:
+            assert prof.calls(name) == 1
+        assert prof.calls("circuit.backward") == 1
+        assert prof.counter("forward.nodes_visited") == sl.circuit.n_nodes
+        assert prof.counter("forward.tensors_allocated") > 0
+        assert prof.counter("load.sdd_read.unique_misses") > 0
+        assert prof.counter("load.normalize.nodes_created") > 0
+
+        summary = json.loads(prof.to_json(str(tmp_path / "profile.json")))
+        assert summary == json.loads((tmp_path / "profile.json").read_text())
+        assert summary["counters"]["forward.nodes_visited"] == sl.circuit.n_nodes
+        assert summary["timings"]["forward"]["calls"] == 1
+
+    def test_inactive_by_default(self):
+        sl = load(SDD_FILES[5])
+        with profiling.profile() as prof:
+            pass
+        sl(torch.randn(4, sl.circuit.var_count))
+        assert profiling.active() is None
+        assert prof.summary() == {"timings": {}, "counters": {}}
+
+    def test_same_result_when_profiled(self):
+        sl = load(SDD_FILES[5])
+        logits = torch.randn(4, sl.circuit.var_count, dtype=torch.float64, requires_grad=True)
+        expected, = torch.autograd.grad(sl(logits=logits), logits)
+        with profiling.profile():
+            profiled, = torch.autograd.grad(sl(logits=logits), logits)
+        assert torch.allclose(expected, profiled)
+        assert not logits._backward_hooks
+
+
+class TestThreadSafety:
+
+    @pytest.mark.parametrize("compiled", [True, False])
+    def test_concurrent_forward(self, compiled):
+        sl = load(SDD_FILES[5], compiled=compiled)
+        inputs = [torch.rand(4, sl.circuit.var_count, dtype=torch.float64) for _ in range(32)]
+
+        def wmc_per_sample(x):
+            return sl(probabilities=x, output_wmc_per_sample=True)[1]
+
+        expected = [wmc_per_sample(x) for x in inputs]
+        with ThreadPoolExecutor(8) as pool:
+            results = list(pool.map(wmc_per_sample, inputs))
+        assert all(torch.equal(result, reference) for result, reference in zip(results, expected))
+
+    def test_evaluators_leave_nodes_untouched(self):
+        psdd = load(SDD_FILES[5]).psdd
+        psdd.generate_pt_ac_v2(torch.rand(2, psdd.vtree.var_count))
+        psdd.weighted_model_count([[0.3, 0.7]] * psdd.vtree.var_count)
+        psdd.get_weighted_mpe([[0.3, 0.7]] * psdd.vtree.var_count)
+        assert all(node.data is None and node._bit is False for node in psdd.as_list(clear_data=False))
+
+
+class TestChunked:
+
+    @pytest.mark.parametrize("log_space", [False, True])
+    def test_same_as_whole_batch(self, log_space):
+        sl = load(SDD_FILES[2], log_space=log_space)
+        chunked = load(SDD_FILES[2], log_space=log_space, chunk_size=3)
+        logits = torch.randn(10, sl.circuit.var_count, dtype=torch.float64, requires_grad=True)
+
+        loss, wmc_per_sample = sl(logits=logits, output_wmc_per_sample=True)
+        chunked_loss, chunked_wmc_per_sample = chunked(logits=logits, output_wmc_per_sample=True)
+        assert torch.allclose(loss, chunked_loss)
+        assert torch.allclose(wmc_per_sample, chunked_wmc_per_sample)
+
+        grad, = torch.autograd.grad(loss, logits)
+        chunked_grad, = torch.autograd.grad(chunked_loss, logits)
+        assert torch.allclose(grad, chunked_grad)
+
+    def test_chunk_size_from_max_memory(self):
+        sl = load(LARGE_SDD_FILE, max_memory=2 ** 24)
+        chunk_size = sl.circuit.chunk_size(2 ** 24)
+        assert 1 < chunk_size < 64
+        assert chunk_size * sl.circuit.memory_per_sample() <= 2 ** 24
+        assert sl.circuit.chunk_size(2 ** 24, dtype=torch.float64) == chunk_size // 2
+
+        logits = torch.randn(64, sl.circuit.var_count, requires_grad=True)
+        assert torch.allclose(sl(logits=logits), load(LARGE_SDD_FILE)(logits=logits))
+
+    def test_invalid_options(self):
+        with pytest.raises(ValueError):
+            load(SDD_FILES[0], chunk_size=4, max_memory=2 ** 20)
+        with pytest.raises(ValueError):
+            load(SDD_FILES[0], chunk_size=0)
+
+
+class TestMultiConstraint:
+
+    @pytest.mark.parametrize("log_space", [False, True])
+    def test_same_as_separate_losses(self, log_space):
+        sdd_files = SDD_FILES[:4]
+        weights = [1.0, 0.5, 2.0, 3.0]
+        multi = MultiConstraintSemanticLoss(
+            sdd_files, [vtree_of(f) for f in sdd_files], weights=weights, log_space=log_space
+        )
+        singles = [load(f, log_space=log_space) for f in sdd_files]
+        logits = torch.randn(8, multi.circuit.var_count, dtype=torch.float64, requires_grad=True)
+
+        loss, wmc, wmc_per_sample = multi(logits=logits, output_wmc=True, output_wmc_per_sample=True)
+        assert wmc.shape == (4,) and wmc_per_sample.shape == (8, 4)
+
+        expected_loss = 0
+        for i, (weight, sl) in enumerate(zip(weights, singles)):
+            single_loss, single_wmc, single_wmc_per_sample = sl(
+                logits=logits[:, :sl.circuit.var_count], output_wmc=True, output_wmc_per_sample=True
+            )
+            assert torch.allclose(wmc[i], single_wmc)
+            assert torch.allclose(wmc_per_sample[:, i], single_wmc_per_sample)
+            expected_loss = expected_loss + weight * single_loss
+        assert torch.allclose(loss, expected_loss)
+
+        grad, = torch.autograd.grad(loss, logits)
+        expected_grad, = torch.autograd.grad(expected_loss, logits)
+        assert torch.allclose(grad, expected_grad)
+
+    def test_shared_nodes(self):
+        sdd_file = SDD_FILES[1]
+        single = load(sdd_file)
+        multi = MultiConstraintSemanticLoss([sdd_file] * 3, [vtree_of(sdd_file)] * 3)
+
+        assert multi.circuit.n_nodes == single.circuit.n_nodes
+        x = torch.rand(4, single.circuit.var_count)
+        wmc_per_sample = multi(probabilities=x, output_wmc_per_sample=True)[1]
+        assert torch.allclose(wmc_per_sample, single(probabilities=x, output_wmc_per_sample=True)[1][:, None])
+
+    def test_wrong_number_of_weights(self):
+        with pytest.raises(ValueError):
+            MultiConstraintSemanticLoss(SDD_FILES[:2], [vtree_of(f) for f in SDD_FILES[:2]], weights=[1.0])
+
+
+def load_from_cache(args):
+    sdd_file, cache_dir = args
+    return load(sdd_file, cache_dir=cache_dir).circuit.to_arrays()
+
+
+class TestCache:
+
+    def test_load_from_cache(self, tmp_path):
+        sl = load(SDD_FILES[2], cache_dir=str(tmp_path))
+        assert len(list(tmp_path.glob("*.npz"))) == 1
+
+        cached = load(SDD_FILES[2], cache_dir=str(tmp_path))
+        assert cached._psdd is None
+        x = torch.rand(4, sl.circuit.var_count)
+        assert torch.allclose(sl(probabilities=x), cached(probabilities=x))
+
+        # the psdd is still available for the reference implementation
+        cached.compiled = False
+        assert torch.allclose(sl(probabilities=x), cached(probabilities=x))
+
+    def test_key_depends_on_content(self, tmp_path):
+        sdd_file = tmp_path / "constraint.sdd"
+        sdd_file.write_text(open(SDD_FILES[0]).read())
+        key = cache.cache_key(str(sdd_file), vtree_of(SDD_FILES[0]))
+
+        assert key == cache.cache_key(SDD_FILES[0], vtree_of(SDD_FILES[0]))
+        sdd_file.write_text(open(SDD_FILES[1]).read())
+        assert key != cache.cache_key(str(sdd_file), vtree_of(SDD_FILES[0]))
+
+    def test_concurrent_processes(self, tmp_path):
+        with multiprocessing.get_context("fork").Pool(4) as pool:
+            results = pool.map(load_from_cache, [(SDD_FILES[3], str(tmp_path))] * 4)
+
+        for arrays in results[1:]:
+            assert all((arrays[name] == results[0][name]).all() for name in arrays)
+        assert len(list(tmp_path.glob("*.npz"))) == 1
+        assert len(list(tmp_path.glob("*.tmp"))) == 0